@@ -40,14 +40,14 @@ the following types are supported: int (in the unsigned long range), bool,
 unicode (In Py2) / str (In Py3), float, slice, complex, tuple(of simple types),
 list(of simple types), frozenset(of simple types)
 as well as the following singletons: None, NotImplemented, Ellipsis
+
+Objects are dumped into a single growing buffer, and loaded by walking the
+byte-string with an offset, using a table of loaders indexed by the tag.
 """
 import sys
 py3k = (sys.version_info[0] == 3)
-if not py3k:
-    from cStringIO import StringIO
-else:
-    from io import BytesIO
 from struct import Struct
+import codecs
 
 if not py3k:
     def b(n):
@@ -58,6 +58,35 @@ else:
         return bytes([n])
     empty_bytes = bytes()
 
+try:
+    bytearray
+except NameError:
+    # Python 2.5 doesn't have bytearray, so we collect the parts in a list.
+    has_bytearray = False
+    class _ListBuffer(list):
+        extend = list.append
+    def _new_buffer():
+        return _ListBuffer()
+    def _buffer_bytes(buf):
+        return empty_bytes.join(buf)
+else:
+    has_bytearray = True
+    _new_buffer = bytearray
+    _buffer_bytes = bytes
+
+try:
+    _memoryview = memoryview
+except NameError:
+    # Python 2.6 doesn't have memoryview
+    _memoryview = None
+
+if py3k:
+    _int_from_bytes = int
+else:
+    def _int_from_bytes(s):
+        # int() doesn't accept a bytearray in Python 2
+        return int(str(s))
+
 # singletons
 TAG_NONE = b(0x00)
 TAG_EMPTY_STR = b(0x01)
@@ -101,9 +130,21 @@ I4 = Struct("!L")
 F8 = Struct("!d")
 C16 = Struct("!dd")
 
+# These are faster than the encode and decode methods, since they skip the
+# codec lookup.
+_utf8_encode = codecs.utf_8_encode
+_utf8_decode = codecs.utf_8_decode
+
+# The headers of strings, tuples and lists, indexed by their length, for
+# lengths which fit in one byte.
+_STR_HEADERS = ([TAG_EMPTY_STR, TAG_STR1, TAG_STR2, TAG_STR3, TAG_STR4]
+                + [TAG_STR_L1 + I1.pack(l) for l in range(5, 256)])
+_TUP_HEADERS = ([TAG_EMPTY_TUPLE, TAG_TUP1, TAG_TUP2, TAG_TUP3, TAG_TUP4]
+                + [TAG_TUP_L1 + I1.pack(l) for l in range(5, 256)])
+_LIST_HEADERS = ([TAG_EMPTY_LIST, TAG_LIST1]
+                 + [TAG_LIST_L1 + I1.pack(l) for l in range(2, 256)])
+
 _dump_registry = {}
-_load_registry = {}
-IMM_INTS_LOADER = dict((v, k) for k, v in IMM_INTS.iteritems())
 
 def register(coll, key):
     def deco(func):
@@ -115,261 +156,294 @@ def register(coll, key):
 # dumping
 #===============================================================================
 @register(_dump_registry, type(None))
-def _dump_none(_obj, stream):
-    stream.append(TAG_NONE)
+def _dump_none(_obj, buf):
+    buf.extend(TAG_NONE)
 
 @register(_dump_registry, type(NotImplemented))
-def _dump_notimplemeted(_obj, stream):
-    stream.append(TAG_NOT_IMPLEMENTED)
+def _dump_notimplemeted(_obj, buf):
+    buf.extend(TAG_NOT_IMPLEMENTED)
 
 @register(_dump_registry, type(Ellipsis))
-def _dump_ellipsis(_obj, stream):
-    stream.append(TAG_ELLIPSIS)
+def _dump_ellipsis(_obj, buf):
+    buf.extend(TAG_ELLIPSIS)
 
 @register(_dump_registry, bool)
-def _dump_bool(obj, stream):
+def _dump_bool(obj, buf):
     if obj:
-        stream.append(TAG_TRUE)
+        buf.extend(TAG_TRUE)
     else:
-        stream.append(TAG_FALSE)
+        buf.extend(TAG_FALSE)
 
 @register(_dump_registry, slice)
-def _dump_slice(obj, stream):
-    stream.append(TAG_SLICE)
-    _dump((obj.start, obj.stop, obj.step), stream)
+def _dump_slice(obj, buf):
+    buf.extend(TAG_SLICE)
+    _dump_tuple((obj.start, obj.stop, obj.step), buf)
 
 @register(_dump_registry, frozenset)
-def _dump_frozenset(obj, stream):
-    stream.append(TAG_FSET)
-    _dump(tuple(obj), stream)
+def _dump_frozenset(obj, buf):
+    buf.extend(TAG_FSET)
+    _dump_tuple(tuple(obj), buf)
 
 @register(_dump_registry, int)
-def _dump_int(obj, stream):
+def _dump_int(obj, buf):
     if obj in IMM_INTS:
-        stream.append(IMM_INTS[obj])
+        buf.extend(IMM_INTS[obj])
     else:
-        obj = str(obj)
+        obj = str(obj).encode('ascii')
         l = len(obj)
         if l < 256:
-            stream.append(TAG_INT_L1 + I1.pack(l) + obj)
+            buf.extend(TAG_INT_L1 + I1.pack(l))
         else:
-            stream.append(TAG_INT_L4 + I4.pack(l) + obj)
-
-#@register(_dump_registry, long)
-#def _dump_long(obj, stream):
-#    stream.append(TAG_LONG)
-#    _dump_int(obj, stream)
+            buf.extend(TAG_INT_L4 + I4.pack(l))
+        buf.extend(obj)
 
 @register(_dump_registry, unicode)
-def _dump_str(obj, stream):
-    obj = obj.encode('utf8')
+def _dump_str(obj, buf):
+    obj = _utf8_encode(obj)[0]
     l = len(obj)
-    if l == 0:
-        stream.append(TAG_EMPTY_STR)
-    elif l == 1:
-        stream.append(TAG_STR1 + obj)
-    elif l == 2:
-        stream.append(TAG_STR2 + obj)
-    elif l == 3:
-        stream.append(TAG_STR3 + obj)
-    elif l == 4:
-        stream.append(TAG_STR4 + obj)
-    elif l < 256:
-        stream.append(TAG_STR_L1 + I1.pack(l) + obj)
+    if l < 256:
+        buf.extend(_STR_HEADERS[l])
     else:
-        stream.append(TAG_STR_L4 + I4.pack(l) + obj)
+        buf.extend(TAG_STR_L4 + I4.pack(l))
+    buf.extend(obj)
 
 @register(_dump_registry, float)
-def _dump_float(obj, stream):
-    stream.append(TAG_FLOAT + F8.pack(obj))
+def _dump_float(obj, buf):
+    buf.extend(TAG_FLOAT + F8.pack(obj))
 
 @register(_dump_registry, complex)
-def _dump_complex(obj, stream):
-    stream.append(TAG_COMPLEX + C16.pack(obj.real, obj.imag))
+def _dump_complex(obj, buf):
+    buf.extend(TAG_COMPLEX + C16.pack(obj.real, obj.imag))
 
-#@register(_dump_registry, unicode)
-#def _dump_unicode(obj, stream):
-#    stream.append(TAG_UNICODE)
-#    _dump_str(obj.encode("utf8"), stream)
+def _dump_items(obj, buf):
+    # This is _dump() inlined, since it's called for every item.
+    dumpers = _dump_registry
+    for item in obj:
+        dumpers.get(type(item), _undumpable)(item, buf)
 
 @register(_dump_registry, tuple)
-def _dump_tuple(obj, stream):
+def _dump_tuple(obj, buf):
     l = len(obj)
-    if l == 0:
-        stream.append(TAG_EMPTY_TUPLE)
-    elif l == 1:
-        stream.append(TAG_TUP1)
-    elif l == 2:
-        stream.append(TAG_TUP2)
-    elif l == 3:
-        stream.append(TAG_TUP3)
-    elif l == 4:
-        stream.append(TAG_TUP4)
-    elif l < 256:
-        stream.append(TAG_TUP_L1 + I1.pack(l))
+    if l < 256:
+        buf.extend(_TUP_HEADERS[l])
     else:
-        stream.append(TAG_TUP_L4 + I4.pack(l))
-    for item in obj:
-        _dump(item, stream)
+        buf.extend(TAG_TUP_L4 + I4.pack(l))
+    _dump_items(obj, buf)
 
 @register(_dump_registry, list)
-def _dump_list(obj, stream):
+def _dump_list(obj, buf):
     l = len(obj)
-    if l == 0:
-        stream.append(TAG_EMPTY_LIST)
-    elif l == 1:
-        stream.append(TAG_LIST1)
-    elif l < 256:
-        stream.append(TAG_LIST_L1 + I1.pack(l))
+    if l < 256:
+        buf.extend(_LIST_HEADERS[l])
     else:
-        stream.append(TAG_LIST_L4 + I4.pack(l))
-    for item in obj:
-        _dump(item, stream)
+        buf.extend(TAG_LIST_L4 + I4.pack(l))
+    _dump_items(obj, buf)
 
-def _undumpable(obj, stream):
+def _undumpable(obj, _buf):
     raise TypeError("cannot dump %r" % (obj,))
 
-def _dump(obj, stream):
-    _dump_registry.get(type(obj), _undumpable)(obj, stream)
+def _dump(obj, buf):
+    _dump_registry.get(type(obj), _undumpable)(obj, buf)
 
 #===============================================================================
 # loading
 #===============================================================================
-@register(_load_registry, TAG_NONE)
-def _load_none(_stream):
-    return None
-@register(_load_registry, TAG_NOT_IMPLEMENTED)
-def _load_nonimp(_stream):
-    return NotImplemented
-@register(_load_registry, TAG_ELLIPSIS)
-def _load_elipsis(_stream):
-    return Ellipsis
-@register(_load_registry, TAG_TRUE)
-def _load_true(_stream):
-    return True
-@register(_load_registry, TAG_FALSE)
-def _load_false(_stream):
-    return False
-@register(_load_registry, TAG_EMPTY_TUPLE)
-def _load_empty_tuple(_stream):
-    return ()
-@register(_load_registry, TAG_EMPTY_LIST)
-def _load_empty_list(_stream):
-    return []
-@register(_load_registry, TAG_EMPTY_STR)
-def _load_empty_str(_stream):
-    return u""
-#@register(_load_registry, TAG_UNICODE)
-#def _load_unicode(stream):
-#    obj = _load(stream)
-#    return obj.decode("utf-8")
-#@register(_load_registry, TAG_LONG)
-#def _load_long(stream):
-#    obj = _load(stream)
-#    return long(obj)
-
-@register(_load_registry, TAG_FLOAT)
-def _load_float(stream):
-    return F8.unpack(stream.read(8))[0]
-@register(_load_registry, TAG_COMPLEX)
-def _load_complex(stream):
-    real, imag = C16.unpack(stream.read(16))
-    return complex(real, imag)
-
-@register(_load_registry, TAG_STR1)
-def _load_str1(stream):
-    return stream.read(1).decode('utf8')
-@register(_load_registry, TAG_STR2)
-def _load_str2(stream):
-    return stream.read(2).decode('utf8')
-@register(_load_registry, TAG_STR3)
-def _load_str3(stream):
-    return stream.read(3).decode('utf8')
-@register(_load_registry, TAG_STR4)
-def _load_str4(stream):
-    return stream.read(4).decode('utf8')
-@register(_load_registry, TAG_STR_L1)
-def _load_str_l1(stream):
-    l, = I1.unpack(stream.read(1))
-    return stream.read(l).decode('utf8')
-@register(_load_registry, TAG_STR_L4)
-def _load_str_l4(stream):
-    l, = I4.unpack(stream.read(4))
-    return stream.read(l).decode('utf8')
-
-@register(_load_registry, TAG_TUP1)
-def _load_tup1(stream):
-    return (_load(stream),)
-@register(_load_registry, TAG_TUP2)
-def _load_tup2(stream):
-    return (_load(stream), _load(stream))
-@register(_load_registry, TAG_TUP3)
-def _load_tup3(stream):
-    return (_load(stream), _load(stream), _load(stream))
-@register(_load_registry, TAG_TUP4)
-def _load_tup4(stream):
-    return (_load(stream), _load(stream), _load(stream), _load(stream))
-@register(_load_registry, TAG_TUP_L1)
-def _load_tup_l1(stream):
-    l, = I1.unpack(stream.read(1))
-    return tuple(_load(stream) for i in range(l))
-@register(_load_registry, TAG_TUP_L4)
-def _load_tup_l4(stream):
-    l, = I4.unpack(stream.read(4))
-    return tuple(_load(stream) for i in xrange(l))
-
-@register(_load_registry, TAG_LIST1)
-def _load_list1(stream):
-    return [_load(stream)]
-@register(_load_registry, TAG_LIST_L1)
-def _load_list_l1(stream):
-    l, = I1.unpack(stream.read(1))
-    return list(_load(stream) for i in range(l))
-@register(_load_registry, TAG_LIST_L4)
-def _load_list_l4(stream):
-    l, = I4.unpack(stream.read(4))
-    return list(_load(stream) for i in xrange(l))
-
-
-@register(_load_registry, TAG_SLICE)
-def _load_slice(stream):
-    start, stop, step = _load(stream)
-    return slice(start, stop, step)
-@register(_load_registry, TAG_FSET)
-def _load_frozenset(stream):
-    return frozenset(_load(stream))
-
-@register(_load_registry, TAG_INT_L1)
-def _load_int_l1(stream):
-    l, = I1.unpack(stream.read(1))
-    return int(stream.read(l))
-@register(_load_registry, TAG_INT_L4)
-def _load_int_l4(stream):
-    l, = I4.unpack(stream.read(4))
-    return int(stream.read(l))
-
-def _load(stream):
-    tag = stream.read(1)
-    if tag in IMM_INTS_LOADER:
-        return IMM_INTS_LOADER[tag]
-    return _load_registry.get(tag)(stream)
+# Each loader gets the data and the offset after the tag, and returns the
+# loaded object and the offset after it. _loaders is indexed by the tag's
+# byte value.
+
+def _unknown_tag(data, pos):
+    raise ValueError("unknown brine tag %r at offset %d"
+                     % (data[pos-1:pos], pos-1))
+
+_loaders = [_unknown_tag] * 256
+_STR_L1 = ord(TAG_STR_L1)
+
+def register_loader(tag):
+    def deco(func):
+        _loaders[ord(tag)] = func
+        return func
+    return deco
+
+def _make_const_loader(value):
+    def load_const(_data, pos):
+        return value, pos
+    return load_const
+
+for _tag, _value in [(TAG_NONE, None),
+                     (TAG_NOT_IMPLEMENTED, NotImplemented),
+                     (TAG_ELLIPSIS, Ellipsis),
+                     (TAG_TRUE, True),
+                     (TAG_FALSE, False),
+                     (TAG_EMPTY_TUPLE, ()),
+                     (TAG_EMPTY_STR, u"")]:
+    register_loader(_tag)(_make_const_loader(_value))
+for _value, _tag in IMM_INTS.items():
+    register_loader(_tag)(_make_const_loader(_value))
+del _tag, _value
+
+@register_loader(TAG_EMPTY_LIST)
+def _load_empty_list(_data, pos):
+    return [], pos
+
+@register_loader(TAG_FLOAT)
+def _load_float(data, pos):
+    return F8.unpack_from(data, pos)[0], pos + 8
+@register_loader(TAG_COMPLEX)
+def _load_complex(data, pos):
+    real, imag = C16.unpack_from(data, pos)
+    return complex(real, imag), pos + 16
+
+def _make_str_loader(l):
+    def load_str(data, pos):
+        end = pos + l
+        return _utf8_decode(data[pos:end], 'strict', True)[0], end
+    return load_str
+
+for _tag, _l in [(TAG_STR1, 1), (TAG_STR2, 2), (TAG_STR3, 3), (TAG_STR4, 4)]:
+    register_loader(_tag)(_make_str_loader(_l))
+del _tag, _l
+
+@register_loader(TAG_STR_L1)
+def _load_str_l1(data, pos):
+    l, = I1.unpack_from(data, pos)
+    pos += 1
+    end = pos + l
+    return _utf8_decode(data[pos:end], 'strict', True)[0], end
+@register_loader(TAG_STR_L4)
+def _load_str_l4(data, pos):
+    l, = I4.unpack_from(data, pos)
+    pos += 4
+    end = pos + l
+    if _memoryview is not None:
+        # Decode long strings without copying them first
+        return _utf8_decode(_memoryview(data)[pos:end], 'strict', True)[0], end
+    return _utf8_decode(data[pos:end], 'strict', True)[0], end
+
+if py3k or has_bytearray:
+    # Indexing bytes in Py3k, or a bytearray, gives an int
+    def _load_items(data, pos, n):
+        """Load n objects. Return a list of them and the offset after them."""
+        loaders = _loaders
+        str_l1 = _STR_L1
+        decode = _utf8_decode
+        items = []
+        append = items.append
+        for _i in xrange(n):
+            tag = data[pos]
+            if tag == str_l1:
+                # Most items are short strings, so they are loaded here.
+                end = pos + 2 + data[pos + 1]
+                append(decode(data[pos + 2:end], 'strict', True)[0])
+                pos = end
+            else:
+                obj, pos = loaders[tag](data, pos + 1)
+                append(obj)
+        return items, pos
+else:
+    def _load_items(data, pos, n):
+        """Load n objects. Return a list of them and the offset after them."""
+        loaders = _loaders
+        str_l1 = _STR_L1
+        decode = _utf8_decode
+        items = []
+        append = items.append
+        for _i in xrange(n):
+            tag = ord(data[pos])
+            if tag == str_l1:
+                # Most items are short strings, so they are loaded here.
+                end = pos + 2 + ord(data[pos + 1])
+                append(decode(data[pos + 2:end], 'strict', True)[0])
+                pos = end
+            else:
+                obj, pos = loaders[tag](data, pos + 1)
+                append(obj)
+        return items, pos
+
+def _make_tup_loader(l):
+    def load_tup(data, pos):
+        items, pos = _load_items(data, pos, l)
+        return tuple(items), pos
+    return load_tup
+
+for _tag, _l in [(TAG_TUP1, 1), (TAG_TUP2, 2), (TAG_TUP3, 3), (TAG_TUP4, 4)]:
+    register_loader(_tag)(_make_tup_loader(_l))
+del _tag, _l
+
+@register_loader(TAG_TUP_L1)
+def _load_tup_l1(data, pos):
+    l, = I1.unpack_from(data, pos)
+    items, pos = _load_items(data, pos + 1, l)
+    return tuple(items), pos
+@register_loader(TAG_TUP_L4)
+def _load_tup_l4(data, pos):
+    l, = I4.unpack_from(data, pos)
+    items, pos = _load_items(data, pos + 4, l)
+    return tuple(items), pos
+
+@register_loader(TAG_LIST1)
+def _load_list1(data, pos):
+    return _load_items(data, pos, 1)
+@register_loader(TAG_LIST_L1)
+def _load_list_l1(data, pos):
+    l, = I1.unpack_from(data, pos)
+    return _load_items(data, pos + 1, l)
+@register_loader(TAG_LIST_L4)
+def _load_list_l4(data, pos):
+    l, = I4.unpack_from(data, pos)
+    return _load_items(data, pos + 4, l)
+
+@register_loader(TAG_SLICE)
+def _load_slice(data, pos):
+    (start, stop, step), pos = _load(data, pos)
+    return slice(start, stop, step), pos
+@register_loader(TAG_FSET)
+def _load_frozenset(data, pos):
+    items, pos = _load(data, pos)
+    return frozenset(items), pos
+
+@register_loader(TAG_INT_L1)
+def _load_int_l1(data, pos):
+    l, = I1.unpack_from(data, pos)
+    pos += 1
+    end = pos + l
+    return _int_from_bytes(data[pos:end]), end
+@register_loader(TAG_INT_L4)
+def _load_int_l4(data, pos):
+    l, = I4.unpack_from(data, pos)
+    pos += 4
+    end = pos + l
+    return _int_from_bytes(data[pos:end]), end
+
+def _load(data, pos):
+    items, pos = _load_items(data, pos, 1)
+    return items[0], pos
 
 #===============================================================================
 # API
 #===============================================================================
 def dump(obj):
     """dumps the given object to a byte-string representation"""
-    stream = []
-    _dump(obj, stream)
-    return empty_bytes.join(stream)
+    buf = _new_buffer()
+    _dump(obj, buf)
+    return _buffer_bytes(buf)
+
+def dump_into(obj, buf):
+    """
+    appends the byte-string representation of the given object to a bytearray,
+    which saves copying it when it's sent with a header
+    """
+    _dump(obj, buf)
 
 def load(data):
-    """loads the given byte-string representation to an object"""
-    if not py3k:
-        stream = StringIO(data)
-    else:
-        stream = BytesIO(data)
-    return _load(stream)
+    """
+    loads the given byte-string representation, or a bytearray with it, to an
+    object
+    """
+    if not py3k and has_bytearray and type(data) is str:
+        data = bytearray(data)
+    obj, _pos = _load(data, 0)
+    return obj
 
 
 simple_types = frozenset([type(None), int, long, bool, str, float, unicode, 
@@ -390,12 +464,3 @@ if __name__ == "__main__":
     y = dump(x)
     z = load(y)
     assert x == z
-    
-
-
-
-
-
-
-
-
@@ -34,29 +34,71 @@ if not py3k:
 else:
     empty_bytes = bytes()
 
-def send_object(sock, obj):
-    """Send an object over a socket"""
-    s = brine.dump(obj)
-    msg = struct.pack('<l', len(s)) + s
-    sock.sendall(msg)
-
-def recv_object(sock):
-    """Receive an object over a socket"""
-    length_str = empty_bytes
-    while len(length_str) < 4:
-        r = sock.recv(4 - len(length_str))
-        if not r:
-            raise IOError("Socket closed unexpectedly")
-        length_str += r
-    length, = struct.unpack('<i', length_str)
+try:
+    _memoryview = memoryview
+except NameError:
+    # Python 2.6 doesn't have memoryview
+    _memoryview = None
+
+HEADER = struct.Struct('<l')
+
+def _recv_exactly(sock, n):
+    """Receive exactly n bytes from a socket, as a byte string."""
     parts = []
     len_received = 0
-    while len_received < length:
-        r = sock.recv(length - len_received)
+    while len_received < n:
+        r = sock.recv(n - len_received)
         if not r:
             raise IOError("Socket closed unexpectedly")
         parts.append(r)
         len_received += len(r)
-    s = empty_bytes.join(parts)
-    obj = brine.load(s)
-    return obj
+    return empty_bytes.join(parts)
+
+if brine.has_bytearray:
+    # The message is built in one buffer, with room for the header at its
+    # start, and sent with one call. It is received into a buffer of the
+    # right size, which brine loads without copying it.
+    
+    def send_object(sock, obj):
+        """Send an object over a socket"""
+        buf = bytearray(HEADER.size)
+        brine.dump_into(obj, buf)
+        HEADER.pack_into(buf, 0, len(buf) - HEADER.size)
+        sock.sendall(buf)
+    
+    def recv_object(sock):
+        """Receive an object over a socket"""
+        length, = HEADER.unpack(_recv_exactly(sock, HEADER.size))
+        buf = bytearray(length)
+        if _memoryview is not None:
+            view = _memoryview(buf)
+        else:
+            # Python 2.6 can only receive into the start of a buffer, so
+            # the first recv_into gets all the message if it can, and the
+            # rest is copied.
+            view = None
+        len_received = 0
+        while len_received < length:
+            if view is not None:
+                n = sock.recv_into(view[len_received:], length - len_received)
+            elif len_received == 0:
+                n = sock.recv_into(buf, length)
+            else:
+                r = sock.recv(length - len_received)
+                n = len(r)
+                buf[len_received:len_received + n] = r
+            if not n:
+                raise IOError("Socket closed unexpectedly")
+            len_received += n
+        return brine.load(buf)
+
+else:
+    def send_object(sock, obj):
+        """Send an object over a socket"""
+        s = brine.dump(obj)
+        sock.sendall(HEADER.pack(len(s)) + s)
+    
+    def recv_object(sock):
+        """Receive an object over a socket"""
+        length, = HEADER.unpack(_recv_exactly(sock, HEADER.size))
+        return brine.load(_recv_exactly(sock, length))
@@ -16,16 +16,17 @@
 # along with DreamPie.  If not, see <http://www.gnu.org/licenses/>.
 
 # This file is a script (not a module) run by the DreamPie GUI.
-# It expects one argument: the port to connect to.
+# It expects one argument: the port to connect to, or 'fd:<n>' if it inherited
+# a socket connected to the GUI with file descriptor n.
 # It creates a package called dreampielib from subp-py2.zip or subp-py3.zip
 # (which are expected to be in the directory of __file__),
-# and runs dreampielib.subprocess.main(port).
+# and runs dreampielib.subprocess.main(sock_arg).
 import sys
 
 from os.path import abspath, join, dirname
 
 def main():
-    port = int(sys.argv[1])
+    sock_arg = sys.argv[1]
 
     py_ver = sys.version_info[0]
     lib_name = abspath(join(dirname(__file__), 'subp-py%d' % py_ver))
@@ -38,7 +39,7 @@ def main():
         sys.stderr.write("Warning: DreamPie doesn't support Python 3.0. \n"
                          "Please upgrade to Python 3.1.\n")
     
-    subprocess_main(port)
+    subprocess_main(sock_arg)
 
 if __name__ == '__main__':
     main()
@@ -80,28 +80,33 @@ from . import gtkexcepthook
 gtkexcepthook.install(gladefile)
 
 try:
-    from glib import timeout_add, idle_add
+    from glib import timeout_add, idle_add, source_remove
 except ImportError:
     # In PyGObject 2.14, it's in gobject.
-    from gobject import timeout_add, idle_add
+    from gobject import timeout_add, idle_add, source_remove
 
 from .. import __version__
 
 from .SimpleGladeApp import SimpleGladeApp
 from .keyhandler import (make_keyhandler_decorator, handle_keypress,
                          parse_keypress_event)
-from .config import Config
+from .config import Config, get_config_fn
 from .config_dialog import ConfigDialog
 from .write_command import write_command
 from .newline_and_indent import newline_and_indent
-from .output import Output
+from .output import Output, add_breaks
 from .folding import Folding
 from .selection import Selection
 from .status_bar import StatusBar
 from .vadj_to_bottom import VAdjToBottom
+from .scrollback import Scrollback
 from .history import History
+from .hist_db import HistoryDB
+from .autosave import Autosave, find_orphan_journals
+from .session_file import FormatError
 from .hist_persist import HistPersist
 from .autocomplete import Autocomplete
+from .firstlevels import FirstLevels
 from .call_tips import CallTips
 from .autoparen import Autoparen
 from .crash_workaround import TextViewCrashWorkaround
@@ -109,7 +114,8 @@ from .subprocess_handler import SubprocessHandler, StartError
 from .common import beep, get_text, TimeoutError
 from .file_dialogs import save_dialog
 from .tags import (OUTPUT, STDIN, STDOUT, STDERR, EXCEPTION, PROMPT, COMMAND,
-                   COMMAND_DEFS, COMMAND_SEP, MESSAGE, RESULT_IND, RESULT)
+                   COMMAND_DEFS, COMMAND_SEP, MESSAGE, RESULT_IND, RESULT,
+                   RESULT_MORE, STATS)
 from . import tags
 from .update_check import update_check
 from . import bug_report
@@ -126,6 +132,30 @@ AUTOCOMPLETE_WAIT = 400
 # idle jobs, and so not return a result.
 SUBP_WAIT_TIMEOUT_S = .5
 
+# When the memory used by the subprocess grows by this many bytes during one
+# command, tell the user.
+MEMORY_GROWTH_REPORT = 100 * 1024 * 1024
+
+# RPC calls which only query the subprocess. If their result arrives too late,
+# it is kept until the next time the same query is made, or until code is
+# executed.
+QUERY_FUNCS = frozenset([
+    u'is_incomplete', u'is_callable_only', u'complete_dict_keys',
+    u'complete_attributes', u'get_firstlevels', u'get_func_args',
+    u'find_modules', u'get_module_members', u'complete_filenames',
+    u'get_func_doc'])
+
+# Queries whose results change only when the namespace of the subprocess
+# does. Their results are cached until the subprocess executes code.
+NAMESPACE_FUNCS = frozenset([
+    u'complete_attributes', u'get_func_args'])
+
+# Output from the subprocess is collected and written to the text buffer at
+# most once in OUTPUT_FLUSH_INTERVAL milliseconds, so that programs which
+# write a lot of small chunks won't cause a buffer insert (and a relayout) for
+# each of them.
+OUTPUT_FLUSH_INTERVAL = 25
+
 # Maybe someday we'll want translations...
 _ = lambda s: s
 
@@ -164,6 +194,13 @@ class DreamPie(SimpleGladeApp):
         # Mark where the cursor was when the popup menu was popped
         self.popup_mark = tb.create_mark('popup-mark', tb.get_start_iter(),
                                          left_gravity=True)
+        # Marks where more of the last result should be inserted, if it wasn't
+        # sent whole. None if there's no such result.
+        self.more_result_mark = None
+        self.scrollback = Scrollback(self.textview,
+                                     self.scrolledwindow_textview
+                                     .get_vadjustment(),
+                                     self.config.get_int('scrollback-sections'))
 
         # Remove the page in the notebook, which was added because empty
         # notebooks cause warnings
@@ -181,6 +218,10 @@ class DreamPie(SimpleGladeApp):
         self.configure()
 
         self.output = Output(self.textview)
+        # A list of (tag, [data, ...]) pairs of output waiting to be written,
+        # and the id of the timeout which will write it.
+        self.pending_output = []
+        self.flush_output_handle = None
         
         self.folding = Folding(self.textbuffer, LINE_LEN)
 
@@ -194,8 +235,16 @@ class DreamPie(SimpleGladeApp):
         self.vadj_to_bottom = VAdjToBottom(self.scrolledwindow_textview
                                            .get_vadjustment())
 
+        if self.config.get_bool('persistent-history'):
+            try:
+                self.hist_db = HistoryDB(get_config_fn() + '-history')
+            except (IOError, OSError), e:
+                debug("Couldn't open the history database: %s" % e)
+                self.hist_db = None
+        else:
+            self.hist_db = None
         self.history = History(self.textview, self.sourceview, self.sv_changed,
-                               self.config)
+                               self.config, self.scrollback, self.hist_db)
 
         self.recent_manager = gtk.recent_manager_get_default()
         self.menuitem_recent = [self.menuitem_recent0, self.menuitem_recent1,
@@ -204,15 +253,27 @@ class DreamPie(SimpleGladeApp):
         self.recent_manager.connect('changed', self.on_recent_manager_changed)
 
         self.histpersist = HistPersist(self.window_main, self.textview,
-                                       self.status_bar, self.recent_manager)
+                                       self.status_bar, self.recent_manager,
+                                       self.scrollback,
+                                       self.history.on_history_loaded)
         self.update_recent()
+
+        autosave_dir = get_config_fn() + '-autosave'
+        if self.config.get_bool('autosave'):
+            try:
+                self.autosave = Autosave(self.textbuffer, self.scrollback,
+                                         autosave_dir)
+            except (IOError, OSError), e:
+                debug("Couldn't create the autosave directory: %s" % e)
+                self.autosave = None
+        else:
+            self.autosave = None
         
         self.autocomplete = Autocomplete(self.sourceview,
                                          self.sv_changed,
                                          self.window_main,
                                          self.complete_attributes,
                                          self.complete_firstlevels,
-                                         self.get_func_args,
                                          self.find_modules,
                                          self.get_module_members,
                                          self.complete_filenames,
@@ -235,12 +296,23 @@ class DreamPie(SimpleGladeApp):
                                    self.autoparen_show_call_tip,
                                    INDENT_WIDTH)
 
+        # Map names of notifications from the subprocess to the functions
+        # which handle them (see on_subp_notification)
+        self.subp_notify_handlers = {
+            u'memory': self.on_subp_memory,
+            u'matplotlib_ia': self.on_subp_matplotlib_ia,
+            u'generation': self.on_subp_generation,
+            }
+        # Memory used by the subprocess after the last command, in bytes
+        self.subp_memory = None
+        # First-level names of the subprocess, for completion
+        self.firstlevels = FirstLevels()
+
         self.subp = SubprocessHandler(
             pyexec, data_dir,
             self.on_stdout_recv, self.on_stderr_recv, self.on_object_recv,
             self.on_subp_terminated)
-        # Number of RPC calls that timed out and expecting results
-        self._n_unclaimed_results = 0
+        self._reset_subp_calls()
         try:
             self.subp.start()
         except StartError, e:
@@ -274,6 +346,35 @@ class DreamPie(SimpleGladeApp):
         
         update_check(self.on_update_available)
         
+        self.recover_autosaved(autosave_dir)
+        
+    def recover_autosaved(self, autosave_dir):
+        """
+        Look for journals left by DreamPie processes which didn't quit
+        normally, and offer to recover them.
+        """
+        for fn in find_orphan_journals(autosave_dir):
+            d = gtk.MessageDialog(
+                parent=self.window_main,
+                flags=gtk.DIALOG_MODAL | gtk.DIALOG_DESTROY_WITH_PARENT,
+                type=gtk.MESSAGE_QUESTION,
+                buttons=gtk.BUTTONS_YES_NO,
+                message_format=_('Recover history?'))
+            d.props.secondary_text = _(
+                "DreamPie didn't quit normally. "
+                "Do you want to recover the history from the last session?")
+            d.set_default_response(gtk.RESPONSE_YES)
+            r = d.run()
+            d.destroy()
+            try:
+                if r == gtk.RESPONSE_YES:
+                    self.histpersist.load_filename(fn, is_recovery=True)
+                    self.histpersist.finish_loading()
+                os.remove(fn)
+            except (IOError, OSError, FormatError), e:
+                self.status_bar.set_status(
+                    _('Error when recovering history: %s') % e)
+
     def on_sv_changed(self, new_sv):
         self.sourceview.disconnect(self.sourceview_keypress_handler)
         self.sourceview = new_sv
@@ -371,6 +472,8 @@ class DreamPie(SimpleGladeApp):
         flags = gtk.TEXT_SEARCH_VISIBLE_ONLY
         if is_upward:
             match = it.backward_search(search_str, flags)
+            if match is None:
+                match = self.scrollback.search_backward(search_str, flags)
             if match is None:
                 match = tb.get_end_iter().backward_search(search_str, flags)
         else:
@@ -490,6 +593,7 @@ class DreamPie(SimpleGladeApp):
             return True
     
     def write(self, data, *tag_names):
+        self.flush_output()
         self.textbuffer.insert_with_tags_by_name(
             self.textbuffer.get_end_iter(), data, *tag_names)
 
@@ -497,10 +601,52 @@ class DreamPie(SimpleGladeApp):
         """
         Call self.output.write with the given arguments, and autofold if needed.
         """
+        self.flush_output()
         it = self.output.write(data, tag_names, onnewline, addbreaks)
-        if self.config.get_bool('autofold'):
+        self.autofold(it)
+    
+    def autofold(self, it):
+        if it is not None and self.config.get_bool('autofold'):
             self.folding.autofold(it, self.config.get_int('autofold-numlines'))
     
+    def queue_output(self, data, tag):
+        """
+        Queue subprocess output to be written by flush_output. Consecutive
+        chunks with the same tag will be written together.
+        """
+        pending = self.pending_output
+        if pending and pending[-1][0] == tag:
+            pending[-1][1].append(data)
+        else:
+            pending.append((tag, [data]))
+        if self.flush_output_handle is None:
+            self.flush_output_handle = timeout_add(OUTPUT_FLUSH_INTERVAL,
+                                                   self.on_flush_output_timeout)
+    
+    def on_flush_output_timeout(self):
+        self.flush_output_handle = None
+        self.flush_output()
+        return False
+    
+    def flush_output(self):
+        """
+        Write queued output to the text buffer, and autofold once. This is
+        called before anything else is written, so that the order is kept.
+        """
+        if self.flush_output_handle is not None:
+            source_remove(self.flush_output_handle)
+            self.flush_output_handle = None
+        if not self.pending_output:
+            return
+        pending = self.pending_output
+        self.pending_output = []
+        last_it = None
+        for tag, parts in pending:
+            it = self.output.write(u''.join(parts), tag)
+            if it is not None:
+                last_it = it
+        self.autofold(last_it)
+    
     def set_is_executing(self, is_executing):
         self.is_executing = is_executing
         label = _(u'Execute Code') if not is_executing else _(u'Write Input')
@@ -514,8 +660,9 @@ class DreamPie(SimpleGladeApp):
         # quotes.
         return source.replace(u'\xa8', '"').replace(u'\xb4', "'")
     
-    def execute_source(self):
+    def execute_source(self, is_sampled=False):
         """Execute the source in the source buffer.
+        If is_sampled, the subprocess will report which lines took the time.
         """
         sb = self.sourcebuffer
         source = get_text(sb, sb.get_start_iter(), sb.get_end_iter())
@@ -530,14 +677,14 @@ class DreamPie(SimpleGladeApp):
             # If we don't get a reply for pause_idle, we don't execute.
             self.call_subp_noblock(u'pause_idle')
         except TimeoutError:
-            self.subp.send_object((u'resume_idle', ()))
-            self._n_unclaimed_results += 1
+            req_id = self.send_subp_call(u'resume_idle')
+            self.forget_subp_call(req_id, u'resume_idle', ())
 
             self.status_bar.set_status(_("The subprocess is currently busy"))
             beep()
             return
             
-        is_ok, syntax_error_info = self.call_subp(u'execute', source)
+        is_ok, syntax_error_info = self.call_subp_execute(source, is_sampled)
         if not is_ok:
             if syntax_error_info:
                 msg, lineno, offset = syntax_error_info
@@ -558,6 +705,8 @@ class DreamPie(SimpleGladeApp):
             self.set_is_executing(True)
             write_command(self.write, source.strip())
             self.output.start_new_section()
+            self.history.add_last_command(persist=True)
+            self.scrollback.on_section_added()
             if not self.config.get_bool('leave-code'):
                 sb.delete(sb.get_start_iter(), sb.get_end_iter())
             self.vadj_to_bottom.scroll_to_bottom()
@@ -572,6 +721,8 @@ class DreamPie(SimpleGladeApp):
         self.write_output(s, [COMMAND, STDIN], addbreaks=False)
         self.write('\r', COMMAND_SEP)
         self.output.start_new_section()
+        self.history.add_last_command()
+        self.scrollback.on_section_added()
         self.vadj_to_bottom.scroll_to_bottom()
 
         if not self.config.get_bool('leave-code'):
@@ -781,13 +932,18 @@ class DreamPie(SimpleGladeApp):
         return self.autoparen.add_parens()
 
     def is_callable_only(self, expr):
-        return self.call_subp_catch(u'is_callable_only', expr)
+        """
+        Return (is_callable_only(expr), get_func_doc(expr)), with one call, so
+        that the call tip can be shown immediately if parens are added.
+        """
+        return self.call_subp_batch([(u'is_callable_only', (expr,)),
+                                     (u'get_func_doc', (expr,))])
     
     def get_expects_str(self):
         return set(self.config.get('expects-str-2').split())
     
-    def autoparen_show_call_tip(self):
-        self.call_tips.show(is_auto=True)
+    def autoparen_show_call_tip(self, expr, func_doc):
+        self.call_tips.show(is_auto=True, known_doc=(expr, func_doc))
 
 
     # History
@@ -817,14 +973,27 @@ class DreamPie(SimpleGladeApp):
             reshist_size = config.get_int('reshist-size')
         else:
             reshist_size = 0
-        self.call_subp(u'set_reshist_size', reshist_size)
         self.menuitem_clear_reshist.props.sensitive = (reshist_size > 0)
         
-        self.call_subp(u'set_pprint', config.get_bool('pprint'))
+        if config.get_bool('repr-limits'):
+            repr_limits = (config.get_int('repr-max-depth'),
+                           config.get_int('repr-max-items'),
+                           config.get_int('repr-max-chars'),
+                           config.get_int('repr-max-seconds'))
+        else:
+            repr_limits = None
         
-        self.call_subp(u'set_matplotlib_ia',
-                       config.get_bool('matplotlib-ia-switch'),
-                       config.get_bool('matplotlib-ia-warn'))
+        self.call_subp_many([
+            (u'set_reshist_size', (reshist_size,)),
+            (u'set_pprint', (config.get_bool('pprint'),)),
+            (u'set_repr_limits', (repr_limits,)),
+            (u'set_command_stats', (config.get_bool('show-command-stats'),
+                                    config.get_int('profile-top'))),
+            (u'set_matplotlib_ia', (config.get_bool('matplotlib-ia-switch'),
+                                    config.get_bool('matplotlib-ia-warn'))),
+            (u'set_parse_files', (config.get_bool('parse-files'),)),
+            (u'start_module_index', (get_config_fn() + '-modules',)),
+            ])
         
     def run_init_code(self, runfile=None):
         """
@@ -841,7 +1010,7 @@ class DreamPie(SimpleGladeApp):
             init_code += ('\n\nprint(%r)\nexec(open(%r).read())\n'
                           % (msg, runfile))
         if init_code:
-            is_ok, syntax_error_info = self.call_subp(u'execute', init_code)
+            is_ok, syntax_error_info = self.call_subp_execute(init_code)
             if not is_ok:
                 msg, lineno, offset = syntax_error_info
                 warning = _(
@@ -863,7 +1032,10 @@ class DreamPie(SimpleGladeApp):
             return
         # This may raise an exception if subprocess couldn't be started,
         # but hopefully if it was started once it will be started again.
-        self._n_unclaimed_results = 0
+        self._reset_subp_calls()
+        self.forget_more_result()
+        self.subp_memory = None
+        self.firstlevels = FirstLevels()
         self.subp.start()
         self.set_is_executing(False)
         self.write('\n')
@@ -880,46 +1052,133 @@ class DreamPie(SimpleGladeApp):
         self.subp.kill()
 
     def on_stdout_recv(self, data):
-        self.write_output(data, STDOUT)
+        self.queue_output(data, STDOUT)
 
     def on_stderr_recv(self, data):
-        self.write_output(data, STDERR)
+        self.queue_output(data, STDERR)
+
+    def _reset_subp_calls(self):
+        """Forget about the calls made to the subprocess."""
+        self._next_req_id = 0
+        # Maps request ids to the replies which were received while waiting
+        # for the reply of another request.
+        self._replies = {}
+        # Maps request ids to (funcname, args) of calls whose reply nobody
+        # waits for anymore.
+        self._unclaimed_calls = {}
+        # Maps (funcname, args) to results of queries which came too late,
+        # so that they can be used if the same query is made again.
+        self._late_results = {}
+        # The namespace generation of the subprocess, which it bumps whenever
+        # it executes code, and a map from (funcname, args) to the results of
+        # NAMESPACE_FUNCS calls made in that generation.
+        self._subp_generation = 0
+        self._namespace_cache = {}
+        # The request id of the running execute call, whose second reply is
+        # the result of the execution.
+        self._execute_req_id = None
+
+    def send_subp_call(self, funcname, *args):
+        """
+        Send an RPC call without waiting for the reply. Return the request
+        id, to be passed to wait_subp_reply.
+        """
+        req_id = self._next_req_id
+        self._next_req_id += 1
+        self.subp.send_object((req_id, funcname, args))
+        return req_id
+
+    def wait_subp_reply(self, req_id, timeout_s=None):
+        """
+        Wait for the reply to the call with the given request id, and return
+        it. If timeout_s is not None and the reply doesn't arrive within
+        timeout_s seconds, raise a TimeoutError. In that case, you should
+        call forget_subp_call.
+        """
+        if timeout_s is not None:
+            end_time = time.time() + timeout_s
+        while req_id not in self._replies:
+            if timeout_s is not None:
+                timeout_s = max(end_time - time.time(), 0)
+            if not self.subp.wait_for_object(timeout_s):
+                raise TimeoutError
+            self.on_object_recv(self.subp.recv_object())
+        return self._replies.pop(req_id)
+
+    def forget_subp_call(self, req_id, funcname, args):
+        """
+        Stop waiting for the reply to a call. When the reply arrives, it
+        will be kept if the call is a query.
+        """
+        try:
+            self._replies.pop(req_id)
+        except KeyError:
+            self._unclaimed_calls[req_id] = (funcname, args)
 
     def call_subp(self, funcname, *args):
         """
         Make an RPC call, blocking until an answer is received.
         """
         assert not self.is_executing
-        
-        while self._n_unclaimed_results:
-            self.subp.recv_object()
-            
-        self.subp.send_object((funcname, args))
-        return self.subp.recv_object()
+        return self.wait_subp_reply(self.send_subp_call(funcname, *args))
+
+    def call_subp_many(self, calls):
+        """
+        Make a few RPC calls, given as a list of (funcname, args) pairs, in
+        one round trip. Block until all answers are received, and return a
+        list of them.
+        """
+        assert not self.is_executing
+        req_ids = [self.send_subp_call(funcname, *args)
+                   for funcname, args in calls]
+        return [self.wait_subp_reply(req_id) for req_id in req_ids]
+
+    def call_subp_execute(self, source, is_sampled=False):
+        """
+        Send source to the subprocess to be executed, with a Sampler if
+        is_sampled.
+        Return (is_ok, syntax_error_info) like the execute RPC call. If is_ok,
+        the result of the execution will be handled when it arrives.
+        """
+        assert not self.is_executing
+        # Results of queries may change when code is executed.
+        self._late_results.clear()
+        self._namespace_cache.clear()
+        # The subprocess discards the rest of the last result
+        self.forget_more_result()
+        req_id = self.send_subp_call(u'execute', source, is_sampled)
+        is_ok, syntax_error_info = self.wait_subp_reply(req_id)
+        if is_ok:
+            self._execute_req_id = req_id
+        return is_ok, syntax_error_info
 
     def call_subp_noblock(self, funcname, *args):
         """
         Make a non-blocking RPC call.
         Will wait for SUBP_WAIT_TIMEOUT_S and if no answer is received will
         raise a TimeoutError. The query will be executed when the subprocess
-        becomes responsive again, but will be discarded.
+        becomes responsive again, and its result will be kept, so that the
+        same call will return it immediately.
+        Results of NAMESPACE_FUNCS are returned from the cache, if the
+        namespace wasn't changed since the same call was made.
         """
         assert not self.is_executing
         
-        while self._n_unclaimed_results:
-            returned = self.subp.wait_for_object(SUBP_WAIT_TIMEOUT_S)
-            if returned:
-                self.subp.recv_object()
-            else:
-                raise TimeoutError
-            
-        self.subp.send_object((funcname, args))
-        returned = self.subp.wait_for_object(SUBP_WAIT_TIMEOUT_S)
-        if returned:
-            return self.subp.recv_object()
+        key = (funcname, args)
+        if key in self._namespace_cache:
+            return self._namespace_cache[key]
+        if funcname in QUERY_FUNCS and key in self._late_results:
+            r = self._late_results.pop(key)
         else:
-            self._n_unclaimed_results += 1
-            raise TimeoutError
+            req_id = self.send_subp_call(funcname, *args)
+            try:
+                r = self.wait_subp_reply(req_id, SUBP_WAIT_TIMEOUT_S)
+            except TimeoutError:
+                self.forget_subp_call(req_id, funcname, args)
+                raise
+        if funcname in NAMESPACE_FUNCS:
+            self._namespace_cache[key] = r
+        return r
 
     def call_subp_catch(self, funcname, *args):
         """
@@ -934,14 +1193,91 @@ class DreamPie(SimpleGladeApp):
         except TimeoutError:
             return None
     
+    def call_subp_batch(self, calls):
+        """
+        Make a few query calls, given as (funcname, args) pairs, with one
+        non-blocking batch RPC call. Return a list of their results, with None
+        for the calls which couldn't be made since the subprocess is executing
+        or busy.
+        """
+        results = [None] * len(calls)
+        if self.is_executing:
+            return results
+        missing = []
+        for i, call in enumerate(calls):
+            if call in self._namespace_cache:
+                results[i] = self._namespace_cache[call]
+            elif call in self._late_results:
+                results[i] = self._late_results.pop(call)
+            else:
+                missing.append(i)
+        if missing:
+            try:
+                r = self.call_subp_noblock(
+                    u'batch', tuple(calls[i] for i in missing))
+            except TimeoutError:
+                return results
+            for i, result in zip(missing, r):
+                results[i] = result
+        for call, result in zip(calls, results):
+            if call[0] in NAMESPACE_FUNCS:
+                self._namespace_cache[call] = result
+        return results
+    
     def on_object_recv(self, obj):
-        if self._n_unclaimed_results:
-            self._n_unclaimed_results -= 1
-            return
-        
+        req_id, r = obj
+        if req_id is None:
+            name, value = r
+            self.on_subp_notification(name, value)
+        elif req_id in self._unclaimed_calls:
+            funcname, args = self._unclaimed_calls.pop(req_id)
+            if funcname in QUERY_FUNCS:
+                self._late_results[funcname, args] = r
+            elif funcname == u'batch' and r is not None:
+                for call, result in zip(args[0], r):
+                    if call[0] in QUERY_FUNCS:
+                        self._late_results[call] = result
+        elif req_id == self._execute_req_id:
+            self._execute_req_id = None
+            self.on_execute_result(r)
+        else:
+            self._replies[req_id] = r
+
+    def on_subp_notification(self, name, value):
+        """
+        Handle a notification which the subprocess sent on its own, and not
+        as a reply to a request.
+        """
+        # Notifications which nobody handles are ignored, so that a newer
+        # subprocess can send new ones.
+        handler = self.subp_notify_handlers.get(name)
+        if handler is not None:
+            handler(value)
+
+    def on_subp_memory(self, memory):
+        if (memory is not None and self.subp_memory is not None
+            and memory - self.subp_memory >= MEMORY_GROWTH_REPORT):
+            self.status_bar.set_status(
+                _("The subprocess now uses %d MB of memory")
+                % (memory // (1024 * 1024)))
+        self.subp_memory = memory
+
+    def on_subp_generation(self, generation):
+        if generation != self._subp_generation:
+            self._subp_generation = generation
+            self._namespace_cache.clear()
+
+    def on_subp_matplotlib_ia(self, _is_interactive):
+        self.status_bar.set_status(
+            _("matplotlib was switched to interactive mode"))
+
+    def on_execute_result(self, obj):
         assert self.is_executing
 
-        is_success, val_no, val_str, exception_string, rem_stdin = obj
+        (is_success, val_no, val_str, val_has_more, exception_string,
+         rem_stdin, stats, samples_str, names_delta) = obj
+
+        self.firstlevels.update(names_delta)
 
         if not is_success:
             self.write_output(exception_string, EXCEPTION, onnewline=True)
@@ -952,10 +1288,95 @@ class DreamPie(SimpleGladeApp):
                     self.write_output('%d:%s' % (val_no, sep), RESULT_IND,
                                       onnewline=True)
                 self.write_output(val_str+'\n', RESULT)
+                if val_has_more:
+                    self.add_more_result_line()
+        if stats is not None:
+            self.write_command_stats(stats)
+        if samples_str is not None:
+            self.write_samples(samples_str)
         self.write('>>> ', COMMAND, PROMPT)
         self.set_is_executing(False)
         self.handle_rem_stdin(rem_stdin)
 
+    def write_command_stats(self, stats):
+        """Write the stats of a command, as sent by the subprocess."""
+        wall_time, cpu_time, peak_memory_growth, profile_str = stats
+        parts = [_('Wall time: %.3f s') % wall_time]
+        if cpu_time is not None:
+            parts.append(_('CPU time: %.3f s') % cpu_time)
+        if peak_memory_growth is not None:
+            parts.append(_('Peak memory growth: %.1f MB')
+                         % (peak_memory_growth / (1024. * 1024)))
+        msg = '[%s]\n' % ', '.join(parts)
+        if profile_str is not None:
+            msg += profile_str + '\n'
+        self.write_output(msg, STATS, onnewline=True)
+
+    def write_samples(self, samples_str):
+        """
+        Write the report of the sampler in the output of the command, like
+        its stats. A long report is folded with the rest of the output.
+        """
+        self.write_output(samples_str, STATS, onnewline=True)
+
+    def add_more_result_line(self):
+        """
+        Add a line after a result which wasn't sent whole, which can be
+        double-clicked to show more of it.
+        """
+        tb = self.textbuffer
+        it = tb.get_iter_at_mark(self.output.mark)
+        # Just before the newline which ends the result
+        it.backward_char()
+        self.more_result_mark = tb.create_mark(None, it, left_gravity=False)
+        self.write_output(_('[Double-click to show more of the result]\n'),
+                          RESULT_MORE)
+
+    def forget_more_result(self):
+        """
+        Called when the rest of the last result can't be retrieved any more.
+        """
+        if self.more_result_mark is not None:
+            self.textbuffer.delete_mark(self.more_result_mark)
+            self.more_result_mark = None
+
+    def show_more_result(self, it):
+        """
+        Get an iterator in a RESULT_MORE line. Insert the next chunk of the
+        result before it.
+        """
+        tb = self.textbuffer
+        more_result = tb.get_tag_table().lookup(RESULT_MORE)
+        line_start = it.copy()
+        if not line_start.begins_tag(more_result):
+            line_start.backward_to_tag_toggle(more_result)
+        if self.more_result_mark is not None:
+            mark_it = tb.get_iter_at_mark(self.more_result_mark)
+            mark_it.forward_char()
+            is_last_result = mark_it.equal(line_start)
+        else:
+            is_last_result = False
+        if not is_last_result or self.is_executing:
+            self.status_bar.set_status(
+                _("The rest of this result is no longer available"))
+            beep()
+            return
+        r = self.call_subp(u'get_more_result')
+        if r is None:
+            chunk, has_more = u'', False
+        else:
+            chunk, has_more = r
+        it = tb.get_iter_at_mark(self.more_result_mark)
+        tb.insert_with_tags_by_name(it, add_breaks(chunk, it.get_line_offset()),
+                                    OUTPUT, RESULT)
+        if not has_more:
+            line_start = tb.get_iter_at_mark(self.more_result_mark)
+            line_start.forward_char()
+            line_end = line_start.copy()
+            line_end.forward_to_tag_toggle(more_result)
+            tb.delete(line_start, line_end)
+            self.forget_more_result()
+
     def handle_rem_stdin(self, rem_stdin):
         """
         Add the stdin text that was not processed to the source buffer.
@@ -973,6 +1394,8 @@ class DreamPie(SimpleGladeApp):
         it = tb.get_end_iter()
         if not it.ends_tag(stdin):
             it.backward_to_tag_toggle(stdin)
+        # Where the text was changed, if it was
+        changed_offset = None
         while True:
             it2 = it.copy()
             it2.backward_to_tag_toggle(stdin)
@@ -984,6 +1407,7 @@ class DreamPie(SimpleGladeApp):
                 break
             it2.forward_chars(len(cur_stdin)-min_len)
             tb.delete(it2, it)
+            changed_offset = it2.get_offset()
             rem_stdin = rem_stdin[:-min_len]
             if not rem_stdin:
                 break
@@ -993,6 +1417,8 @@ class DreamPie(SimpleGladeApp):
                 # stdin region.
                 it2.backward_to_tag_toggle(stdin)
                 assert it2.ends_tag(stdin)
+        if changed_offset is not None:
+            self.history.on_end_changed(tb.get_iter_at_offset(changed_offset))
 
     def on_execute_command(self, _widget):
         if self.is_executing:
@@ -1003,6 +1429,13 @@ class DreamPie(SimpleGladeApp):
             self.execute_source()
         return True
 
+    def on_execute_sampled(self, _widget):
+        if self.is_executing or self.sourcebuffer.get_char_count() == 0:
+            beep()
+        else:
+            self.execute_source(is_sampled=True)
+        return True
+
     def on_interrupt(self, _widget):
         if self.subp_can_mask_sigint or self.is_executing:
             self.subp.interrupt()
@@ -1014,9 +1447,11 @@ class DreamPie(SimpleGladeApp):
     # History persistence
     
     def on_save_history(self, _widget):
+        self.flush_output()
         self.histpersist.save()
     
     def on_save_history_as(self, _widget):
+        self.flush_output()
         self.histpersist.save_as()
     
     def on_load_history(self, _widget):
@@ -1062,12 +1497,20 @@ class DreamPie(SimpleGladeApp):
         all history, and if tag == MESSAGE, this discards previous sessions.
         """
         tb = self.textbuffer
+        # Saving may still read sections which are paged out
+        self.histpersist.finish_saving()
         
         tag = tb.get_tag_table().lookup(tag)
-        it = tb.get_end_iter()
-        it.backward_to_tag_toggle(tag)
-        if not it.begins_tag(tag):
+        while True:
+            it = tb.get_end_iter()
             it.backward_to_tag_toggle(tag)
+            if not it.begins_tag(tag):
+                it.backward_to_tag_toggle(tag)
+            # If the tag isn't found, it may be in the sections stored on disk
+            if it.begins_tag(tag) or not self.scrollback.load_page():
+                break
+        self.scrollback.forget_before(it)
+        self.history.on_history_discarded(it)
         tb.delete(tb.get_start_iter(), it)
 
     def on_discard_history(self, _widget):
@@ -1180,6 +1623,13 @@ class DreamPie(SimpleGladeApp):
         x, y = tv.window_to_buffer_coords(gtk.TEXT_WINDOW_TEXT,
                                           int(event.x), int(event.y))
         it = tv.get_iter_at_location(x, y)
+        if self.scrollback.is_placeholder(it):
+            self.scrollback.load_page_keep_view()
+            return True
+        more_result = self.textbuffer.get_tag_table().lookup(RESULT_MORE)
+        if it.has_tag(more_result):
+            self.show_more_result(it)
+            return True
         r = self.folding.get_section_status(it)
         if r is not None:
             typ, is_folded, start_it = r
@@ -1272,11 +1722,24 @@ class DreamPie(SimpleGladeApp):
     def complete_attributes(self, expr):
         return self.call_subp_catch(u'complete_attributes', expr)
 
-    def complete_firstlevels(self):
-        return self.call_subp_catch(u'complete_firstlevels')
-    
-    def get_func_args(self, expr):
-        return self.call_subp_catch(u'get_func_args', expr)
+    def complete_firstlevels(self, prefix, func_expr):
+        """
+        Return ((public, private), func_args), where (public, private) are
+        the first-level names which start with prefix, and func_args are the
+        argument names of the function func_expr, if it isn't None.
+        The names are loaded from the subprocess once, and then kept up to
+        date with the changes it sends after every command.
+        """
+        if not self.firstlevels.is_loaded:
+            r = self.call_subp_catch(u'get_firstlevels')
+            if r is None:
+                return None, None
+            self.firstlevels.load(*r)
+        if func_expr is not None:
+            func_args = self.call_subp_catch(u'get_func_args', func_expr)
+        else:
+            func_args = None
+        return self.firstlevels.complete(prefix), func_args
     
     def find_modules(self, expr):
         return self.call_subp_catch(u'find_modules', expr)
@@ -1338,6 +1801,8 @@ class DreamPie(SimpleGladeApp):
         
         command_defs = self.textbuffer.get_tag_table().lookup(COMMAND_DEFS)
         command_defs.props.invisible = config.get_bool('hide-defs')
+        
+        self.scrollback.max_sections = config.get_int('scrollback-sections')
 
     def configure_sourceview(self, sv):
         """
@@ -1375,6 +1840,8 @@ class DreamPie(SimpleGladeApp):
         self.quit()
 
     def quit(self):
+        self.flush_output()
+        self.histpersist.finish_saving()
         was_saved = self.histpersist.was_saved()
         if (self.textbuffer.get_modified()
             and (was_saved or self.config.get_bool('ask-on-quit'))):
@@ -1404,7 +1871,7 @@ class DreamPie(SimpleGladeApp):
                 self.config.set_bool('ask-on-quit', False)
                 self.config.save()
             if r == SAVE:
-                saved = self.histpersist.save()
+                saved = self.histpersist.save(wait=True)
                 quit = saved
             elif r == DISCARD:
                 quit = True
@@ -1415,6 +1882,10 @@ class DreamPie(SimpleGladeApp):
             quit = True
         if quit:
             self.is_terminating = True
+            if self.hist_db is not None:
+                self.hist_db.close()
+            if self.autosave is not None:
+                self.autosave.close()
             self.window_main.destroy()
             self.subp.kill()
             gtk.main_quit()
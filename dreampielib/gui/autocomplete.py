@@ -30,7 +30,7 @@ ID_CHARS_DOT = ID_CHARS + '.'
 
 class Autocomplete(object):
     def __init__(self, sourceview, sv_changed, window_main,
-                 complete_attributes, complete_firstlevels, get_func_args,
+                 complete_attributes, complete_firstlevels,
                  find_modules, get_module_members, complete_filenames,
                  complete_dict_keys,
                  INDENT_WIDTH):
@@ -38,7 +38,6 @@ class Autocomplete(object):
         sv_changed.append(self._on_sv_changed)
         self.complete_attributes = complete_attributes
         self.complete_firstlevels = complete_firstlevels
-        self.get_func_args = get_func_args
         self.find_modules = find_modules
         self.get_module_members = get_module_members
         self.complete_filenames = complete_filenames
@@ -195,13 +194,9 @@ class Autocomplete(object):
                 return
             public, private = public_and_private
         else:
-            public_and_private = self.complete_firstlevels()
-            if public_and_private is None: # The subprocess is busy
-                return
-            public, private = public_and_private
-            
             # If we are inside a function call after a ',' or '(',
-            # get argument names.
+            # get argument names too.
+            func_expr = None
             if text[:i].rstrip()[-1:] in (',', '('):
                 opener, _closer = hp.get_surrounding_brackets('(')
                 if opener:
@@ -209,10 +204,16 @@ class Autocomplete(object):
                     expr = hp.get_expression()
                     if expr and '(' not in expr:
                         # Don't need to execute a function just to get arguments
-                        args = self.get_func_args(expr)
-                        if args is not None:
-                            public.extend(args)
-                            public.sort()
+                        func_expr = expr
+            
+            public_and_private, args = self.complete_firstlevels(comp_prefix,
+                                                                 func_expr)
+            if public_and_private is None: # The subprocess is busy
+                return
+            public, private = public_and_private
+            if args is not None:
+                public.extend(args)
+                public.sort()
         
         is_case_insen = False
         return comp_prefix, public, private, is_case_insen
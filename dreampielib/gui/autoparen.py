@@ -123,7 +123,7 @@ class Autoparen(object):
             # Don't evaluate expressions which may contain a function call.
             return False
         
-        r = self.is_callable_only(expr)
+        r, func_doc = self.is_callable_only(expr)
         if r is None:
             return False
         is_callable_only, expects_str = r
@@ -149,7 +149,7 @@ class Autoparen(object):
             self.insert_handler = sb.connect('insert-text', self.on_insert_text)
             self.delete_handler = sb.connect('delete-range', self.on_delete_range)
 
-        self.show_call_tip()
+        self.show_call_tip(expr, func_doc)
         
         return True
     
@@ -0,0 +1,570 @@
+# Copyright 2012 Noam Yorav-Raphael
+#
+# This file is part of DreamPie.
+# 
+# DreamPie is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# DreamPie is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with DreamPie.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Keep a journal of the history on disk, so that it can be recovered if
+DreamPie crashes.
+"""
+
+__all__ = ['Autosave', 'find_orphan_journals']
+
+import sys
+import os
+import errno
+import threading
+from logging import debug
+
+try:
+    from glib import idle_add, PRIORITY_LOW
+except ImportError:
+    # In PyGObject 2.14, it's in gobject.
+    from gobject import idle_add, PRIORITY_LOW
+
+from .tags import COMMAND
+from .tag_runs import get_tag_runs
+from .session_file import (SESSION_EXT, MAGIC, FormatError, iter_sections,
+                           pack_section, pack_replace, SessionReader)
+from .hist_persist import iter_history_runs
+
+# The journal is a session file without an index, in the autosave
+# directory, named after the process id. Sections are appended to it when
+# they are complete - that is, when the next command starts. If text which
+# was already written to the journal is changed (for example, when a section
+# is folded, or when history is discarded), a replace record is appended with
+# the new version of the sections around the change. They are found by
+# counting the sections from the change to the nearest end of the journal,
+# not counting across the scrollback placeholder, since the paged out
+# sections aren't in the text buffer. When replace records take up much of
+# the journal, a background thread compacts it - it reads the journal and
+# writes the resulting sections.
+# When DreamPie quits normally, the journal is removed, so a journal of a
+# process which doesn't run anymore means that DreamPie crashed.
+
+# The journal is compacted when replace records take more than half of it,
+# and at least this number of bytes.
+COMPACT_MIN_SIZE = 256 * 1024
+
+def _is_pid_alive(pid):
+    if sys.platform == 'win32':
+        import ctypes
+        PROCESS_QUERY_INFORMATION = 0x0400
+        handle = ctypes.windll.kernel32.OpenProcess(
+            PROCESS_QUERY_INFORMATION, False, pid)
+        if not handle:
+            return False
+        ctypes.windll.kernel32.CloseHandle(handle)
+        return True
+    else:
+        try:
+            os.kill(pid, 0)
+        except OSError, e:
+            return e.errno == errno.EPERM
+        else:
+            return True
+
+def find_orphan_journals(dirname):
+    """
+    Return a list of the journals in dirname which belong to processes which
+    don't run anymore, oldest first.
+    """
+    try:
+        names = os.listdir(dirname)
+    except OSError:
+        return []
+    r = []
+    for name in names:
+        base, ext = os.path.splitext(name)
+        if ext != '.' + SESSION_EXT or not base.isdigit():
+            continue
+        if int(base) == os.getpid() or _is_pid_alive(int(base)):
+            continue
+        fn = os.path.join(dirname, name)
+        r.append((os.path.getmtime(fn), fn))
+    r.sort()
+    return [journal_fn for _mtime, journal_fn in r]
+
+def _write_journal(filename, chunks):
+    """Write a journal to filename+'.tmp'. Runs in a thread."""
+    f = open(filename + '.tmp', 'wb')
+    try:
+        for chunk in chunks:
+            f.write(chunk)
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+
+def _iter_journal_chunks(sections):
+    yield MAGIC
+    for section in sections:
+        yield pack_section(section)
+
+def _compact_journal(filename, size):
+    """
+    Write the sections of the first size bytes of the journal, without
+    replace records, to filename+'.tmp'. Runs in a thread.
+    """
+    f = open(filename, 'rb')
+    try:
+        sections = SessionReader(f, size).read_sections()
+    finally:
+        f.close()
+    _write_journal(filename, _iter_journal_chunks(sections))
+
+class Autosave(object):
+    """
+    Append completed sections, and changes to sections which were already
+    written, to a journal file from a low-priority idle callback.
+    """
+    def __init__(self, textbuffer, scrollback, dirname):
+        self.textbuffer = tb = textbuffer
+        self.scrollback = scrollback
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self.filename = os.path.join(dirname,
+                                     '%d.%s' % (os.getpid(), SESSION_EXT))
+        self.file = None
+        # The size of the journal, and an estimate of how much of it was
+        # replaced.
+        self.size = 0
+        self.garbage = 0
+        # Set if writing failed. We then stop, and leave what was written.
+        self.is_disabled = False
+
+        self.command_tag = tb.get_tag_table().lookup(COMMAND)
+        # Everything before the mark was written to the journal
+        self.mark = tb.create_mark('autosave', tb.get_start_iter(),
+                                   left_gravity=True)
+        # Sections before the mark which were changed and not written yet:
+        # None, or [from_end, start_mark, end_mark, n, n_old], as in the
+        # replace record which will be written.
+        self.dirty = None
+        # Set when the scrollback inserts text exactly at the mark. Since that
+        # text was already written, the mark is moved after it.
+        self.is_paging_at_mark = False
+        self.is_scheduled = False
+        # The thread which compacts the journal, when it runs.
+        self.thread = None
+
+        tb.connect('changed', self._on_changed)
+        tb.connect('insert-text', self._on_insert_text)
+        tb.connect_after('insert-text', self._on_after_insert_text)
+        tb.connect('delete-range', self._on_range_changed)
+        tb.connect('apply-tag', self._on_tag_changed)
+        tb.connect('remove-tag', self._on_tag_changed)
+        # Write everything before the scrollback changes the text buffer, so
+        # that text it inserts at the mark is known to be written, and so
+        # that changed sections aren't paged out.
+        scrollback.before_paging.append(self.flush)
+        scrollback.paged_out.append(self._on_paged_out)
+        scrollback.paged_in.append(self._on_paged_in)
+
+    def _get_placeholder(self):
+        """
+        Return iterators (start, end) around the scrollback placeholder, or
+        None if there isn't one.
+        """
+        start = self.scrollback.get_placeholder_start()
+        end = self.textbuffer.get_iter_at_mark(self.scrollback.mark)
+        if start.equal(end):
+            return None
+        return start, end
+
+    def _section_start_before(self, it, lower):
+        """
+        Return an iterator at the beginning of the last section which starts
+        before it, but not before lower.
+        """
+        command = self.command_tag
+        it = it.copy()
+        while it.compare(lower) > 0:
+            it.backward_to_tag_toggle(command)
+            if it.begins_tag(command) or it.is_start():
+                break
+        if it.compare(lower) < 0:
+            it = lower.copy()
+        return it
+
+    def _section_start_after(self, it, upper):
+        """
+        Return an iterator at the beginning of the first section which starts
+        after it, but not after upper.
+        """
+        command = self.command_tag
+        it = it.copy()
+        while it.compare(upper) < 0:
+            it.forward_to_tag_toggle(command)
+            if it.begins_tag(command) or it.is_end():
+                break
+        if it.compare(upper) > 0:
+            it = upper.copy()
+        return it
+
+    def _count_sections(self, start, end):
+        """
+        Return the number of sections in the journal which start in
+        [start, end). start should be at the beginning of a section - at a
+        command, at the beginning of the buffer or after the scrollback
+        placeholder - and the range shouldn't include the placeholder.
+        """
+        command = self.command_tag
+        n = 0
+        it = start.copy()
+        if it.compare(end) >= 0:
+            return 0
+        if not it.begins_tag(command):
+            # The text before the first command is a section.
+            n += 1
+            it.forward_to_tag_toggle(command)
+        while it.begins_tag(command) and it.compare(end) < 0:
+            n += 1
+            it.forward_to_tag_toggle(command)
+            it.forward_to_tag_toggle(command)
+        return n
+
+    def _get_range(self, start, end):
+        """
+        Called before the text in [start, end) is changed. Return
+        (from_end, s, e): s and e are iterators around the sections which
+        the change affects, and from_end tells if they should be counted from
+        the end of the journal.
+        """
+        tb = self.textbuffer
+        placeholder = self._get_placeholder()
+        if placeholder is not None and start.compare(placeholder[1]) >= 0:
+            lower = placeholder[1]
+        else:
+            lower = tb.get_start_iter()
+        if placeholder is not None and end.compare(placeholder[0]) <= 0:
+            upper = placeholder[0]
+        else:
+            upper = tb.get_iter_at_mark(self.mark)
+        s = self._section_start_before(start, lower)
+        e = self._section_start_after(end, upper)
+        if (placeholder is not None and s.compare(placeholder[1]) < 0
+            and e.compare(placeholder[0]) > 0):
+            # The placeholder itself is changed, which happens when history
+            # is discarded. Everything before e is replaced.
+            return True, tb.get_start_iter(), e
+        elif s.is_start():
+            return False, s, e
+        elif placeholder is not None and e.compare(placeholder[0]) <= 0:
+            return False, s, e
+        else:
+            return True, s, e
+
+    def _on_change(self, start, end):
+        if self.is_disabled or self.scrollback.is_paging:
+            return
+        tb = self.textbuffer
+        if start.compare(tb.get_iter_at_mark(self.mark)) >= 0:
+            return
+        from_end, s, e = self._get_range(start, end)
+        dirty = self.dirty
+        if dirty is not None:
+            dirty_start = tb.get_iter_at_mark(dirty[1])
+            dirty_end = tb.get_iter_at_mark(dirty[2])
+            if (from_end == dirty[0] and s.compare(dirty_end) <= 0
+                and e.compare(dirty_start) >= 0):
+                self._extend_dirty(s, e)
+                return
+            # The text hasn't changed yet, so the sections changed before can
+            # be written now.
+            if not self._write_dirty():
+                return
+        self.dirty = [from_end, None, None, None, 0]
+        self._extend_dirty(s, e)
+
+    def _extend_dirty(self, s, e):
+        """
+        Extend self.dirty to the range [s, e), which is adjacent to it.
+        The text after its end, and before its start, wasn't changed, so the
+        sections there are counted to update it.
+        """
+        tb = self.textbuffer
+        mark_it = tb.get_iter_at_mark(self.mark)
+        dirty = self.dirty
+        from_end, start_mark, end_mark, n, n_old = dirty
+        if start_mark is None:
+            start = end = s
+        else:
+            start = tb.get_iter_at_mark(start_mark)
+            end = tb.get_iter_at_mark(end_mark)
+        if s.compare(start) < 0 or start_mark is None:
+            if from_end and s.is_start():
+                n_old = None
+            elif n_old is not None:
+                n_old += self._count_sections(s, start)
+            if not from_end:
+                n = self._count_sections(tb.get_start_iter(), s)
+            if start_mark is not None:
+                tb.delete_mark(start_mark)
+            start_mark = tb.create_mark(None, s, left_gravity=True)
+        if e.compare(end) > 0 or end_mark is None:
+            if n_old is not None:
+                n_old += self._count_sections(end, e)
+            if from_end:
+                n = self._count_sections(e, mark_it)
+            if end_mark is not None:
+                tb.delete_mark(end_mark)
+            # Text inserted at the end belongs to the range, unless it is at
+            # the mark, and will be appended.
+            end_mark = tb.create_mark(None, e, left_gravity=e.equal(mark_it))
+        self.dirty = [from_end, start_mark, end_mark, n, n_old]
+
+    def _on_insert_text(self, tb, it, _text, _length):
+        if (self.scrollback.is_paging
+            and it.equal(tb.get_iter_at_mark(self.mark))):
+            self.is_paging_at_mark = True
+        else:
+            self._on_change(it, it)
+
+    def _on_after_insert_text(self, tb, it, _text, _length):
+        # it now points at the end of the inserted text
+        if self.is_paging_at_mark:
+            self.is_paging_at_mark = False
+            tb.move_mark(self.mark, it)
+
+    def _on_range_changed(self, _tb, start, end):
+        self._on_change(start, end)
+
+    def _on_tag_changed(self, _tb, _tag, start, end):
+        self._on_change(start, end)
+
+    def _on_paged_out(self, start, end):
+        # Called before the text is removed. If the page doesn't start with a
+        # command, its first section is split from the one before it, which
+        # is still one section in the journal.
+        if (self.is_disabled or start.is_start()
+            or start.begins_tag(self.command_tag)
+            or self._get_placeholder() is not None):
+            return
+        tb = self.textbuffer
+        s = self._section_start_before(start, tb.get_start_iter())
+        e = self._section_start_after(start, end)
+        record = pack_replace(False,
+                              self._count_sections(tb.get_start_iter(), s),
+                              self._count_sections(s, e),
+                              [get_tag_runs(tb, s, start),
+                               get_tag_runs(tb, start, e)])
+        self.garbage += len(record)
+        self._write(record)
+
+    def _on_paged_in(self, start, end):
+        # Called before the placeholder is updated. The page was written to
+        # the journal as separate sections, so if the text after it, or the
+        # page itself when it's the last one, doesn't start with a command,
+        # the sections which are now joined are joined in the journal too.
+        if self.is_disabled:
+            return
+        tb = self.textbuffer
+        command = self.command_tag
+        mark_it = tb.get_iter_at_mark(self.mark)
+        if not end.begins_tag(command) and end.compare(mark_it) < 0:
+            s = self._section_start_before(end, start)
+            e = self._section_start_after(end, mark_it)
+            self._join_sections(True, self._count_sections(e, mark_it),
+                                s, end, end, e)
+        if self.scrollback.pages or start.begins_tag(command):
+            return
+        placeholder_start = self.scrollback.get_placeholder_start()
+        if placeholder_start.is_start():
+            return
+        s = self._section_start_before(placeholder_start, tb.get_start_iter())
+        e = self._section_start_after(start, mark_it)
+        self._join_sections(False, self._count_sections(tb.get_start_iter(), s),
+                            s, placeholder_start, start, e)
+
+    def _join_sections(self, from_end, n, s, end1, start2, e):
+        """
+        Replace the sections in [s, end1) and in [start2, e) with one
+        section.
+        """
+        tb = self.textbuffer
+        n_old = self._count_sections(s, end1) + self._count_sections(start2, e)
+        runs = get_tag_runs(tb, s, end1) + get_tag_runs(tb, start2, e)
+        record = pack_replace(from_end, n, n_old, [runs])
+        self.garbage += len(record)
+        self._write(record)
+
+    def _on_changed(self, _tb):
+        if not self.is_scheduled and not self.is_disabled:
+            idle_add(self._on_idle, priority=PRIORITY_LOW)
+            self.is_scheduled = True
+
+    def _get_complete_end(self):
+        """Return an iterator at the beginning of the last command."""
+        command = self.command_tag
+        it = self.textbuffer.get_end_iter()
+        it.backward_to_tag_toggle(command)
+        if it.ends_tag(command):
+            it.backward_to_tag_toggle(command)
+        return it
+
+    def _on_idle(self):
+        # Callback function
+        self.is_scheduled = False
+        self.flush()
+        return False
+
+    def _write(self, data):
+        """
+        Append data to the journal. If it fails, stop autosaving and return
+        False.
+        """
+        try:
+            if self.file is None:
+                self.file = open(self.filename, 'ab')
+                self.file.seek(0, 2)
+                if self.file.tell() == 0:
+                    self.file.write(MAGIC)
+            self.file.write(data)
+            self.file.flush()
+        except (IOError, OSError), e:
+            debug("Error when writing the autosave journal: %s" % e)
+            # Leave the journal as it was, so that what was written can
+            # still be recovered.
+            try:
+                if self.file is not None:
+                    self.file.truncate(self.size)
+                    self.file.close()
+            except (IOError, OSError):
+                pass
+            self.file = None
+            self.is_disabled = True
+            return False
+        self.size = self.file.tell()
+        return True
+
+    def _write_dirty(self):
+        """Write the changed sections. Return False if writing failed."""
+        if self.dirty is None:
+            return True
+        tb = self.textbuffer
+        from_end, start_mark, end_mark, n, n_old = self.dirty
+        self.dirty = None
+        start = tb.get_iter_at_mark(start_mark)
+        end = tb.get_iter_at_mark(end_mark)
+        tb.delete_mark(start_mark)
+        tb.delete_mark(end_mark)
+        runs = iter_history_runs(get_tag_runs(tb, start, end),
+                                 self.scrollback.iter_paged_runs())
+        record = pack_replace(from_end, n, n_old, list(iter_sections(runs)))
+        if n_old is None:
+            # We don't know how much was replaced, so compact when we can.
+            self.garbage = self.size
+        else:
+            self.garbage += len(record)
+        return self._write(record)
+
+    def flush(self):
+        """
+        Write the changed sections and the completed sections to the
+        journal.
+        """
+        if self.is_disabled or not self._write_dirty():
+            return
+        tb = self.textbuffer
+        start = tb.get_iter_at_mark(self.mark)
+        if not start.is_start() and not start.begins_tag(self.command_tag):
+            # The output of the last written section was removed, so the
+            # section at the mark was joined to it. Remove it from the journal,
+            # and write it again when the joined section is complete.
+            if not self._write(pack_replace(True, 0, 1, [])):
+                return
+            placeholder = self._get_placeholder()
+            if placeholder is not None:
+                lower = placeholder[1]
+            else:
+                lower = tb.get_start_iter()
+            start = self._section_start_before(start, lower)
+            tb.move_mark(self.mark, start)
+        end = self._get_complete_end()
+        if start.compare(end) < 0:
+            runs = get_tag_runs(tb, start, end)
+            data = ''.join(pack_section(section)
+                           for section in iter_sections(runs))
+            if not self._write(data):
+                return
+            tb.move_mark(self.mark, end)
+        if (self.thread is None and self.garbage >= COMPACT_MIN_SIZE
+            and self.garbage * 2 > self.size):
+            self.thread = threading.Thread(target=self._compact_in_thread,
+                                           args=(self.size, self.garbage))
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _compact_in_thread(self, size, garbage):
+        try:
+            _compact_journal(self.filename, size)
+        except (IOError, OSError, FormatError), e:
+            idle_add(self._on_compacted, size, garbage, e)
+        else:
+            idle_add(self._on_compacted, size, garbage, None)
+
+    def _on_compacted(self, size, garbage, error):
+        # Callback function, called in the main thread
+        self.thread = None
+        tmp_fn = self.filename + '.tmp'
+        if error is None and not self.is_disabled:
+            try:
+                # Add what was appended while compacting
+                f = open(self.filename, 'rb')
+                try:
+                    f.seek(size)
+                    tail = f.read()
+                finally:
+                    f.close()
+                f = open(tmp_fn, 'ab')
+                try:
+                    f.write(tail)
+                    f.flush()
+                    os.fsync(f.fileno())
+                finally:
+                    f.close()
+                if self.file is not None:
+                    self.file.close()
+                    self.file = None
+                if sys.platform == 'win32' and os.path.exists(self.filename):
+                    # On Windows, rename doesn't replace existing files
+                    os.remove(self.filename)
+                os.rename(tmp_fn, self.filename)
+                self.size = os.path.getsize(self.filename)
+            except (IOError, OSError), e:
+                error = e
+        if error is not None:
+            debug("Error when compacting the autosave journal: %s" % error)
+        # If compacting failed, wait for as much garbage before trying again.
+        self.garbage = max(self.garbage - garbage, 0)
+        if os.path.exists(tmp_fn):
+            try:
+                os.remove(tmp_fn)
+            except OSError:
+                pass
+        return False
+
+    def close(self):
+        """Called when DreamPie quits normally. Remove the journal."""
+        self.is_disabled = True
+        if self.thread is not None:
+            self.thread.join()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        for journal_fn in (self.filename, self.filename + '.tmp'):
+            if os.path.exists(journal_fn):
+                os.remove(journal_fn)
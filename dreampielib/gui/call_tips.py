@@ -72,7 +72,12 @@ class CallTips(object):
             widget.disconnect(handler)
         self.signals[:] = []
 
-    def show(self, is_auto):
+    def show(self, is_auto, known_doc=None):
+        """
+        Show the call tip of the function whose arguments are being typed.
+        known_doc may be an (expr, doc) pair, if the doc of expr was already
+        retrieved.
+        """
         sb = self.sourcebuffer
         text = get_text(sb, sb.get_start_iter(), sb.get_end_iter())
         index = sb.get_iter_at_mark(sb.get_insert()).get_offset()
@@ -93,7 +98,10 @@ class CallTips(object):
         expr = hp.get_expression()
         if not expr or (is_auto and expr.find('(') != -1):
             return and_maybe_beep()
-        arg_text = self.get_func_doc(expr)
+        if known_doc is not None and known_doc[0] == expr:
+            arg_text = known_doc[1]
+        else:
+            arg_text = self.get_func_doc(expr)
 
         if not arg_text:
             return and_maybe_beep()
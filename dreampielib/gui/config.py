@@ -33,6 +33,13 @@ show-getting-started = True
 font=Courier New 10
 current-theme = Dark
 pprint = True
+repr-limits = True
+repr-max-depth = 20
+repr-max-items = 10000
+repr-max-chars = 0
+repr-max-seconds = 2
+show-command-stats = False
+profile-top = 0
 use-reshist = True
 reshist-size = 30
 autofold = True
@@ -45,10 +52,14 @@ vertical-layout = True
 ask-on-quit = True
 matplotlib-ia-switch = False
 matplotlib-ia-warn = True
+parse-files = True
 
 recall-1-char-commands = False
+persistent-history = True
+autosave = True
 hide-defs = False
 leave-code = False
+scrollback-sections = 0
 
 start-rpdb2-embedded = False
 
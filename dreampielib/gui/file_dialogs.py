@@ -37,7 +37,7 @@ def open_dialog(func, title, parent, filter_name, filter_pattern):
     title - window title
     parent - parent window, or None
     filter_name - "HTML Files"
-    filter_pattern - "*.html"
+    filter_pattern - "*.html", or a list of patterns
     """
     d = gtk.FileChooserDialog(
         title, parent,
@@ -46,7 +46,10 @@ def open_dialog(func, title, parent, filter_name, filter_pattern):
          gtk.STOCK_OK, gtk.RESPONSE_OK))
     fil = gtk.FileFilter()
     fil.set_name(filter_name)
-    fil.add_pattern(filter_pattern)
+    if isinstance(filter_pattern, basestring):
+        filter_pattern = [filter_pattern]
+    for pattern in filter_pattern:
+        fil.add_pattern(pattern)
     d.add_filter(fil)
     while True:
         r = d.run()
@@ -66,7 +69,7 @@ def open_dialog(func, title, parent, filter_name, filter_pattern):
     d.destroy()
 
 def save_dialog(func, title, parent, filter_name, filter_pattern, auto_ext=None,
-                prev_dir=None, prev_name=None):
+                prev_dir=None, prev_name=None, more_filters=()):
     """
     Display the Save As dialog.
     func - a function which gets a file name and does something. If it throws
@@ -77,6 +80,8 @@ def save_dialog(func, title, parent, filter_name, filter_pattern, auto_ext=None,
     filter_pattern - "*.html"
     auto_ext - "html", if not None will be added if no extension given.
     prev_dir, prev_name - will set the default if given.
+    more_filters - a list of (filter_name, filter_pattern, auto_ext) tuples of
+        more file types to choose from. auto_ext of the chosen one is used.
     
     Return True if file was saved.
     """
@@ -85,10 +90,15 @@ def save_dialog(func, title, parent, filter_name, filter_pattern, auto_ext=None,
         gtk.FILE_CHOOSER_ACTION_SAVE,
         (gtk.STOCK_CANCEL, gtk.RESPONSE_CANCEL,
          gtk.STOCK_OK, gtk.RESPONSE_OK))
-    fil = gtk.FileFilter()
-    fil.set_name(filter_name)
-    fil.add_pattern(filter_pattern)
-    d.add_filter(fil)
+    # A list of (filter, auto_ext) pairs
+    filters = []
+    for name, pattern, ext in ([(filter_name, filter_pattern, auto_ext)]
+                               + list(more_filters)):
+        fil = gtk.FileFilter()
+        fil.set_name(name)
+        fil.add_pattern(pattern)
+        d.add_filter(fil)
+        filters.append((fil, ext))
     if prev_dir:
         d.set_current_folder(prev_dir)
     if prev_name:
@@ -99,6 +109,9 @@ def save_dialog(func, title, parent, filter_name, filter_pattern, auto_ext=None,
         if r != gtk.RESPONSE_OK:
             break
         filename = abspath(d.get_filename()).decode('utf8')
+        for fil, ext in filters:
+            if fil is d.get_filter():
+                auto_ext = ext
         if auto_ext and not os.path.splitext(filename)[1]:
             filename += os.path.extsep + auto_ext
         if exists(filename):
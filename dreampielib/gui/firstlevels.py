@@ -0,0 +1,93 @@
+# Copyright 2012 Noam Yorav-Raphael
+#
+# This file is part of DreamPie.
+#
+# DreamPie is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# DreamPie is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with DreamPie.  If not, see <http://www.gnu.org/licenses/>.
+
+__all__ = ['FirstLevels']
+
+from bisect import bisect_left, insort
+
+# If a delta changes more names than this, the sorted list of globals is
+# rebuilt instead of updated name by name.
+MAX_INSORTS = 100
+
+def _prefix_slice(L, prefix):
+    """Return the items of the sorted list L which start with prefix."""
+    start = end = bisect_left(L, prefix)
+    while end < len(L) and L[end].startswith(prefix):
+        end += 1
+    return L[start:end]
+
+class FirstLevels(object):
+    """
+    Keep the names which can be completed at the first level - builtins,
+    keywords and globals of the subprocess - sorted, so that they can be
+    completed without asking the subprocess.
+    The builtins and keywords are loaded once. The globals are updated by
+    the delta which the subprocess sends after every command.
+    """
+    def __init__(self):
+        self.is_loaded = False
+        # Builtin names and keywords
+        self.fixed = []
+        self.globals = []
+        # The names in __all__ of the namespace, or None
+        self.all_set = None
+
+    def load(self, fixed_names, global_names, all_names):
+        """Load the reply of the get_firstlevels call."""
+        self.fixed = fixed_names
+        self.globals = global_names
+        self.all_set = set(all_names) if all_names is not None else None
+        self.is_loaded = True
+
+    def update(self, names_delta):
+        """
+        Apply the names_delta sent by the subprocess with the result of a
+        command.
+        """
+        if not self.is_loaded or names_delta is None:
+            return
+        added, removed, all_names = names_delta
+        if len(added) + len(removed) > MAX_INSORTS:
+            names = set(self.globals)
+            names.difference_update(removed)
+            names.update(added)
+            self.globals = sorted(names)
+        else:
+            globals_ = self.globals
+            for name in removed:
+                i = bisect_left(globals_, name)
+                if i < len(globals_) and globals_[i] == name:
+                    del globals_[i]
+            for name in added:
+                insort(globals_, name)
+        self.all_set = set(all_names) if all_names is not None else None
+
+    def complete(self, prefix):
+        """
+        Return (public, private) - sorted lists of the names which start
+        with prefix.
+        """
+        names = _prefix_slice(self.fixed, prefix)
+        names.extend(_prefix_slice(self.globals, prefix))
+        names = sorted(set(names))
+        if self.all_set is not None:
+            public = [x for x in names if x in self.all_set]
+            private = [x for x in names if x not in self.all_set]
+        else:
+            public = [x for x in names if not x.startswith('_')]
+            private = [x for x in names if x.startswith('_')]
+        return public, private
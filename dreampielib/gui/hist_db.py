@@ -0,0 +1,286 @@
+# Copyright 2012 Noam Yorav-Raphael
+#
+# This file is part of DreamPie.
+# 
+# DreamPie is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# DreamPie is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with DreamPie.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A database of the commands executed in all sessions, so that they can be
+recalled after DreamPie is restarted.
+"""
+
+__all__ = ['HistoryDB']
+
+import os
+import struct
+from zlib import crc32
+import threading
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+
+try:
+    from glib import timeout_add, idle_add, source_remove
+except ImportError:
+    # In PyGObject 2.14, it's in gobject.
+    from gobject import timeout_add, idle_add, source_remove
+
+# The database is made of two files:
+# * The log file - the commands, each stored as its utf-8 length (packed with
+#   LEN_FORMAT) followed by the utf-8 encoded command.
+# * The index file - an entry for each command, which is its offset in the
+#   log file and the crc32 of its utf-8 encoding, packed with INDEX_FORMAT.
+# Both files are only appended to. Since the index entries are of a fixed
+# size, the index can be read backwards, starting from the newest command,
+# without reading the rest of the file.
+# An index entry is written only after the command was written to the log, so
+# if DreamPie crashed while writing, we may only have an incomplete index
+# entry at the end, which we ignore, or a command without an index entry,
+# which is never read.
+# A command which is already in the log isn't written again - its new index
+# entry points to the existing copy. Since crc32 may collide, the text is
+# compared before a copy is reused, and when commands are deduplicated while
+# reading.
+# Several DreamPie instances may share the database, so the index file is
+# locked while writing.
+LEN_FORMAT = '<I'
+LEN_SIZE = struct.calcsize(LEN_FORMAT)
+INDEX_FORMAT = '<QI'
+INDEX_SIZE = struct.calcsize(INDEX_FORMAT)
+
+# Number of index entries to read at once when reading backwards
+INDEX_BLOCK = 1024
+
+# Appended commands are written and synced to disk this number of
+# milliseconds after the first one which wasn't written yet.
+FLUSH_DELAY = 2000
+
+def hash_cmd(s):
+    return crc32(s) & 0xffffffff
+
+def _get_n_entries(index_file):
+    index_file.seek(0, 2)
+    return index_file.tell() // INDEX_SIZE
+
+def _read_entries(index_file, start, end):
+    """Read index entries [start, end) and return a list of
+    (offset, hash) pairs."""
+    index_file.seek(start * INDEX_SIZE)
+    data = index_file.read((end - start) * INDEX_SIZE)
+    return [struct.unpack_from(INDEX_FORMAT, data, i * INDEX_SIZE)
+            for i in xrange(len(data) // INDEX_SIZE)]
+
+def _read_data(log_file, offset, cmd_hash):
+    """Read an encoded command from the log. Return None if it's corrupted."""
+    log_file.seek(offset)
+    data = log_file.read(LEN_SIZE)
+    if len(data) < LEN_SIZE:
+        return None
+    length, = struct.unpack(LEN_FORMAT, data)
+    data = log_file.read(length)
+    if len(data) < length or hash_cmd(data) != cmd_hash:
+        return None
+    return data
+
+class HistoryDB(object):
+    """
+    Store commands on disk, and read them newest first.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        # These are used by the main thread, for reading. The flush thread
+        # opens its own.
+        self.log_file = open(filename, 'a+b')
+        self.index_file = open(filename + '-index', 'a+b')
+        # A list of utf-8 encoded commands which weren't written yet
+        self.pending = []
+        # The commands which the flush thread is writing
+        self.flushing = []
+        self.flush_handle = None
+        self.flush_thread = None
+
+        # Used only when writing: maps hashes to the offsets of the commands
+        # with that hash in the log, for the first n_known index entries.
+        self.known = {}
+        self.n_known = 0
+
+        self.last_data = None
+        n = _get_n_entries(self.index_file)
+        if n > 0:
+            offset, cmd_hash = _read_entries(self.index_file, n - 1, n)[0]
+            self.last_data = _read_data(self.log_file, offset, cmd_hash)
+
+    def append(self, command):
+        """
+        Add a command to the database. Repeating the last command does nothing.
+        """
+        data = command.encode('utf8')
+        if data == self.last_data:
+            return
+        self.last_data = data
+        self.pending.append(data)
+        if self.flush_handle is None:
+            self.flush_handle = timeout_add(FLUSH_DELAY, self._on_flush_timeout)
+
+    def _on_flush_timeout(self):
+        if self.flush_thread is not None:
+            # _on_flushed will schedule us again
+            self.flush_handle = None
+            return False
+        self.flush_handle = None
+        self.flushing = self.pending
+        self.pending = []
+        # Syncing to disk may take a while, so it's done in a thread.
+        self.flush_thread = threading.Thread(target=self._flush_in_thread,
+                                             args=(self.flushing,))
+        self.flush_thread.daemon = True
+        self.flush_thread.start()
+        return False
+
+    def _flush_in_thread(self, datas):
+        try:
+            self._write(datas)
+            # They may be read by the main thread until _on_flushed, but
+            # close() shouldn't write them again.
+            self.flushing = []
+        finally:
+            idle_add(self._on_flushed)
+
+    def _on_flushed(self):
+        # Callback function, called in the main thread
+        if self.flush_thread is None:
+            # We were closed
+            return False
+        self.flush_thread.join()
+        self.flush_thread = None
+        self.flushing = []
+        if self.pending and self.flush_handle is None:
+            self.flush_handle = timeout_add(FLUSH_DELAY, self._on_flush_timeout)
+        return False
+
+    def _update_known(self, index_file):
+        """Add the index entries written since the last call to self.known."""
+        n = _get_n_entries(index_file)
+        known = self.known
+        for offset, cmd_hash in _read_entries(index_file, self.n_known, n):
+            offsets = known.setdefault(cmd_hash, [])
+            if offset not in offsets:
+                offsets.append(offset)
+        self.n_known = n
+
+    def _find_known(self, log_file, data):
+        """Return the offset of a copy of data in the log, or None."""
+        cmd_hash = hash_cmd(data)
+        for offset in self.known.get(cmd_hash, ()):
+            if _read_data(log_file, offset, cmd_hash) == data:
+                return offset
+        return None
+
+    def _write(self, datas):
+        """
+        Write commands to the log and the index, and sync them to disk.
+        Called by the flush thread, or by close() after it ended.
+        """
+        log_file = open(self.filename, 'a+b')
+        try:
+            index_file = open(self.filename + '-index', 'a+b')
+            try:
+                if fcntl is not None:
+                    # Released when the file is closed
+                    fcntl.flock(index_file.fileno(), fcntl.LOCK_EX)
+                self._update_known(index_file)
+                log_file.seek(0, 2)
+                end = log_file.tell()
+                log_parts = []
+                index_parts = []
+                # Offsets of commands which are written now
+                new = {}
+                for data in datas:
+                    offset = new.get(data)
+                    if offset is None:
+                        offset = self._find_known(log_file, data)
+                    if offset is None:
+                        offset = new[data] = end
+                        log_parts.append(struct.pack(LEN_FORMAT, len(data)))
+                        log_parts.append(data)
+                        end += LEN_SIZE + len(data)
+                    index_parts.append(struct.pack(INDEX_FORMAT, offset,
+                                                   hash_cmd(data)))
+
+                if log_parts:
+                    log_file.seek(0, 2)
+                    log_file.write(''.join(log_parts))
+                    log_file.flush()
+                    os.fsync(log_file.fileno())
+                # If there's an incomplete entry at the end, overwrite it.
+                n = _get_n_entries(index_file)
+                index_file.truncate(n * INDEX_SIZE)
+                index_file.seek(0, 2)
+                index_file.write(''.join(index_parts))
+                index_file.flush()
+                os.fsync(index_file.fileno())
+                self._update_known(index_file)
+            finally:
+                index_file.close()
+        finally:
+            log_file.close()
+
+    def iter_commands(self):
+        """
+        Yield the stored commands, newest first. Commands which were already
+        yielded are skipped.
+        """
+        # Maps hashes to the commands with that hash which were yielded
+        seen = {}
+        def is_new(cmd_hash, data):
+            datas = seen.setdefault(cmd_hash, [])
+            if data in datas:
+                return False
+            datas.append(data)
+            return True
+        for data in reversed(self.flushing + self.pending):
+            if is_new(hash_cmd(data), data):
+                yield data.decode('utf8')
+        # Reused copies have the same offset, so they are skipped without
+        # reading the log.
+        seen_offsets = set()
+        end = _get_n_entries(self.index_file)
+        while end > 0:
+            start = max(end - INDEX_BLOCK, 0)
+            entries = _read_entries(self.index_file, start, end)
+            for offset, cmd_hash in reversed(entries):
+                if offset in seen_offsets:
+                    continue
+                seen_offsets.add(offset)
+                data = _read_data(self.log_file, offset, cmd_hash)
+                if data is not None and is_new(cmd_hash, data):
+                    yield data.decode('utf8')
+            end = start
+
+    def close(self):
+        if self.flush_handle is not None:
+            source_remove(self.flush_handle)
+            self.flush_handle = None
+        if self.flush_thread is not None:
+            self.flush_thread.join()
+            self.flush_thread = None
+        datas = self.flushing + self.pending
+        self.flushing = []
+        self.pending = []
+        if datas:
+            self._write(datas)
+        self.log_file.close()
+        self.index_file.close()
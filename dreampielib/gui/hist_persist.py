@@ -18,54 +18,175 @@
 __all__ = ['HistPersist']
 
 import os
-from HTMLParser import HTMLParser
+import re
+import time
 from htmlentitydefs import name2codepoint
 
+try:
+    from glib import idle_add, source_remove
+except ImportError:
+    # In PyGObject 2.14, it's in gobject.
+    from gobject import idle_add, source_remove
+
 from .file_dialogs import open_dialog, save_dialog
-from .common import get_text
+from .tags import SCROLLBACK
+from .tag_runs import get_tag_runs, insert_tag_runs
+from .session_file import (SESSION_EXT, FormatError, is_session_file,
+                           iter_session_chunks, SessionReader)
 
 _ = lambda s: s
 
+# When saving, the HTML is written in chunks of about this size
+SAVE_CHUNK_SIZE = 256 * 1024
+
+# Saving and loading are done from idle callbacks, which return after this
+# number of seconds, to let the window respond.
+SAVE_TIME_BUDGET = LOAD_TIME_BUDGET = 0.05
+
+# When loading, the file is read in blocks of this size, and the text is
+# inserted in chunks of about this number of characters.
+LOAD_READ_SIZE = 64 * 1024
+LOAD_CHUNK_SIZE = 64 * 1024
+
 class HistPersist(object):
     """
     Provide actions for storing and loading history.
     """
     
-    def __init__(self, window_main, textview, status_bar, recent_manager):
+    def __init__(self, window_main, textview, status_bar, recent_manager,
+                 scrollback, on_loaded):
         self.window_main = window_main
         self.textview = textview
         self.textbuffer = textview.get_buffer()
         self.status_bar = status_bar
         self.recent_manager = recent_manager
+        self.scrollback = scrollback
+        # A function to call after history was loaded, with an iterator at
+        # the end of the loaded history
+        self.on_loaded = on_loaded
         
         self.filename = None
         
+        # While history is being saved in the background, a list
+        # [file, chunks, filename, estimated_size, n_saved, percent], where
+        # chunks is an iterator over the rest of the file, and n_saved is a
+        # list with the number of characters which were serialized.
+        self.save_job = None
+        self.save_handle = None
+        # While history is being loaded, a list
+        # [file, chunks, filename, file_size, mark, percent], where chunks
+        # is an iterator over lists of runs, and mark is where they are
+        # inserted.
+        self.load_job = None
+        self.load_handle = None
+        
         self.textbuffer.connect('modified-changed', self.on_modified_changed)
     
-    def save_filename(self, filename):
+    def save_filename(self, filename, wait=False):
         """
         Save history to a file.
+        The contents of the text buffer is copied immediately. Unless wait is
+        True, the file is written from an idle callback, so the window stays
+        responsive while saving large histories.
         """
+        self.finish_saving()
+        self.finish_loading()
         f = open(filename, 'wb')
-        save_history(self.textview, f)
-        f.close()
+        tb = self.textbuffer
+        runs = get_tag_runs(tb, tb.get_start_iter(), tb.get_end_iter())
+        estimated_size = sum(len(text) for text, _tag_names in runs)
+        n_saved = [0]
+        # The pages are read while saving, and may be loaded meanwhile.
+        self.scrollback.hold_pages()
+        history_runs = _count_chars(iter_history_runs(
+            runs, self.scrollback.iter_paged_runs()), n_saved)
+        if is_session_filename(filename):
+            chunks = iter_session_chunks(history_runs)
+        else:
+            chunks = iter_history_html(self.textview, history_runs)
+        # If the history is changed while saving, it will be marked as
+        # modified again.
+        tb.set_modified(False)
+        if wait:
+            try:
+                try:
+                    for chunk in chunks:
+                        f.write(chunk)
+                finally:
+                    f.close()
+                    self.scrollback.release_pages()
+            except:
+                tb.set_modified(True)
+                raise
+            self._on_saved(filename)
+        else:
+            self.save_job = [f, chunks, filename, estimated_size, n_saved, 0]
+            self.save_handle = idle_add(self._on_save_idle)
+
+    def _on_save_idle(self):
+        f, chunks, filename, estimated_size, n_saved, percent = self.save_job
+        start_time = time.time()
+        is_done = True
+        try:
+            try:
+                while time.time() - start_time < SAVE_TIME_BUDGET:
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        break
+                    f.write(chunk)
+                else:
+                    new_percent = min(
+                        n_saved[0] * 100 // (estimated_size or 1), 99)
+                    if new_percent != percent:
+                        self.save_job[5] = new_percent
+                        self.status_bar.set_status(
+                            _('Saving history... %d%%') % new_percent)
+                    is_done = False
+                    return True
+            except (IOError, OSError), e:
+                self.textbuffer.set_modified(True)
+                self.status_bar.set_status(
+                    _('Error when saving history: %s') % e)
+                return False
+            except:
+                self.textbuffer.set_modified(True)
+                raise
+        finally:
+            if is_done:
+                # Whatever happened, the job is over, so later saves can run.
+                f.close()
+                self.save_job = self.save_handle = None
+                self.scrollback.release_pages()
+        self._on_saved(filename)
+        return False
+
+    def _on_saved(self, filename):
         self.filename = filename
         self.status_bar.set_status(_('History saved.'))
         self.recent_add(filename)
-        self.textbuffer.set_modified(False)
+        self.update_title()
+
+    def finish_saving(self):
+        """If history is being saved in the background, finish saving."""
+        if self.save_job is None:
+            return
+        source_remove(self.save_handle)
+        while self._on_save_idle():
+            pass
 
-    def save(self):
+    def save(self, wait=False):
         """
         Show the save dialog if there's no filename. Return True if was saved.
+        If wait is True, return after the file was written.
         """
         if self.filename is None:
-            saved = self.save_as()
+            saved = self.save_as(wait)
         else:
-            self.save_filename(self.filename)
+            self.save_filename(self.filename, wait)
             saved = True
         return saved
     
-    def save_as(self):
+    def save_as(self, wait=False):
         """Show the save dialog. Return True if was saved."""
         if self.filename:
             prev_dir = os.path.dirname(self.filename)
@@ -74,35 +195,110 @@ class HistPersist(object):
             prev_dir = None
             #prev_name = 'dreampie-history.html'
             prev_name = None
-        saved = save_dialog(self.save_filename,
+        saved = save_dialog(lambda fn: self.save_filename(fn, wait),
                             _('Choose where to save the history'),
                             self.window_main,
                             _('HTML Files'),
                             '*.html', 'html',
-                            prev_dir, prev_name)
+                            prev_dir, prev_name,
+                            [(_('DreamPie Session Files'),
+                              '*.' + SESSION_EXT, SESSION_EXT)])
         return saved
 
-    def load_filename(self, filename):
-        s = open(filename, 'rb').read()
-        parser = Parser(self.textbuffer)
-        parser.feed(s)
-        parser.close()
-        self.status_bar.set_status(_('History loaded.'))
-        self.filename = filename
-        self.update_title()
-        self.recent_add(filename)
+    def load_filename(self, filename, is_recovery=False):
+        """
+        Insert the history from a file at the beginning of the text buffer.
+        The header is read immediately, and the rest is inserted from an idle
+        callback.
+        If is_recovery is True, the file is an autosave journal, so it isn't
+        remembered as the file of the history.
+        """
+        self.finish_loading()
+        f = open(filename, 'rb')
+        try:
+            if is_session_file(f):
+                chunks = iter_session_runs_chunks(SessionReader(f))
+            else:
+                chunks = iter_history_runs_chunks(f, read_history_header(f))
+        except:
+            f.close()
+            raise
+        tb = self.textbuffer
+        # The mark has right gravity, so it stays after the inserted text.
+        mark = tb.create_mark(None, tb.get_start_iter(), left_gravity=False)
+        file_size = os.fstat(f.fileno()).st_size
+        self.load_job = [f, chunks, filename, file_size, mark, 0,
+                         is_recovery]
+        self.load_handle = idle_add(self._on_load_idle)
+
+    def _on_load_idle(self):
+        (f, chunks, filename, file_size, mark, percent,
+         is_recovery) = self.load_job
+        tb = self.textbuffer
+        start_time = time.time()
+        is_done = True
+        try:
+            try:
+                while time.time() - start_time < LOAD_TIME_BUDGET:
+                    runs = next(chunks, None)
+                    if runs is None:
+                        break
+                    insert_tag_runs(tb, tb.get_iter_at_mark(mark), runs)
+                else:
+                    new_percent = min(f.tell() * 100 // (file_size or 1), 99)
+                    if new_percent != percent:
+                        self.load_job[5] = new_percent
+                        self.status_bar.set_status(
+                            _('Loading history... %d%%') % new_percent)
+                    is_done = False
+                    return True
+                if is_recovery:
+                    status = _('History recovered.')
+                else:
+                    status = _('History loaded.')
+            except (IOError, OSError, LoadError, FormatError), e:
+                status = _('Error when loading history: %s') % e
+                filename = None
+        finally:
+            if is_done:
+                # Whatever happened, the job is over, so later loads can run,
+                # and what was inserted is known to the others.
+                f.close()
+                # The loaded history is before this
+                loaded_end = tb.get_iter_at_mark(mark)
+                tb.delete_mark(mark)
+                self.load_job = self.load_handle = None
+                self.on_loaded(loaded_end)
+        self.status_bar.set_status(status)
+        if filename is not None and not is_recovery:
+            self.filename = filename
+            self.update_title()
+            self.recent_add(filename)
+        return False
+
+    def finish_loading(self):
+        """If history is being loaded in the background, finish loading."""
+        if self.load_job is None:
+            return
+        source_remove(self.load_handle)
+        while self._on_load_idle():
+            pass
     
     def load(self):
         open_dialog(self.load_filename,
                     _('Choose the saved history file'),
                     self.window_main,
-                    _('HTML Files'),
-                    '*.html')
+                    _('DreamPie History Files'),
+                    ['*.html', '*.' + SESSION_EXT])
     
     def recent_add(self, filename):
         # FIXME: This doesn't add an entry when saving HTML files. VERY strange.
+        if is_session_filename(filename):
+            mime_type = 'application/x-dreampie-session'
+        else:
+            mime_type = 'text/html'
         self.recent_manager.add_full('file://'+filename, {
-            'mime_type': 'text/html', 'app_name': 'dreampie',
+            'mime_type': mime_type, 'app_name': 'dreampie',
             'app_exec': 'dreampie'})
     
     def update_title(self):
@@ -140,15 +336,40 @@ def _html_escape(s):
 def _format_color(color):
     return '#%02x%02x%02x' % (color.red >> 8, color.green >> 8, color.blue >> 8)
 
-def save_history(textview, f):
+def is_session_filename(filename):
+    """Check if history should be saved to filename in the session format."""
+    return filename.lower().endswith('.' + SESSION_EXT)
+
+def _count_chars(runs, counter):
+    """Yield runs, adding the number of characters to counter[0]."""
+    for run in runs:
+        counter[0] += len(run[0])
+        yield run
+
+def iter_history_runs(runs, paged_runs):
     """
-    Save the history - the content of the textview - to a HTML file f.
+    Yield the runs of the history. runs are the runs of the text buffer, and
+    paged_runs are the runs of the sections which were paged out by
+    Scrollback. They are yielded instead of the placeholder which replaces
+    them.
+    """
+    for run in runs:
+        if SCROLLBACK in run[1]:
+            for paged_run in paged_runs:
+                yield paged_run
+        else:
+            yield run
+
+def iter_history_html(textview, runs):
+    """
+    Yield the history, given as runs of (text, tag_names), as chunks of a
+    utf-8 encoded HTML file.
     """
     tv = textview
     tb = tv.get_buffer()
     style = tv.get_style()
 
-    f.write("""\
+    header = ["""\
 <!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01//EN">
 <html>
 <head>
@@ -169,7 +390,7 @@ body {
     _format_color(style.text[0]),
     _format_color(style.base[0]),
     )
-)
+    ]
     
     tt = tb.get_tag_table()
     all_tags = []
@@ -177,125 +398,182 @@ body {
     all_tags.sort(key=lambda tag: -tag.get_priority())
     
     for tag in all_tags:
-        f.write("span.%s {\n" % tag.props.name)
+        header.append("span.%s {\n" % tag.props.name)
         if tag.props.foreground_set:
-            f.write("  color: %s;\n" % _format_color(tag.props.foreground_gdk))
+            header.append("  color: %s;\n"
+                          % _format_color(tag.props.foreground_gdk))
         if tag.props.background_set:
-            f.write("  background-color: %s;\n"
-                    % _format_color(tag.props.background_gdk))
+            header.append("  background-color: %s;\n"
+                          % _format_color(tag.props.background_gdk))
         if tag.props.invisible:
-            f.write(" display: none;\n")
-        f.write("}\n")
+            header.append(" display: none;\n")
+        header.append("}\n")
     
-    f.write("""\
+    header.append("""\
 </style>
 </head>
 <body>""")
+    yield ''.join(header)
     
+    # Map tag names to priorities, and tuples of tag names to lists of names
+    # sorted by descending priority.
+    priorities = dict((tag.props.name, tag.get_priority()) for tag in all_tags)
+    sorted_names = {}
+    
+    parts = []
+    size = 0
     cur_tags = []
-    it = tb.get_start_iter()
-    while True:
-        new_tags = cur_tags[:]
-        for tag in it.get_toggled_tags(False):
-            new_tags.remove(tag)
-        for tag in it.get_toggled_tags(True):
-            new_tags.append(tag)
-        new_tags.sort(key=lambda tag: -tag.get_priority())
+    for text, tag_names in runs:
+        try:
+            new_tags = sorted_names[tag_names]
+        except KeyError:
+            new_tags = sorted(tag_names, key=lambda name: -priorities[name])
+            sorted_names[tag_names] = new_tags
         
         shared_prefix = 0
         while (len(cur_tags) > shared_prefix and len(new_tags) > shared_prefix
-               and cur_tags[shared_prefix] is new_tags[shared_prefix]):
+               and cur_tags[shared_prefix] == new_tags[shared_prefix]):
             shared_prefix += 1
-        for _i in range(len(cur_tags) - shared_prefix):
-            f.write('</span>')
-        for tag in new_tags[shared_prefix:]:
-            f.write('<span class="%s">' % tag.props.name)
-        
-        if it.compare(tb.get_end_iter()) == 0:
-            # We reached the end. We break here, because we want to close
-            # the tags.
-            break
-        
-        new_it = it.copy()
-        new_it.forward_to_tag_toggle(None)
-        text = get_text(tb, it, new_it)
-        text = _html_escape(text)
-        f.write(text.encode('utf8'))
-        
-        it = new_it
+        if len(cur_tags) > shared_prefix:
+            parts.append('</span>' * (len(cur_tags) - shared_prefix))
+        for name in new_tags[shared_prefix:]:
+            parts.append('<span class="%s">' % name)
         cur_tags = new_tags
+        
+        data = _html_escape(text).encode('utf8')
+        parts.append(data)
+        size += len(data)
+        if size >= SAVE_CHUNK_SIZE:
+            yield ''.join(parts)
+            parts = []
+            size = 0
     
-    f.write("""\
+    parts.append('</span>' * len(cur_tags))
+    parts.append("""\
 </body>
 </html>
 """)
+    yield ''.join(parts)
+
+def save_history(textview, f, paged_runs=()):
+    """
+    Save the history - the content of the textview - to a HTML file f.
+    paged_runs are the runs of the sections which were paged out by
+    Scrollback.
+    """
+    tb = textview.get_buffer()
+    runs = get_tag_runs(tb, tb.get_start_iter(), tb.get_end_iter())
+    for chunk in iter_history_html(textview, iter_history_runs(runs,
+                                                               paged_runs)):
+        f.write(chunk)
 
 class LoadError(Exception):
     pass
 
-class Parser(HTMLParser):
-    def __init__(self, textbuffer):
-        HTMLParser.__init__(self)
-        
-        self.textbuffer = tb = textbuffer
+_meta_re = re.compile(r'<meta\s+name="DreamPie Format"\s+content="([^"]*)"',
+                      re.IGNORECASE)
+_body_re = re.compile(r'<body[^>]*>', re.IGNORECASE)
+# Groups: span class, end of span, other tag, text
+_token_re = re.compile(r'<span class="([^"]*)">|(</span>)|(<[^>]*>)|([^<]+)')
+_entity_re = re.compile(r'&(#?)(\w+);')
 
-        self.reached_body = False
-        self.version = None
-        self.cur_tags = []
-        self.leftmark = tb.create_mark(None, tb.get_start_iter(), True)
-        self.rightmark = tb.create_mark(None, tb.get_start_iter(), False)
-    
-    def handle_starttag(self, tag, attrs):
-        attrs = dict(attrs)
-        if not self.reached_body:
-            if tag == 'meta':
-                if 'name' in attrs and attrs['name'] == 'DreamPie Format':
-                    if attrs['content'] != '1':
-                        raise LoadError("Unrecognized DreamPie Format")
-                    self.version = 1
-            if tag == 'body':
-                if self.version is None:
-                    raise LoadError("File is not a DreamPie history file.")
-                self.reached_body = True
+def read_history_header(f):
+    """
+    Read the beginning of a DreamPie history file, up to and including the
+    <body> tag. Return the data which was read after it.
+    Raise LoadError if the file isn't a DreamPie Format 1 file.
+    """
+    data = ''
+    while True:
+        m = _body_re.search(data)
+        if m is not None:
+            break
+        s = f.read(LOAD_READ_SIZE)
+        if not s:
+            raise LoadError("File is not a DreamPie history file.")
+        data += s
+    m_meta = _meta_re.search(data, 0, m.start())
+    if m_meta is None:
+        raise LoadError("File is not a DreamPie history file.")
+    if m_meta.group(1) != '1':
+        raise LoadError("Unrecognized DreamPie Format")
+    return data[m.end():]
+
+def iter_session_runs_chunks(reader):
+    """
+    Yield lists of runs from a session file, with whole sections and about
+    LOAD_CHUNK_SIZE characters in each.
+    """
+    runs = []
+    size = 0
+    for section in reader.iter_sections():
+        runs.extend(section)
+        size += sum(len(text) for text, _tag_names in section)
+        if size >= LOAD_CHUNK_SIZE:
+            yield runs
+            runs = []
+            size = 0
+    if runs:
+        yield runs
+
+def _replace_entity(m):
+    if m.group(1):
+        raise LoadError("Got a charref %r and not expecting it."
+                        % m.group(2))
+    try:
+        return unichr(name2codepoint[m.group(2)])
+    except KeyError:
+        raise LoadError("Unknown entity %r" % m.group(2))
+
+def iter_history_runs_chunks(f, data):
+    """
+    Read the rest of a DreamPie history file, after read_history_header
+    returned data. Yield lists of runs of (text, tag_names), with about
+    LOAD_CHUNK_SIZE characters in each.
+    """
+    cur_tags = []
+    runs = []
+    size = 0
+    is_eof = False
+    while not is_eof:
+        s = f.read(LOAD_READ_SIZE)
+        if s:
+            data += s
+            # Leave what comes after the last '<' for the next time, since it
+            # may be an incomplete tag.
+            end = data.rfind('<')
+            if end == -1:
+                continue
         else:
-            if tag == 'span':
-                if 'class' not in attrs:
-                    raise LoadError("<span> without a 'class' attribute")
-                self.cur_tags.append(attrs['class'])
-    
-    def handle_endtag(self, tag):
-        if tag == 'span':
-            if not self.cur_tags:
-                raise LoadError("Too many </span> tags")
-            self.cur_tags.pop()
-    
-    def insert(self, data):
-        tb = self.textbuffer
-        leftmark = self.leftmark; rightmark = self.rightmark
-        # For some reasoin, insert_with_tags_by_name marks everything with the
-        # message tag. So we do it all by ourselves...
-        tb.insert(tb.get_iter_at_mark(leftmark), data)
-        leftit = tb.get_iter_at_mark(leftmark)
-        rightit = tb.get_iter_at_mark(rightmark)
-        tb.remove_all_tags(leftit, rightit)
-        for tag in self.cur_tags:
-            tb.apply_tag_by_name(tag, leftit, rightit)
-        tb.move_mark(leftmark, rightit)
-
-    def handle_data(self, data):
-        if self.reached_body:
-            self.insert(data.decode('utf8'))
-    
-    def handle_charref(self, name):
-        raise LoadError("Got a charref %r and not expecting it." % name)
-    
-    def handle_entityref(self, name):
-        if self.reached_body:
-            self.insert(unichr(name2codepoint[name]))
-    
-    def close(self):
-        HTMLParser.close(self)
+            is_eof = True
+            end = len(data)
         
-        tb = self.textbuffer
-        tb.delete_mark(self.leftmark)
-        tb.delete_mark(self.rightmark)
+        for m in _token_re.finditer(data, 0, end):
+            name, span_end, _other_tag, text = m.groups()
+            if text is not None:
+                try:
+                    text = text.decode('utf8')
+                except UnicodeDecodeError, e:
+                    raise LoadError("Invalid text in history file: %s" % e)
+                if '&' in text:
+                    text = _entity_re.sub(_replace_entity, text)
+                tag_names = tuple(cur_tags)
+                if runs and runs[-1][1] == tag_names:
+                    runs[-1] = (runs[-1][0] + text, tag_names)
+                else:
+                    runs.append((text, tag_names))
+                size += len(text)
+            elif name is not None:
+                cur_tags.append(name)
+            elif span_end is not None:
+                if not cur_tags:
+                    raise LoadError("Too many </span> tags")
+                cur_tags.pop()
+            # Other tags are ignored
+        data = data[end:]
+        
+        if size >= LOAD_CHUNK_SIZE or (is_eof and runs):
+            yield runs
+            runs = []
+            size = 0
+
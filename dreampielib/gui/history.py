@@ -17,42 +17,312 @@
 
 __all__ = ['History']
 
-from zlib import adler32 as hash_cmd
+from bisect import bisect_left, insort
 
 from .tags import COMMAND, PROMPT
 from .common import beep, get_text
 
-# In order to filter out repeating commands, we store the number of times a
-# command was encountered. To save memory, we only map the hash of a command
-# to a number. The docs say that adler32 is a fast checksum function. I think
-# that 32 bits should be enough (you'll get a collision if you have 2**16
-# commands, and even that will just mean that a command isn't retreived).
-# To ease debugging, uncomment this:
-# hash_cmd = lambda s: s
+class CommandIndex(object):
+    """
+    An index of the commands in the text buffer, so that recalling commands
+    doesn't require searching the text buffer.
+    """
+    # self.commands is a list of [mark, command, first_line] lists, in the
+    # order of the text buffer. The mark is at the beginning of the COMMAND
+    # region, and has right gravity so that output written right before a
+    # prompt won't move it away from the command. Empty commands (prompts
+    # without a command) aren't indexed.
+    # Commands which were paged out by the scrollback stay in the index, with
+    # None instead of a mark, so that they can be recalled without loading
+    # them. They come after the commands before the scrollback placeholder,
+    # and self.pages has the number of commands in each page, like
+    # scrollback.pages. self.paged_serial is the serial of the first one.
+    # The serial of a command is its index in self.commands plus
+    # self.first_serial. Commands are only added and removed at the ends of
+    # the list, so serials don't change, and self.first_lines, a sorted list
+    # of (first_line, serial) tuples used to find commands with a prefix by
+    # bisection, is updated instead of rebuilt.
+    def __init__(self, textbuffer, get_command, scrollback):
+        self.textbuffer = textbuffer
+        # A function which gets an iterator at the beginning of a COMMAND
+        # region, and returns the command.
+        self.get_command = get_command
+        self.scrollback = scrollback
+        self.command_tag = textbuffer.get_tag_table().lookup(COMMAND)
+        self.commands = []
+        self.first_serial = 0
+        self.first_lines = []
+        self.pages = []
+        self.paged_serial = 0
+
+        scrollback.paged_out.append(self._on_paged_out)
+        scrollback.paged_in.append(self._on_paged_in)
+
+    def _make_entry(self, it):
+        """
+        Return an entry for the command which starts at it, or None if it is
+        empty.
+        """
+        command = self.get_command(it).strip()
+        if not command:
+            return None
+        first_line = command.split('\n', 1)[0].strip()
+        mark = self.textbuffer.create_mark(None, it, left_gravity=False)
+        return [mark, command, first_line]
+
+    def _scan(self, start, end):
+        """Return entries for the commands which start in [start, end)."""
+        command = self.command_tag
+        entries = []
+        it = start.copy()
+        if not it.begins_tag(command):
+            it.forward_to_tag_toggle(command)
+        while it.begins_tag(command) and it.compare(end) < 0:
+            entry = self._make_entry(it)
+            if entry is not None:
+                entries.append(entry)
+            it.forward_to_tag_toggle(command)
+            it.forward_to_tag_toggle(command)
+        return entries
+
+    def _append(self, entries):
+        serial = self.first_serial + len(self.commands)
+        for entry in entries:
+            insort(self.first_lines, (entry[2], serial))
+            serial += 1
+        self.commands.extend(entries)
+
+    def _remove(self, start, end):
+        """Remove the commands [start, end) from first_lines."""
+        tb = self.textbuffer
+        first_lines = self.first_lines
+        for i in xrange(start, end):
+            mark, _command, first_line = self.commands[i]
+            if mark is not None:
+                tb.delete_mark(mark)
+            j = bisect_left(first_lines, (first_line, self.first_serial + i))
+            del first_lines[j]
+
+    def _get_paged_start(self):
+        """Return the index of the first paged out command."""
+        return self.paged_serial - self.first_serial
+
+    def add(self, it):
+        """
+        Add the command which starts at it. It should be after all the
+        commands which were already added.
+        """
+        entry = self._make_entry(it)
+        if entry is None:
+            return None
+        self._append([entry])
+        return entry[1]
+
+    def add_last(self):
+        """
+        Add the last command in the text buffer. Return it, or None if it is
+        empty.
+        """
+        command = self.command_tag
+        it = self.textbuffer.get_end_iter()
+        it.backward_to_tag_toggle(command)
+        if it.ends_tag(command):
+            it.backward_to_tag_toggle(command)
+        if it.begins_tag(command):
+            return self.add(it)
+
+    def rebuild(self):
+        """
+        Index all the commands in the text buffer. The commands which are
+        paged out are kept.
+        """
+        tb = self.textbuffer
+        paged = [entry for entry in self.commands if entry[0] is None]
+        for mark, _command, _first_line in self.commands:
+            if mark is not None:
+                tb.delete_mark(mark)
+        if len(paged) != sum(self.pages):
+            # Shouldn't happen. Commands can't be recalled from the
+            # scrollback pages anyway.
+            paged = []
+            self.pages = [0] * len(self.pages)
+        older = self._scan(tb.get_start_iter(),
+                           self.scrollback.get_placeholder_start())
+        resident = self._scan(tb.get_iter_at_mark(self.scrollback.mark),
+                              tb.get_end_iter())
+        self.commands = older + paged + resident
+        self.first_serial = 0
+        self.paged_serial = len(older)
+        self.first_lines = sorted(
+            (first_line, i)
+            for i, (_mark, _command, first_line) in enumerate(self.commands))
+
+    def prepend(self, end):
+        """
+        Called after commands were inserted at the beginning of the text
+        buffer, before end.
+        """
+        if (self.scrollback.pages
+            and end.compare(self.scrollback.get_placeholder_start()) > 0):
+            # Some of them were paged out while they were inserted
+            self.rebuild()
+            return
+        entries = self._scan(self.textbuffer.get_start_iter(), end)
+        self.first_serial -= len(entries)
+        serial = self.first_serial
+        for entry in entries:
+            insort(self.first_lines, (entry[2], serial))
+            serial += 1
+        self.commands[:0] = entries
+
+    def remove_before(self, it):
+        """
+        Called before the text before it is deleted, after
+        scrollback.forget_before.
+        """
+        n = self.find(it.get_offset() - 1) + 1
+        self._remove(0, n)
+        del self.commands[:n]
+        self.first_serial += n
+        if not self.scrollback.pages:
+            self.pages = []
+
+    def reindex_from(self, it):
+        """
+        Called after text at the end of the text buffer, from it, was changed.
+        """
+        tb = self.textbuffer
+        commands = self.commands
+        i = self.find(it.get_offset())
+        if i == -1:
+            i = 0
+            start = it
+        elif commands[i][0] is None:
+            # Shouldn't happen - it's in the resident text.
+            self.rebuild()
+            return
+        else:
+            start = tb.get_iter_at_mark(commands[i][0])
+        self._remove(i, len(commands))
+        del commands[i:]
+        self._append(self._scan(start, tb.get_end_iter()))
+
+    def _on_paged_out(self, start, end):
+        tb = self.textbuffer
+        commands = self.commands
+        i = self.find(start.get_offset() - 1) + 1
+        j = self.find(end.get_offset() - 1) + 1
+        if not self.pages:
+            self.paged_serial = self.first_serial + i
+        for entry in commands[i:j]:
+            if entry[0] is not None:
+                tb.delete_mark(entry[0])
+                entry[0] = None
+        self.pages.append(j - i)
+
+    def _on_paged_in(self, start, end):
+        tb = self.textbuffer
+        n = self.pages.pop()
+        i = self._get_paged_start() + sum(self.pages)
+        entries = self._scan(start, end)
+        if len(entries) != n:
+            # Commands which were inserted while the page was paged out
+            # weren't indexed.
+            for mark, _command, _first_line in entries:
+                tb.delete_mark(mark)
+            self._remove(i, i + n)
+            del self.commands[i:i + n]
+            self.rebuild()
+            return
+        for k, entry in enumerate(entries):
+            self.commands[i + k][0] = entry[0]
+
+    def iter_matches(self, prefix, min_len):
+        """
+        Yield the commands whose first line starts with prefix and is at
+        least min_len chars long, newest first.
+        """
+        if not prefix:
+            serials = xrange(self.first_serial + len(self.commands) - 1,
+                             self.first_serial - 1, -1)
+        else:
+            first_lines = self.first_lines
+            serials = []
+            i = bisect_left(first_lines, (prefix,))
+            while (i < len(first_lines)
+                   and first_lines[i][0].startswith(prefix)):
+                serials.append(first_lines[i][1])
+                i += 1
+            serials.sort(reverse=True)
+        for serial in serials:
+            i = serial - self.first_serial
+            if not 0 <= i < len(self.commands):
+                # Removed since we started
+                continue
+            _mark, command, first_line = self.commands[i]
+            if len(first_line) >= min_len:
+                yield command
+
+    def get_offset(self, i):
+        """
+        Return the offset of command i. Paged out commands are at the
+        beginning of the scrollback placeholder.
+        """
+        mark = self.commands[i][0]
+        if mark is not None:
+            return self.textbuffer.get_iter_at_mark(mark).get_offset()
+        else:
+            return self.scrollback.get_placeholder_start().get_offset()
+
+    def find(self, offset):
+        """
+        Return the index of the last command which starts at or before
+        offset, or -1 if there isn't one.
+        """
+        lo = 0; hi = len(self.commands)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.get_offset(mid) <= offset:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo - 1
 
 class History(object):
     """
     Manage moving between commands on the text view, and recalling commands
     in the source view.
     """
-    def __init__(self, textview, sourceview, sv_changed, config):
+    def __init__(self, textview, sourceview, sv_changed, config, scrollback,
+                 hist_db):
         self.textview = textview
         self.textbuffer = textview.get_buffer()
         self.sourceview = sourceview
         self.sourcebuffer = sourceview.get_buffer()
         sv_changed.append(self._on_sv_changed)
         self.recall_1_char_commands = config.get_bool('recall-1-char-commands')
+        # A HistoryDB with commands from previous sessions, or None
+        self.hist_db = hist_db
 
-        tb = self.textbuffer
+        self.index = CommandIndex(self.textbuffer, self.iter_get_command,
+                                  scrollback)
 
         self.hist_prefix = None
-        # Map a command hash to the number of times it has occured in the search.
-        # This lets us avoid showing the same command twice.
-        self.hist_count = {}
+        # The commands recalled so far with the current prefix, without
+        # repeating commands, and the index in that list of the command in the
+        # source buffer (-1 if it's the prefix).
+        self.matches = []
+        self.recalled = set()
+        self.match_pos = -1
+        # An iterator over the matching commands which weren't examined yet -
+        # first those in the text buffer and then those in the database.
+        self.match_iter = iter([])
+        self.is_searching_db = False
         self.sb_changed = True
         # A handler_id when sb_changed is False.
         self.changed_handler_id = None
-        self.hist_mark = tb.create_mark('history', tb.get_end_iter(), False)
+
+        self.index.rebuild()
 
     def _on_sv_changed(self, new_sv):
         if self.changed_handler_id:
@@ -74,6 +344,78 @@ class History(object):
         self.sourcebuffer.disconnect(self.changed_handler_id)
         self.changed_handler_id = None
 
+    def add_last_command(self, persist=False):
+        """
+        Called after a command or stdin was written to the text buffer.
+        If persist is True, the command is also stored in the database.
+        """
+        command = self.index.add_last()
+        if persist and command and self.hist_db is not None:
+            self.hist_db.append(command)
+
+    def _on_index_changed(self):
+        # Commands which were already recalled will be skipped.
+        self.match_iter = self._iter_buffer_matches()
+        self.is_searching_db = False
+
+    def on_history_loaded(self, end):
+        """Called after history was inserted at the beginning, before end."""
+        self.index.prepend(end)
+        self._on_index_changed()
+
+    def on_history_discarded(self, it):
+        """
+        Called before the history before it is deleted, after
+        scrollback.forget_before.
+        """
+        self.index.remove_before(it)
+        self._on_index_changed()
+
+    def on_end_changed(self, it):
+        """Called after text at the end of the text buffer, from it, changed."""
+        self.index.reindex_from(it)
+        self._on_index_changed()
+
+    def _get_min_len(self):
+        return 1 if self.recall_1_char_commands else 3
+
+    def _iter_buffer_matches(self):
+        return self.index.iter_matches(self.hist_prefix or '',
+                                       self._get_min_len())
+
+    def _iter_db_matches(self):
+        prefix = self.hist_prefix or ''
+        min_len = self._get_min_len()
+        for command in self.hist_db.iter_commands():
+            first_line = command.split('\n', 1)[0].strip()
+            if first_line.startswith(prefix) and len(first_line) >= min_len:
+                yield command
+
+    def _reset_matches(self):
+        self.matches = []
+        self.recalled = set()
+        self.match_pos = -1
+        self.match_iter = self._iter_buffer_matches()
+        self.is_searching_db = False
+
+    def _find_next_match(self):
+        """
+        Add the next command which matches the prefix and wasn't recalled yet
+        to self.matches. Return False if there isn't one.
+        """
+        while True:
+            for command in self.match_iter:
+                if command not in self.recalled:
+                    self.recalled.add(command)
+                    self.matches.append(command)
+                    return True
+            # Commands which were paged out by the scrollback are in the
+            # index too, so there's no need to load them.
+            if self.is_searching_db or self.hist_db is None:
+                return False
+            self.match_iter = self._iter_db_matches()
+            self.is_searching_db = True
+
     def iter_get_command(self, it, only_first_line=False):
         """Get a textiter placed inside (or at the end of) a COMMAND tag.
         Return the text of the tag which doesn't have the PROMPT tag.
@@ -115,6 +457,7 @@ class History(object):
         tb = self.textbuffer
         sb = self.sourcebuffer
         command = tb.get_tag_table().lookup(COMMAND)
+        commands = self.index.commands
 
         sel = tb.get_selection_bounds()
         if not sel:
@@ -125,20 +468,24 @@ class History(object):
             s = self.iter_get_command(it).strip()
         else:
             # Copy all commands which intersect with the selection
-            it, end_it = sel
-            s = ''
-            if it.has_tag(command) or it.ends_tag(command):
-                s += self.iter_get_command(it).strip() + '\n'
-                if not it.ends_tag(command):
-                    it.forward_to_tag_toggle(command)
-            assert not it.has_tag(command)
-            while True:
-                it.forward_to_tag_toggle(command)
-                if it.compare(end_it) >= 0:
-                    break
-                s += self.iter_get_command(it).strip() + '\n'
-                it.forward_to_tag_toggle(command)
-            s = s.strip()
+            start_it, end_it = sel
+            i = self.index.find(start_it.get_offset())
+            if start_it.has_tag(command) or start_it.ends_tag(command):
+                it = start_it.copy()
+                if not it.begins_tag(command):
+                    it.backward_to_tag_toggle(command)
+                if i == -1 or self.index.get_offset(i) != it.get_offset():
+                    # The selection starts in an empty prompt
+                    i += 1
+            else:
+                i += 1
+            end_offset = end_it.get_offset()
+            cmds = []
+            while (i < len(commands)
+                   and self.index.get_offset(i) < end_offset):
+                cmds.append(commands[i][1])
+                i += 1
+            s = '\n'.join(cmds)
         if not s:
             beep()
             return True
@@ -165,9 +512,7 @@ class History(object):
             self.textview.scroll_mark_onscreen(insert)
 
         elif self.sourceview.is_focus():
-            tb = self.textbuffer
             sb = self.sourcebuffer
-            command = tb.get_tag_table().lookup(COMMAND)
             if self.sb_changed:
                 if sb.get_end_iter().get_line() != 0:
                     # Don't allow prefixes of more than one line
@@ -175,38 +520,16 @@ class History(object):
                     return
                 self.hist_prefix = get_text(sb, sb.get_start_iter(),
                                             sb.get_end_iter())
-                self.hist_count = {}
+                self._reset_matches()
                 self._track_change()
-                tb.move_mark(self.hist_mark, tb.get_end_iter())
-            it = tb.get_iter_at_mark(self.hist_mark)
-            if it.is_start():
+            if (self.match_pos + 1 == len(self.matches)
+                and not self._find_next_match()):
                 beep()
                 return
-            while True:
-                it.backward_to_tag_toggle(command)
-                if it.ends_tag(command):
-                    it.backward_to_tag_toggle(command)
-                if not it.begins_tag(command):
-                    beep()
-                    break
-                first_line = self.iter_get_command(it, only_first_line=True).strip()
-                if (first_line
-                    and first_line.startswith(self.hist_prefix)
-                    and (len(first_line) > 2 or self.recall_1_char_commands)):
-                    
-                    cmd = self.iter_get_command(it).strip()
-                    cmd_hash = hash_cmd(cmd)
-                    tb.move_mark(self.hist_mark, it)
-                    count = self.hist_count.get(cmd_hash, 0) + 1
-                    self.hist_count[cmd_hash] = count
-                    if count == 1:
-                        sb.set_text(cmd)
-                        self._track_change()
-                        sb.place_cursor(sb.get_end_iter())
-                        break
-                if it.is_start():
-                    beep()
-                    return
+            self.match_pos += 1
+            sb.set_text(self.matches[self.match_pos])
+            self._track_change()
+            sb.place_cursor(sb.get_end_iter())
 
         else:
             beep()
@@ -225,45 +548,22 @@ class History(object):
             self.textview.scroll_mark_onscreen(insert)
 
         elif self.sourceview.is_focus():
-            tb = self.textbuffer
             sb = self.sourcebuffer
-            command = tb.get_tag_table().lookup(COMMAND)
             if self.sb_changed:
                 beep()
                 return
-            it = tb.get_iter_at_mark(self.hist_mark)
-            passed_one = False
-            while True:
-                if not it.begins_tag(command):
-                    # Return the source buffer to the prefix and everything
-                    # to initial state.
-                    sb.set_text(self.hist_prefix)
-                    sb.place_cursor(sb.get_end_iter())
-                    # Since we change the text and not called _track_change,
-                    # it's like the user did it and hist_prefix is not longer
-                    # meaningful.
-                    break
-                first_line = self.iter_get_command(it, only_first_line=True).strip()
-                if (first_line
-                    and first_line.startswith(self.hist_prefix)
-                    and (len(first_line) > 2 or self.recall_1_char_commands)):
-                    
-                    cmd = self.iter_get_command(it).strip()
-                    cmd_hash = hash_cmd(cmd)
-                    tb.move_mark(self.hist_mark, it)
-                    if self.hist_count[cmd_hash] == 1:
-                        if passed_one:
-                            sb.set_text(cmd)
-                            self._track_change()
-                            sb.place_cursor(sb.get_end_iter())
-                            break
-                        else:
-                            passed_one = True
-                    self.hist_count[cmd_hash] -= 1
-
-                it.forward_to_tag_toggle(command)
-                it.forward_to_tag_toggle(command)
-                
+            self.match_pos -= 1
+            if self.match_pos >= 0:
+                sb.set_text(self.matches[self.match_pos])
+                self._track_change()
+            else:
+                # Return the source buffer to the prefix and everything
+                # to initial state.
+                sb.set_text(self.hist_prefix)
+                # Since we change the text and not called _track_change,
+                # it's like the user did it and hist_prefix is not longer
+                # meaningful.
+            sb.place_cursor(sb.get_end_iter())
 
         else:
             beep()
@@ -15,7 +15,7 @@
 # You should have received a copy of the GNU General Public License
 # along with DreamPie.  If not, see <http://www.gnu.org/licenses/>.
 
-__all__ = ['Output']
+__all__ = ['Output', 'add_breaks']
 
 import re
 from StringIO import StringIO
@@ -32,6 +32,34 @@ ansi_escape_re = re.compile(r'\x1b\[[^@-~]*?[@-~]')
 # ignore when copying.
 BREAK_LEN = 1600
 
+def add_breaks(data, col):
+    """
+    Return data with '\r' chars added so that no line is longer than
+    BREAK_LEN chars. col is the column where data will be inserted.
+    """
+    f = StringIO()
+
+    pos = 0
+    copied_pos = 0
+    next_newline = data.find('\n', pos)
+    if next_newline == -1:
+        next_newline = len(data)
+    while pos < len(data):
+        if next_newline - pos + col > BREAK_LEN:
+            pos = pos + BREAK_LEN - col
+            f.write(data[copied_pos:pos])
+            f.write('\r')
+            copied_pos = pos
+            col = 0
+        else:
+            pos = next_newline + 1
+            col = 0
+            next_newline = data.find('\n', pos)
+            if next_newline == -1:
+                next_newline = len(data)
+    f.write(data[copied_pos:])
+    return f.getvalue()
+
 class Output(object):
     """
     Manage writing output to the text view.
@@ -137,31 +165,8 @@ class Output(object):
             data = data[cr_pos+1:]
 
         if addbreaks:
-            # We DO use \r characters as linebreaks after BREAK_LEN chars, which
-            # are not copied.
-            f = StringIO()
-    
-            pos = 0
-            copied_pos = 0
             col = tb.get_iter_at_mark(self.mark).get_line_offset()
-            next_newline = data.find('\n', pos)
-            if next_newline == -1:
-                next_newline = len(data)
-            while pos < len(data):
-                if next_newline - pos + col > BREAK_LEN:
-                    pos = pos + BREAK_LEN - col
-                    f.write(data[copied_pos:pos])
-                    f.write('\r')
-                    copied_pos = pos
-                    col = 0
-                else:
-                    pos = next_newline + 1
-                    col = 0
-                    next_newline = data.find('\n', pos)
-                    if next_newline == -1:
-                        next_newline = len(data)
-            f.write(data[copied_pos:])
-            data = f.getvalue()
+            data = add_breaks(data, col)
 
         it = tb.get_iter_at_mark(self.mark)
         tb.insert_with_tags_by_name(it, data, OUTPUT, *tag_names)
@@ -0,0 +1,323 @@
+# Copyright 2012 Noam Yorav-Raphael
+#
+# This file is part of DreamPie.
+# 
+# DreamPie is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# DreamPie is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with DreamPie.  If not, see <http://www.gnu.org/licenses/>.
+
+__all__ = ['Scrollback']
+
+import tempfile
+import marshal
+
+try:
+    from glib import idle_add
+except ImportError:
+    # In PyGObject 2.14, it's in gobject.
+    from gobject import idle_add
+
+from .tags import COMMAND, SCROLLBACK
+from .tag_runs import get_tag_runs, insert_tag_runs
+
+_ = lambda s: s
+
+class Scrollback(object):
+    """
+    Keep only the last sections of the history in the text buffer, and page
+    older sections out to a temporary file.
+    
+    Sections are paged out in pages of several sections. The pages are stored
+    in the file one after the other, and are loaded back in reverse order -
+    the most recent page first - when the user double-clicks the placeholder
+    message which replaces them, scrolls to the top, or searches for something
+    which isn't found in the text buffer.
+    """
+    # The text buffer looks like this:
+    #
+    # (Older text which was never paged out, for example loaded history)
+    # [n older sections are stored on disk. Double-click to load them]
+    # (Resident sections)
+    #
+    # The placeholder message is tagged with SCROLLBACK, and self.mark is
+    # right after it. When nothing was paged out, there's no placeholder, and
+    # self.mark is just where the next page will start.
+    def __init__(self, textview, vadj, max_sections):
+        self.textview = textview
+        self.textbuffer = tb = textview.get_buffer()
+        self.vadj = vadj
+        # Maximum number of sections to keep in the text buffer. 0 means
+        # no limit.
+        self.max_sections = max_sections
+        
+        tt = tb.get_tag_table()
+        self.command_tag = tt.lookup(COMMAND)
+        self.scrollback_tag = tt.lookup(SCROLLBACK)
+        self.mark = tb.create_mark('scrollback', tb.get_start_iter(),
+                                   left_gravity=True)
+        
+        # The file is created when the first page is paged out
+        self.file = None
+        # A list of (offset, length, n_sections) of the pages in the file.
+        self.pages = []
+        # While pages are held (see hold_pages), pages which are loaded or
+        # forgotten stay in the file, so they can still be read.
+        self.n_holds = 0
+        # Number of sections added since we last checked if there are too many.
+        self.n_added = 0
+        # Lists of callbacks to call with the (start, end) iterators of
+        # sections which are paged out, before they are deleted, and of
+        # sections which were paged in, right after they were inserted.
+        self.paged_out = []
+        self.paged_in = []
+        # A list of callbacks to call before sections are paged out or in
+        self.before_paging = []
+        # True while the text buffer is changed because of paging, so others
+        # can tell that the history itself didn't change.
+        self.is_paging = False
+        
+        self.last_vadj_value = vadj.value
+        self.is_load_scheduled = False
+        vadj.connect('value-changed', self._on_vadj_value_changed)
+    
+    def _get_page_sections(self):
+        return max(self.max_sections // 4, 1)
+    
+    def get_n_paged_sections(self):
+        return sum(n_sections for _offset, _length, n_sections in self.pages)
+    
+    def on_section_added(self):
+        """
+        Called after a command was written. If there are too many sections,
+        page out the oldest ones.
+        """
+        if self.max_sections <= 0:
+            return
+        # We count the sections only once in a page, so that this is cheap.
+        self.n_added += 1
+        page_sections = self._get_page_sections()
+        if self.n_added < page_sections:
+            return
+        self.n_added = 0
+        
+        tb = self.textbuffer
+        command = self.command_tag
+        resident_start = tb.get_iter_at_mark(self.mark)
+        it = tb.get_end_iter()
+        n_sections = 0
+        cut_it = None
+        while n_sections < self.max_sections + page_sections:
+            if (not it.backward_to_tag_toggle(command)
+                or it.compare(resident_start) < 0):
+                return
+            if it.begins_tag(command):
+                n_sections += 1
+                if n_sections == self.max_sections:
+                    cut_it = it.copy()
+        # Page out everything before cut_it. We count the sections up to the
+        # beginning of the resident text only to report their number.
+        while (it.backward_to_tag_toggle(command)
+               and it.compare(resident_start) >= 0):
+            if it.begins_tag(command):
+                n_sections += 1
+        self._page_out(resident_start, cut_it,
+                       n_sections - self.max_sections)
+    
+    def _page_out(self, start, end, n_sections):
+        tb = self.textbuffer
+        for cb in self.before_paging:
+            cb()
+        data = marshal.dumps(get_tag_runs(tb, start, end))
+        for cb in self.paged_out:
+            cb(start, end)
+        if self.file is None:
+            self.file = tempfile.TemporaryFile(prefix='dreampie-scrollback-')
+        self.file.seek(0, 2)
+        offset = self.file.tell()
+        self.file.write(data)
+        self.pages.append((offset, len(data), n_sections))
+        
+        # Paging out doesn't change the history, so we keep the modified flag.
+        was_modified = tb.get_modified()
+        self.is_paging = True
+        tb.delete(start, end)
+        self._update_placeholder()
+        self.is_paging = False
+        tb.set_modified(was_modified)
+    
+    def _read_page(self, page):
+        offset, length, _n_sections = page
+        self.file.seek(offset)
+        return marshal.loads(self.file.read(length))
+    
+    def get_placeholder_start(self):
+        """
+        Return an iterator at the beginning of the placeholder message, or at
+        self.mark if there isn't one.
+        """
+        it = self.textbuffer.get_iter_at_mark(self.mark)
+        if it.ends_tag(self.scrollback_tag):
+            it.backward_to_tag_toggle(self.scrollback_tag)
+        return it
+    
+    def _update_placeholder(self):
+        """Replace the placeholder message with an up-to-date one."""
+        tb = self.textbuffer
+        start = self.get_placeholder_start()
+        it = tb.get_iter_at_mark(self.mark)
+        if not start.equal(it):
+            tb.delete(start, it)
+            it = tb.get_iter_at_mark(self.mark)
+        if self.pages:
+            msg = _("[%d older sections are stored on disk. "
+                    "Double-click to load them]\n") % self.get_n_paged_sections()
+            offset = it.get_offset()
+            tb.insert_with_tags_by_name(it, msg, SCROLLBACK)
+            tb.move_mark(self.mark, tb.get_iter_at_offset(offset + len(msg)))
+    
+    def load_page(self):
+        """
+        Load the most recent page back into the text buffer.
+        Return True if a page was loaded, False if there was nothing to load.
+        """
+        if not self.pages:
+            return False
+        tb = self.textbuffer
+        page = self.pages.pop()
+        runs = self._read_page(page)
+        if self.n_holds == 0:
+            self.file.truncate(page[0])
+        
+        for cb in self.before_paging:
+            cb()
+        was_modified = tb.get_modified()
+        self.is_paging = True
+        # self.mark has left gravity, so it stays before the inserted text.
+        start_offset = tb.get_iter_at_mark(self.mark).get_offset()
+        n_chars = tb.get_char_count()
+        insert_tag_runs(tb, tb.get_iter_at_mark(self.mark), runs)
+        end_offset = start_offset + tb.get_char_count() - n_chars
+        for cb in self.paged_in:
+            cb(tb.get_iter_at_offset(start_offset),
+               tb.get_iter_at_offset(end_offset))
+        self._update_placeholder()
+        self.is_paging = False
+        tb.set_modified(was_modified)
+        return True
+    
+    def forget_before(self, it):
+        """
+        Called before the text before it is deleted. If the placeholder is
+        deleted, forget the paged out sections.
+        """
+        tb = self.textbuffer
+        if self.pages and it.compare(tb.get_iter_at_mark(self.mark)) >= 0:
+            del self.pages[:]
+            if self.n_holds == 0:
+                self.file.truncate(0)
+    
+    def is_placeholder(self, it):
+        return it.has_tag(self.scrollback_tag)
+    
+    def hold_pages(self):
+        """
+        Keep the pages which are currently in the file until release_pages
+        is called, so that an iterator returned by iter_paged_runs can
+        still read them after they were loaded or forgotten.
+        """
+        self.n_holds += 1
+    
+    def release_pages(self):
+        """
+        Called when pages held by hold_pages aren't needed anymore. When
+        nothing holds them, the space of pages which were loaded or
+        forgotten is reclaimed.
+        """
+        self.n_holds -= 1
+        if self.n_holds > 0 or self.file is None:
+            return
+        if not self.pages:
+            self.file.truncate(0)
+            return
+        offset, length, _n_sections = self.pages[-1]
+        self.file.truncate(offset + length)
+        # Pages which were paged out while others were held may follow
+        # unused space. If most of the file is unused, copy the pages to a
+        # new file.
+        used = sum(length for _offset, length, _n_sections in self.pages)
+        if used * 2 < offset + length:
+            new_file = tempfile.TemporaryFile(prefix='dreampie-scrollback-')
+            new_pages = []
+            for offset, length, n_sections in self.pages:
+                self.file.seek(offset)
+                new_pages.append((new_file.tell(), length, n_sections))
+                new_file.write(self.file.read(length))
+            self.file.close()
+            self.file = new_file
+            self.pages = new_pages
+    
+    def iter_paged_runs(self):
+        """
+        Return an iterator over the runs of the sections which are currently
+        paged out, oldest first. The pages are read when the iterator reaches
+        them. If they may be loaded or forgotten before that, hold them with
+        hold_pages.
+        """
+        pages = self.pages[:]
+        return (run for page in pages for run in self._read_page(page))
+    
+    def search_backward(self, search_str, flags):
+        """
+        Load pages until search_str is found in one of them.
+        Return the match, as returned by TextIter.backward_search, or None if
+        it wasn't found.
+        """
+        tb = self.textbuffer
+        while self.pages:
+            # This mark will stay after the loaded text
+            end_mark = tb.create_mark(None, tb.get_iter_at_mark(self.mark),
+                                      left_gravity=False)
+            self.load_page()
+            end_it = tb.get_iter_at_mark(end_mark)
+            tb.delete_mark(end_mark)
+            match = end_it.backward_search(search_str, flags,
+                                           tb.get_iter_at_mark(self.mark))
+            if match is not None:
+                return match
+        return None
+    
+    def load_page_keep_view(self):
+        """Load a page, and scroll so that the text which was at the top of
+        the view stays there."""
+        tb = self.textbuffer
+        top_mark = tb.create_mark(None, tb.get_iter_at_mark(self.mark),
+                                  left_gravity=False)
+        if self.load_page():
+            self.textview.scroll_to_mark(top_mark, 0, True, 0, 0)
+        tb.delete_mark(top_mark)
+    
+    def _on_vadj_value_changed(self, vadj):
+        # Load a page when the user scrolls up to the top
+        if (self.pages and not self.is_load_scheduled
+            and vadj.value == vadj.lower and self.last_vadj_value != vadj.lower):
+            idle_add(self._on_idle_load)
+            self.is_load_scheduled = True
+        self.last_vadj_value = vadj.value
+    
+    def _on_idle_load(self):
+        # Callback function
+        try:
+            self.is_load_scheduled = False
+            if self.vadj.value == self.vadj.lower:
+                self.load_page_keep_view()
+        finally:
+            return False
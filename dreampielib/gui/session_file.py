@@ -0,0 +1,314 @@
+# Copyright 2012 Noam Yorav-Raphael
+#
+# This file is part of DreamPie.
+# 
+# DreamPie is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# DreamPie is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with DreamPie.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+The DreamPie session format - a compact binary alternative to the HTML
+history files, which is fast to write and to load.
+"""
+
+__all__ = ['SESSION_EXT', 'FormatError', 'is_session_file',
+           'iter_sections', 'iter_session_chunks', 'SessionReader']
+
+import struct
+import zlib
+
+from ..common import brine
+from .tags import COMMAND
+
+# A session file looks like this:
+#
+# MAGIC
+# A section record for each section
+# An index record
+# The trailer: the offset of the index record, packed with TRAILER_FORMAT,
+# followed by END_MAGIC.
+#
+# Each record starts with a header, packed with RECORD_FORMAT, which is the
+# record type and the length of the data which follows. The data is
+# compressed with zlib. The data of a section record is the brined tuple
+# of its (text, tag_names) runs, where text is unicode and tag_names is a
+# tuple of unicode tag names. The data of the index record is the brined
+# tuple of the offsets of the section records, so any section can be found
+# without reading the others.
+# brine, and not marshal, is used since session files may come from anywhere,
+# and brine can only load simple types.
+# The records can also be read one after the other without the index, so a
+# file without the index and the trailer (like the autosave journal) can
+# still be read. An incomplete record at the end is ignored.
+# The autosave journal may also have replace records, which replace sections
+# written before them. Their data is the brined tuple
+# (from_end, n, n_old, sections): the n_old sections after the first n
+# sections, or before the last n sections if from_end is true, are replaced
+# by the given sections. If n_old is None, all of them up to the other end
+# are replaced.
+MAGIC = 'DreamPie Session 2\n'
+END_MAGIC = '\nDreamPie Session End\n'
+RECORD_FORMAT = '<cI'
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+TRAILER_FORMAT = '<Q'
+TRAILER_SIZE = struct.calcsize(TRAILER_FORMAT) + len(END_MAGIC)
+SECTION = 'S'
+INDEX = 'I'
+REPLACE = 'R'
+
+SESSION_EXT = 'dreampie'
+
+# Records are yielded by iter_session_chunks in chunks of about this size
+CHUNK_SIZE = 256 * 1024
+
+class FormatError(Exception):
+    pass
+
+def is_session_file(f):
+    """Check if the file f is a session file. f is left at its beginning."""
+    f.seek(0)
+    r = (f.read(len(MAGIC)) == MAGIC)
+    f.seek(0)
+    return r
+
+def iter_sections(runs):
+    """
+    Split runs into sections. Yield lists of runs - the first one with the
+    runs before the first command, if there are any, and then one for each
+    command and the output after it.
+    """
+    section = []
+    was_command = False
+    for run in runs:
+        is_command = COMMAND in run[1]
+        if is_command and not was_command and section:
+            yield section
+            section = []
+        section.append(run)
+        was_command = is_command
+    if section:
+        yield section
+
+def pack_record(typ, obj):
+    data = zlib.compress(brine.dump(obj))
+    return struct.pack(RECORD_FORMAT, typ, len(data)) + data
+
+def _section_obj(section):
+    return tuple((unicode(text), tuple(unicode(name) for name in tag_names))
+                 for text, tag_names in section)
+
+def pack_section(section):
+    """Return a section record with the given list of runs."""
+    return pack_record(SECTION, _section_obj(section))
+
+def pack_replace(from_end, n, n_old, sections):
+    """Return a replace record. See the description of the format."""
+    return pack_record(REPLACE, (from_end, n, n_old,
+                                 tuple(_section_obj(section)
+                                       for section in sections)))
+
+def _is_section(obj):
+    if type(obj) is not tuple:
+        return False
+    for run in obj:
+        if (type(run) is not tuple or len(run) != 2
+            or type(run[0]) is not unicode or type(run[1]) is not tuple):
+            return False
+        for name in run[1]:
+            if type(name) is not unicode:
+                return False
+    return True
+
+def _is_replace(obj):
+    if type(obj) is not tuple or len(obj) != 4:
+        return False
+    from_end, n, n_old, sections = obj
+    if (type(from_end) is not bool or type(n) is not int or n < 0
+        or not (n_old is None or type(n_old) is int and n_old >= 0)
+        or type(sections) is not tuple):
+        return False
+    for section in sections:
+        if not _is_section(section):
+            return False
+    return True
+
+def iter_session_chunks(runs):
+    """
+    Yield a session file with the history given as runs of (text, tag_names),
+    as chunks of bytes.
+    """
+    offset = 0
+    parts = [MAGIC]
+    size = len(MAGIC)
+    offsets = []
+    for section in iter_sections(runs):
+        offsets.append(offset + size)
+        record = pack_section(section)
+        parts.append(record)
+        size += len(record)
+        if size >= CHUNK_SIZE:
+            yield ''.join(parts)
+            offset += size
+            parts = []
+            size = 0
+    index_offset = offset + size
+    parts.append(pack_record(INDEX, tuple(offsets)))
+    parts.append(struct.pack(TRAILER_FORMAT, index_offset))
+    parts.append(END_MAGIC)
+    yield ''.join(parts)
+
+class SessionReader(object):
+    """
+    Read sections from a session file. If end is given, only the records
+    before it are read.
+    """
+    def __init__(self, f, end=None):
+        self.f = f
+        self.end = end
+        # The offsets of the sections, once the index was read
+        self.offsets = None
+        f.seek(0)
+        if f.read(len(MAGIC)) != MAGIC:
+            raise FormatError("File is not a DreamPie session file.")
+
+    def _read_record(self, offset):
+        """
+        Read the record at offset. Return (type, obj, next_offset), or None
+        if the record is incomplete.
+        """
+        f = self.f
+        f.seek(offset)
+        header = f.read(RECORD_SIZE)
+        if len(header) < RECORD_SIZE:
+            return None
+        typ, length = struct.unpack(RECORD_FORMAT, header)
+        if self.end is not None and offset + RECORD_SIZE + length > self.end:
+            return None
+        data = f.read(length)
+        if len(data) < length:
+            return None
+        try:
+            obj = brine.load(zlib.decompress(data))
+        except (zlib.error, struct.error, ValueError, IndexError, KeyError,
+                TypeError), e:
+            raise FormatError("Corrupted record at offset %d: %s"
+                              % (offset, e))
+        if (typ == SECTION and not _is_section(obj)
+            or typ == REPLACE and not _is_replace(obj)):
+            raise FormatError("Corrupted record at offset %d" % offset)
+        return typ, obj, offset + RECORD_SIZE + length
+
+    def read_index(self):
+        """
+        Return a tuple with the offsets of the sections, read from the index.
+        Raise FormatError if the file has no index, like the autosave
+        journal.
+        """
+        if self.offsets is not None:
+            return self.offsets
+        f = self.f
+        f.seek(0, 2)
+        size = f.tell()
+        if size < len(MAGIC) + TRAILER_SIZE:
+            raise FormatError("File has no index.")
+        f.seek(size - TRAILER_SIZE)
+        trailer = f.read(TRAILER_SIZE)
+        if not trailer.endswith(END_MAGIC):
+            raise FormatError("File has no index.")
+        index_offset, = struct.unpack_from(TRAILER_FORMAT, trailer)
+        if not len(MAGIC) <= index_offset < size - TRAILER_SIZE:
+            raise FormatError("Corrupted index")
+        r = self._read_record(index_offset)
+        if r is None or r[0] != INDEX or type(r[1]) is not tuple:
+            raise FormatError("Corrupted index")
+        for offset in r[1]:
+            if (type(offset) not in (int, long)
+                or not len(MAGIC) <= offset < index_offset):
+                raise FormatError("Corrupted index")
+        self.offsets = r[1]
+        return self.offsets
+
+    def read_section(self, i):
+        """
+        Return the runs of the i'th section, using the index to find it
+        without reading the others.
+        """
+        offset = self.read_index()[i]
+        r = self._read_record(offset)
+        if r is None or r[0] != SECTION or not _is_section(r[1]):
+            raise FormatError("No section at offset %d" % offset)
+        return r[1]
+
+    def _has_replace_records(self):
+        """Check if the file has replace records, by reading their headers."""
+        f = self.f
+        offset = len(MAGIC)
+        while True:
+            f.seek(offset)
+            header = f.read(RECORD_SIZE)
+            if len(header) < RECORD_SIZE:
+                return False
+            typ, length = struct.unpack(RECORD_FORMAT, header)
+            if typ == REPLACE:
+                return True
+            if typ != SECTION:
+                return False
+            offset += RECORD_SIZE + length
+
+    def read_sections(self):
+        """
+        Return a list with the runs of all the sections in the file, after
+        the replace records were applied.
+        """
+        sections = []
+        offset = len(MAGIC)
+        while True:
+            r = self._read_record(offset)
+            if r is None:
+                break
+            typ, obj, next_offset = r
+            if typ == SECTION:
+                sections.append(obj)
+            elif typ == REPLACE:
+                from_end, n, n_old, new_sections = obj
+                if from_end:
+                    end = len(sections) - n
+                    start = 0 if n_old is None else end - n_old
+                else:
+                    start = n
+                    end = len(sections) if n_old is None else start + n_old
+                if not 0 <= start <= end <= len(sections):
+                    raise FormatError("Invalid replace record at offset %d"
+                                      % offset)
+                sections[start:end] = new_sections
+            else:
+                break
+            offset = next_offset
+        return sections
+
+    def iter_sections(self):
+        """
+        Yield the runs of the sections in the file, in order. Stop at the
+        index or at an incomplete record.
+        """
+        if self._has_replace_records():
+            # Sections may be replaced by later records.
+            for section in self.read_sections():
+                yield section
+            return
+        offset = len(MAGIC)
+        while True:
+            r = self._read_record(offset)
+            if r is None or r[0] != SECTION:
+                return
+            yield r[1]
+            offset = r[2]
@@ -20,8 +20,10 @@ __all__ = ['SubprocessHandler']
 import sys
 import os
 import time
+import codecs
 if sys.platform != 'win32':
     import signal
+    import fcntl
 else:
     import ctypes
 from .subprocess_interact import Popen, PIPE
@@ -38,6 +40,21 @@ _ = lambda s: s
 
 START_TIMEOUT = 30 # seconds
 
+# On win32 we poll the subprocess every POLL_INTERVAL milliseconds. Elsewhere,
+# gobject wakes us up when there's something to read or when the subprocess
+# terminates, so nothing happens while the subprocess is idle.
+use_io_watch = (sys.platform != 'win32')
+POLL_INTERVAL = 10 # milliseconds
+
+# When reading stdout and stderr, we read everything available. The read size
+# starts at MIN_READ_SIZE and is doubled (up to MAX_READ_SIZE) whenever a read
+# fills it, so a chatty subprocess is drained with few system calls. We stop
+# after READ_TIME_BUDGET seconds, so that the UI will stay responsive; the rest
+# will be read on the next round.
+MIN_READ_SIZE = 4096 # bytes
+MAX_READ_SIZE = 1024*1024 # bytes
+READ_TIME_BUDGET = 0.05 # seconds
+
 class StartError(IOError):
     """Error when starting subprocess"""
     pass
@@ -89,18 +106,104 @@ class SubprocessHandler(object):
         self._on_subp_terminated = on_subp_terminated
         
         self._sock = None
+        # On Unix, the subprocess inherits one end of a socket pair, which
+        # saves finding a free port and the overhead of TCP.
+        self._use_socketpair = (sys.platform != 'win32'
+                                and hasattr(socket, 'socketpair'))
         # self._popen is None when there's no subprocess
         self._popen = None
         self._last_kill_time = 0
+        # Map a name ('stdout', 'stderr', 'sock', 'child') to a gobject source
+        # id, when gobject watches the subprocess for us.
+        self._watch_ids = {}
+        # Current read size and utf-8 decoder for each of stdout and stderr.
+        # The incremental decoders handle chars split between two reads.
+        self._read_sizes = {}
+        self._decoders = {}
         
-        # I know that polling isn't the best way, but on Windows you have
-        # no choice, and it allows us to do it all by ourselves, not use
-        # gobject's functionality.
-        gobject.timeout_add(10, self._manage_subp)
+        if not use_io_watch:
+            # I know that polling isn't the best way, but on Windows you have
+            # no choice, since gobject can't watch pipes there.
+            gobject.timeout_add(POLL_INTERVAL, self._manage_subp)
         
     def start(self):
         if self._popen is not None:
             raise ValueError("Subprocess is already living")
+        if self._use_socketpair:
+            try:
+                popen, sock = self._start_socketpair()
+            except StartTerminatedError, e:
+                # Maybe the interpreter can't use a socket it inherits (it
+                # may be Jython or IronPython, for example), so we try TCP.
+                debug("Couldn't start subprocess with a socket pair: %s" % e)
+                self._use_socketpair = False
+        if not self._use_socketpair:
+            popen, sock = self._start_tcp()
+        self._sock = sock
+        self._popen = popen
+        for name in ('stdout', 'stderr'):
+            self._read_sizes[name] = MIN_READ_SIZE
+            self._decoders[name] = codecs.getincrementaldecoder('utf8')(
+                'replace')
+        if use_io_watch:
+            self._add_watches()
+
+    def _spawn(self, sock_arg):
+        """Run subp_main.py, telling it how to connect with sock_arg."""
+        env = os.environ.copy()
+        env['PYTHONUNBUFFERED'] = '1'
+        env['PYTHONIOENCODING'] = 'UTF-8'
+        script = os.path.join(self._data_dir, 'subp_main.py')
+        return Popen([self._pyexec, script, sock_arg],
+                     stdin=PIPE, stdout=PIPE, stderr=PIPE,
+                     env=env)
+
+    def _start_socketpair(self):
+        """
+        Start the subprocess, letting it inherit one end of a socket pair.
+        Return (popen, sock).
+        """
+        sock, child_sock = socket.socketpair()
+        # Only the subprocess should get child_sock. This also prevents later
+        # subprocesses from inheriting sock.
+        fcntl.fcntl(sock.fileno(), fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        try:
+            popen = self._spawn('fd:%d' % child_sock.fileno())
+        finally:
+            child_sock.close()
+        # There's no connection to wait for, so the subprocess sends None when
+        # it's ready. If it terminates instead, the socket is closed.
+        start_time = time.time()
+        while not select([sock], [], [], 0.1)[0]:
+            rc = popen.poll()
+            if rc is not None:
+                sock.close()
+                out = (popen.recv() or '') + (popen.recv_err() or '')
+                raise StartTerminatedError(rc, out)
+            if time.time() - start_time > START_TIMEOUT:
+                sock.close()
+                out = (popen.recv() or '') + (popen.recv_err() or '')
+                raise StartTimeoutError(START_TIMEOUT, out)
+        try:
+            recv_object(sock)
+        except IOError:
+            sock.close()
+            # Give the subprocess a second to terminate
+            for _i in range(10):
+                if popen.poll() is not None:
+                    break
+                time.sleep(0.1)
+            else:
+                popen.kill()
+            out = (popen.recv() or '') + (popen.recv_err() or '')
+            raise StartTerminatedError(popen.wait(), out)
+        return popen, sock
+
+    def _start_tcp(self):
+        """
+        Start the subprocess, and wait for it to connect to a TCP port on
+        localhost. Return (popen, sock).
+        """
         # Find a socket to listen to
         ports = range(10000, 10100)
         random.shuffle(ports)
@@ -120,13 +223,7 @@ class SubprocessHandler(object):
         # Now the socket is bound to port.
 
         #debug("Spawning subprocess")
-        env = os.environ.copy()
-        env['PYTHONUNBUFFERED'] = '1'
-        env['PYTHONIOENCODING'] = 'UTF-8'
-        script = os.path.join(self._data_dir, 'subp_main.py')
-        popen = Popen([self._pyexec, script, str(port)],
-                       stdin=PIPE, stdout=PIPE, stderr=PIPE,
-                       env=env)
+        popen = self._spawn(str(port))
         #debug("Waiting for the subprocess to connect")
         s.listen(1)
         # We wait for the client to connect, but we also poll stdout and stderr,
@@ -135,7 +232,7 @@ class SubprocessHandler(object):
         start_time = time.time()
         while True:
             try:
-                self._sock, _addr = s.accept()
+                sock, _addr = s.accept()
             except socket.timeout:
                 pass
             else:
@@ -149,13 +246,14 @@ class SubprocessHandler(object):
             if time.time() - start_time > START_TIMEOUT:
                 out = (popen.recv() or '') + (popen.recv_err() or '')
                 raise StartTimeoutError(START_TIMEOUT, out)
-        self._sock.setblocking(True)
+        sock.setblocking(True)
             
         #debug("Connected to addr %r." % (addr,))
         s.close()
-        self._popen = popen
+        return popen, sock
 
     def _manage_subp(self):
+        """Called every POLL_INTERVAL when we can't use gobject watches."""
         popen = self._popen
         if popen is None:
             # Just continue looping - there's no subprocess.
@@ -164,41 +262,158 @@ class SubprocessHandler(object):
         # Check if exited
         rc = popen.poll()
         if rc is not None:
-            if time.time() - self._last_kill_time > 10:
-                debug("Process terminated unexpectedly with rc %r" % rc)
-            self._sock.close()
-            self._sock = None
-            self._popen = None
-            self._on_subp_terminated()
+            # Show everything it wrote before it terminated, like
+            # _on_child_exit does.
+            self._read_stdout(None)
+            self._read_stderr(None)
+            self._handle_termination(rc)
             return True
 
-        # Read from stdout
-        r = popen.recv()
-        if r:
-            self._on_stdout_recv(r.decode('utf8', 'replace'))
-
-        # Read from stderr
-        r = popen.recv_err()
-        if r:
-            self._on_stderr_recv(r.decode('utf8', 'replace'))
-        
-        # Read from socket
+        self._read_stdout()
+        self._read_stderr()
         if self.wait_for_object(0):
-            try:
-                obj = recv_object(self._sock)
-            except IOError:
-                # Could happen when subprocess exits. See bug #525358.
-                # We give the subprocess a second. If it shuts down, we ignore
-                # the exception, since on the next round we will handle that.
-                # Otherwise, the exception remains unexplained so we re-raise.
-                time.sleep(1)
-                if popen.poll() is None:
-                    raise
-            else:
-                self._on_object_recv(obj)
+            self._read_object()
 
         return True
 
+    def _handle_termination(self, rc):
+        if time.time() - self._last_kill_time > 10:
+            debug("Process terminated unexpectedly with rc %r" % rc)
+        self._remove_watches()
+        self._sock.close()
+        self._sock = None
+        self._popen = None
+        self._on_subp_terminated()
+
+    def _read_stdout(self, time_budget=READ_TIME_BUDGET):
+        """Read from stdout. Return False if it was closed."""
+        return self._read_stream('stdout', self._popen.recv,
+                                 self._on_stdout_recv, time_budget)
+
+    def _read_stderr(self, time_budget=READ_TIME_BUDGET):
+        """Read from stderr. Return False if it was closed."""
+        return self._read_stream('stderr', self._popen.recv_err,
+                                 self._on_stderr_recv, time_budget)
+
+    def _read_stream(self, name, recv, on_recv, time_budget):
+        """
+        Read what's available from stdout or stderr (within time_budget
+        seconds, if it isn't None) and pass it to on_recv. Return False if
+        the stream was closed.
+        """
+        size = self._read_sizes[name]
+        start_time = time.time()
+        parts = []
+        is_open = True
+        while True:
+            r = recv(size)
+            if r is None:
+                is_open = False
+                break
+            if not r:
+                break
+            parts.append(r)
+            if len(r) < size:
+                # We got everything that was available.
+                break
+            size = min(size * 2, MAX_READ_SIZE)
+            if (time_budget is not None
+                and time.time() - start_time > time_budget):
+                break
+        self._read_sizes[name] = size
+        data = self._decoders[name].decode(''.join(parts), not is_open)
+        if data:
+            on_recv(data)
+        return is_open
+
+    def _read_object(self):
+        """
+        Read an object from the socket, which should be ready for reading.
+        Return False if the socket was closed.
+        """
+        popen = self._popen
+        try:
+            obj = recv_object(self._sock)
+        except IOError:
+            # Could happen when subprocess exits. See bug #525358.
+            # We give the subprocess a second. If it shuts down, we ignore
+            # the exception, since the termination will be handled soon.
+            # Otherwise, the exception remains unexplained so we re-raise.
+            time.sleep(1)
+            if popen.poll() is None:
+                raise
+            return False
+        else:
+            self._on_object_recv(obj)
+            return True
+
+    # gobject watches
+
+    def _add_watches(self):
+        popen = self._popen
+        cond = gobject.IO_IN | gobject.IO_HUP | gobject.IO_ERR
+        self._watch_ids = {
+            'stdout': gobject.io_add_watch(popen.stdout, cond,
+                                           self._on_stdout_ready),
+            'stderr': gobject.io_add_watch(popen.stderr, cond,
+                                           self._on_stderr_ready),
+            'sock': gobject.io_add_watch(self._sock, cond,
+                                         self._on_sock_ready),
+            'child': gobject.child_watch_add(popen.pid, self._on_child_exit),
+            }
+
+    def _remove_watch(self, name):
+        watch_id = self._watch_ids.pop(name, None)
+        if watch_id is not None:
+            gobject.source_remove(watch_id)
+
+    def _remove_watches(self):
+        for name in self._watch_ids.keys():
+            self._remove_watch(name)
+
+    def _on_stdout_ready(self, _source, _condition):
+        if self._read_stdout():
+            return True
+        del self._watch_ids['stdout']
+        return False
+
+    def _on_stderr_ready(self, _source, _condition):
+        if self._read_stderr():
+            return True
+        del self._watch_ids['stderr']
+        return False
+
+    def _on_sock_ready(self, _source, _condition):
+        # The object may have already been read by a blocking call, in which
+        # case there's nothing to do.
+        if not self.wait_for_object(0) or self._read_object():
+            return True
+        # The socket was closed. The child watch will handle the termination.
+        del self._watch_ids['sock']
+        return False
+
+    def _on_child_exit(self, _pid, status):
+        # The source is removed after this callback returns.
+        del self._watch_ids['child']
+        # Show everything the subprocess wrote just before it terminated.
+        # It can't write more, so what's left in the pipes is bounded, and
+        # is read without a time budget.
+        self._read_stdout(None)
+        self._read_stderr(None)
+        if os.WIFSIGNALED(status):
+            rc = -os.WTERMSIG(status)
+        else:
+            rc = os.WEXITSTATUS(status)
+        self._popen.returncode = rc
+        self._handle_termination(rc)
+
+    def _on_killed(self, popen):
+        # kill() waits for the subprocess itself, so the child watch was
+        # removed and we handle the termination here.
+        if self._popen is popen:
+            self._handle_termination(popen.wait())
+        return False
+
     def send_object(self, obj):
         """Send an object to the subprocess"""
         if self._popen is None:
@@ -229,6 +444,9 @@ class SubprocessHandler(object):
         If the event loop continues, will start another one."""
         if self._popen is None:
             raise ValueError("Subprocess not living")
+        if use_io_watch:
+            # We wait for the subprocess ourselves, so gobject mustn't reap it.
+            self._remove_watch('child')
         if sys.platform != 'win32':
             # Send SIGTERM, and if the process didn't terminate within 1 second,
             # send SIGKILL.
@@ -250,6 +468,8 @@ class SubprocessHandler(object):
             kernel32.TerminateProcess(handle, -1)
             kernel32.CloseHandle(handle)
         self._last_kill_time = time.time()
+        if use_io_watch:
+            gobject.idle_add(self._on_killed, self._popen)
 
     def interrupt(self):
         if self._popen is None:
@@ -16,7 +16,6 @@ if subprocess.mswindows:
     PeekNamedPipe = windll.kernel32.PeekNamedPipe #@UndefinedVariable
 else:
     import select
-    import fcntl
 
 class Popen(subprocess.Popen):
     def recv(self, maxsize=None):
@@ -104,24 +103,18 @@ class Popen(subprocess.Popen):
             if conn is None:
                 return None
 
-            flags = fcntl.fcntl(conn, fcntl.F_GETFL)
-            if not conn.closed:
-                fcntl.fcntl(conn, fcntl.F_SETFL, flags| os.O_NONBLOCK)
+            if not select.select([conn], [], [], 0)[0]:
+                return ''
 
-            try:
-                if not select.select([conn], [], [], 0)[0]:
-                    return ''
-
-                r = conn.read(maxsize)
-                if not r:
-                    return self._close(which)
+            # A single os.read returns what's available without waiting for
+            # maxsize bytes, so there's no need to make the pipe non-blocking.
+            r = os.read(conn.fileno(), maxsize)
+            if not r:
+                return self._close(which)
 
-                if self.universal_newlines:
-                    r = self._translate_newlines(r)
-                return r
-            finally:
-                if not conn.closed:
-                    fcntl.fcntl(conn, fcntl.F_SETFL, flags)
+            if self.universal_newlines:
+                r = self._translate_newlines(r)
+            return r
 
 message = "Other end disconnected!"
 
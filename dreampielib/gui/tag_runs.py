@@ -0,0 +1,102 @@
+# Copyright 2012 Noam Yorav-Raphael
+#
+# This file is part of DreamPie.
+# 
+# DreamPie is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# DreamPie is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with DreamPie.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Copy tagged text out of a text buffer and back in, efficiently.
+
+A run is a pair (text, tag_names), where text is a unicode string and
+tag_names is a tuple with the names of the tags applied to all of text.
+"""
+
+__all__ = ['get_tag_runs', 'insert_tag_runs']
+
+import sys
+
+from .common import get_text
+
+# On narrow (UCS-2) builds, characters outside the BMP take two code units in
+# a unicode string but only one offset in the text buffer, so python string
+# lengths can't be used as buffer offsets.
+is_narrow_build = sys.maxunicode <= 0xffff
+
+def char_len(s):
+    """Return the number of text buffer characters in the unicode string s."""
+    if not is_narrow_build:
+        return len(s)
+    return len(s) - sum(1 for c in s if u'\udc00' <= c <= u'\udfff')
+
+def get_tag_runs(textbuffer, start, end):
+    """
+    Return a list of runs with the text between the iterators start and end.
+    The text is read with one get_text() call and the tags by walking the tag
+    toggles, so this takes a single pass over the range.
+    """
+    tb = textbuffer
+    base = start.get_offset()
+    if not is_narrow_build:
+        text = get_text(tb, start, end)
+    runs = []
+    it = start.copy()
+    pos = 0
+    while it.compare(end) < 0:
+        tag_names = tuple(tag.props.name for tag in it.get_tags())
+        next_it = it.copy()
+        next_it.forward_to_tag_toggle(None)
+        if next_it.compare(end) > 0:
+            next_it = end.copy()
+        if is_narrow_build:
+            runs.append((get_text(tb, it, next_it), tag_names))
+        else:
+            next_pos = next_it.get_offset() - base
+            runs.append((text[pos:next_pos], tag_names))
+            pos = next_pos
+        it = next_it
+    return runs
+
+def insert_tag_runs(textbuffer, it, runs):
+    """
+    Insert runs at the iterator it, and return an iterator pointing at the end
+    of the inserted text.
+    All the text is inserted with one insert() call, and each tag is applied
+    once for every range of consecutive runs which it is applied to.
+    """
+    tb = textbuffer
+    start_offset = it.get_offset()
+    tb.insert(it, u''.join(text for text, _tag_names in runs))
+    
+    # Find the ranges of the tags, as (name, start, end) offsets.
+    ranges = []
+    open_tags = {}
+    offset = start_offset
+    for text, tag_names in runs:
+        for name in open_tags.keys():
+            if name not in tag_names:
+                ranges.append((name, open_tags.pop(name), offset))
+        for name in tag_names:
+            if name not in open_tags:
+                open_tags[name] = offset
+        offset += char_len(text)
+    for name, tag_start in open_tags.iteritems():
+        ranges.append((name, tag_start, offset))
+    
+    # Inserted text may get the tags of its surroundings, so remove them.
+    tb.remove_all_tags(tb.get_iter_at_offset(start_offset),
+                       tb.get_iter_at_offset(offset))
+    for name, tag_start, tag_end in ranges:
+        tb.apply_tag_by_name(name, tb.get_iter_at_offset(tag_start),
+                             tb.get_iter_at_offset(tag_end))
+    return tb.get_iter_at_offset(offset)
@@ -44,6 +44,15 @@ FOLD_MESSAGE = 'fold-message'
 # The MESSAGE tag
 MESSAGE = 'message'
 
+# The placeholder of sections which were paged out by scrollback.py
+SCROLLBACK = 'scrollback'
+
+# The line after a result which wasn't sent whole by the subprocess
+RESULT_MORE = 'result-more'
+
+# The time, memory and profile of a command, if measured
+STATS = 'stats'
+
 # Tags for syntax highlighting
 KEYWORD = 'keyword'; BUILTIN = 'builtin'; STRING = 'string'
 NUMBER = 'number'; COMMENT = 'comment'; BRACKET_MATCH = 'bracket-match'
@@ -143,6 +152,18 @@ First few characters of the output/code section, which are truncated somewhe
   turns out that if it's visible, you get an extra empty line.
 * Afterwards comes the FOLD_MESSAGE, which includes a '\n' at the end so that
   the background color is behind the entire line.
+
+If a limit on the number of sections is configured, the oldest sections are
+removed from the text buffer and stored in a temporary file by scrollback.py.
+They are replaced by a single line tagged with SCROLLBACK, which says how many
+sections are stored on disk, and is displayed like a FOLD_MESSAGE. Double-
+clicking it loads them back. Always whole sections are paged out, so the text
+after the SCROLLBACK line starts with a COMMAND.
+
+Long results are sent by the subprocess in chunks. Only the first is written,
+and it is followed by a line tagged with RESULT_MORE, which is also displayed
+like a FOLD_MESSAGE. Double-clicking it asks the subprocess for the next chunk,
+which is inserted before it.
 """
 
 def get_theme_names(config):
@@ -219,6 +240,9 @@ def add_tags(textbuffer):
     tag.props.invisible = True
     tag = textbuffer.create_tag(FOLDED)
     tag.props.invisible = True
+    textbuffer.create_tag(SCROLLBACK)
+    textbuffer.create_tag(RESULT_MORE)
+    textbuffer.create_tag(STATS)
 
 def apply_theme_text(textview, textbuffer, theme):
     """
@@ -230,13 +254,23 @@ def apply_theme_text(textview, textbuffer, theme):
             textview.modify_base(0, gdk.color_parse(theme[tag, BG, COLOR]))
             textview.modify_text(0, gdk.color_parse(theme[tag, FG, COLOR]))
         else:
-            tt = textbuffer.get_tag_table().lookup(tag)
-            tt.props.foreground = theme[tag, FG, COLOR]
-            tt.props.foreground_set = theme[tag, FG, ISSET]
-            tt.props.background = theme[tag, BG, COLOR]
-            tt.props.background_set = theme[tag, BG, ISSET]
-            tt.props.paragraph_background = theme[tag, BG, COLOR]
-            tt.props.paragraph_background_set = theme[tag, BG, ISSET]
+            # The scrollback placeholder and the "more of the result" line
+            # look just like a fold message. Command stats look like the
+            # result index.
+            if tag == FOLD_MESSAGE:
+                names = [tag, SCROLLBACK, RESULT_MORE]
+            elif tag == RESULT_IND:
+                names = [tag, STATS]
+            else:
+                names = [tag]
+            for name in names:
+                tt = textbuffer.get_tag_table().lookup(name)
+                tt.props.foreground = theme[tag, FG, COLOR]
+                tt.props.foreground_set = theme[tag, FG, ISSET]
+                tt.props.background = theme[tag, BG, COLOR]
+                tt.props.background_set = theme[tag, BG, ISSET]
+                tt.props.paragraph_background = theme[tag, BG, COLOR]
+                tt.props.paragraph_background_set = theme[tag, BG, ISSET]
 
 def _make_style_scheme(spec):
     # Quite stupidly, there's no way to create a SourceStyleScheme without
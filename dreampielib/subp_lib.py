@@ -42,7 +42,9 @@ dirs = [
 files = [
     'dreampielib/__init__.py',
     'dreampielib/subprocess/__init__.py',
+    'dreampielib/subprocess/bounded_repr.py',
     'dreampielib/subprocess/find_modules.py',
+    'dreampielib/subprocess/sampler.py',
     'dreampielib/subprocess/split_to_singles.py',
     'dreampielib/subprocess/trunc_traceback.py',
     'dreampielib/common/__init__.py',
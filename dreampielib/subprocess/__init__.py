@@ -53,6 +53,12 @@ else:
 if ast is None:
     from .split_to_singles import split_to_singles
 import __future__
+try:
+    import cProfile
+    import pstats
+except ImportError:
+    # Jython doesn't have cProfile
+    cProfile = None
 
 if sys.platform == 'win32':
     from msvcrt import get_osfhandle #@UnresolvedImport
@@ -60,7 +66,10 @@ if sys.platform == 'win32':
     PeekNamedPipe = windll.kernel32.PeekNamedPipe #@UndefinedVariable
 
 from .trunc_traceback import trunc_traceback
+from .bounded_repr import BoundedRepr
+from .sampler import Sampler
 from .find_modules import find_modules, simple_parse_source
+from .find_modules import index as module_index
 # We don't use relative import because of a Jython 2.5.1 bug.
 from dreampielib.common.objectstream import send_object, recv_object
 
@@ -73,8 +82,10 @@ from logging import debug
 # time interval to process GUI events, in seconds
 GUI_SLEEP = 0.1
 
-# Maximum result string length to transmit
-MAX_RES_STR_LEN = 1000000
+# Results are sent in chunks of up to RES_CHUNK_LEN chars. The first is sent
+# with the reply to execute, and the GUI asks for the others when the user
+# wants to see them.
+RES_CHUNK_LEN = 10000
 
 rpc_funcs = set()
 # A decorator which adds the function name to rpc_funcs
@@ -176,10 +187,136 @@ def mask_sigint():
     else:
         pass
 
+def get_memory_usage():
+    """
+    Return the memory used by the process in bytes, or None if we don't know
+    how to get it. Where the current resident size isn't available, the peak
+    is returned.
+    """
+    try:
+        f = open('/proc/self/statm')
+        try:
+            rss_pages = int(f.read().split()[1])
+        finally:
+            f.close()
+        return rss_pages * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError, AttributeError):
+        return get_peak_memory_usage()
+
+def get_peak_memory_usage():
+    """
+    Return the peak memory used by the process in bytes, or None if we don't
+    know how to get it.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # In bytes, not in kilobytes like everywhere else
+        return maxrss
+    else:
+        return maxrss * 1024
+
+def get_cpu_time():
+    """Return the CPU time used by the process in seconds, or None."""
+    try:
+        times = os.times()
+    except (AttributeError, OSError):
+        return None
+    return times[0] + times[1]
+
+class CommandStats(object):
+    """
+    Measure the wall time, CPU time and growth of peak memory of running a
+    command. If profile_top isn't 0, the caller should also enable and disable
+    self.profiler around the command (this isn't done in start and stop, so
+    that they don't appear in the profile).
+    """
+    def __init__(self, profile_top):
+        # The number of functions to show in the profile, or 0 not to profile
+        self.profile_top = profile_top
+        if profile_top and cProfile is not None:
+            self.profiler = cProfile.Profile()
+        else:
+            self.profiler = None
+        self.wall_time = self.cpu_time = self.peak_memory = None
+    
+    def start(self):
+        self.wall_time = time.time()
+        self.cpu_time = get_cpu_time()
+        self.peak_memory = get_peak_memory_usage()
+    
+    def stop(self):
+        self.wall_time = time.time() - self.wall_time
+        cpu_time = get_cpu_time()
+        if cpu_time is not None and self.cpu_time is not None:
+            self.cpu_time = cpu_time - self.cpu_time
+        else:
+            self.cpu_time = None
+        peak_memory = get_peak_memory_usage()
+        if peak_memory is not None and self.peak_memory is not None:
+            self.peak_memory = peak_memory - self.peak_memory
+        else:
+            self.peak_memory = None
+    
+    def get_profile_str(self):
+        """Return the functions which took most time, or None."""
+        if self.profiler is None:
+            return None
+        f = StringIO()
+        stats = pstats.Stats(self.profiler, stream=f)
+        stats.sort_stats('time').print_stats(self.profile_top)
+        return unicodify(f.getvalue().strip('\n'))
+    
+    def get_reply(self):
+        """
+        Return (wall_time, cpu_time, peak_memory_growth, profile_str) to be
+        sent to the GUI. All but wall_time may be None.
+        """
+        return (self.wall_time, self.cpu_time, self.peak_memory,
+                self.get_profile_str())
+
+class BoundedWriter(object):
+    """
+    A file-like object which collects what is written to it, up to a limit of
+    chars (or without a limit, if it's None). When writing would exceed the
+    limit, the text up to the limit is kept, and BoundedWriter.Full is raised.
+    """
+    class Full(Exception):
+        pass
+    
+    def __init__(self, limit):
+        self.limit = limit
+        self.parts = []
+        self.length = 0
+    
+    def write(self, s):
+        if self.limit is not None and self.length + len(s) > self.limit:
+            self.parts.append(s[:self.limit - self.length])
+            self.length = self.limit
+            raise self.Full()
+        self.parts.append(s)
+        self.length += len(s)
+    
+    def clear(self):
+        self.parts = []
+        self.length = 0
+    
+    def strip_newline(self):
+        """Remove a trailing newline, like the one pprint adds."""
+        if self.parts and self.parts[-1].endswith('\n'):
+            self.parts[-1] = self.parts[-1][:-1]
+            self.length -= 1
+    
+    def getvalue(self):
+        return unicodify(''.join(self.parts))
+
+
 class Subprocess(object):
-    def __init__(self, port):
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.connect(('localhost', port))
+    def __init__(self, sock_arg):
+        self.sock = connect(sock_arg)
 
         # Mask SIGINT/Ctrl-C
         mask_sigint()
@@ -216,6 +353,9 @@ class Subprocess(object):
         
         # Config
         self.is_pprint = False
+        self.repr_limits = None
+        self.is_timing = False
+        self.profile_top = 0
         self.is_matplotlib_ia_switch = False
         self.is_matplotlib_ia_warn = False
         self.reshist_size = 0
@@ -226,6 +366,17 @@ class Subprocess(object):
         
         # The result history index of the next value to enter the history
         self.reshist_counter = 0
+        
+        # The chunks of the last result which weren't sent yet
+        self.res_chunks = None
+        
+        # Bumped whenever code is executed, so the GUI can tell if the
+        # results of its completion queries may have changed.
+        self.generation = 0
+        
+        # The names in the namespace which the GUI knows about, or None if
+        # it didn't ask for them yet (see get_firstlevels)
+        self.known_names = None
 
         # Run endless loop
         self.loop()
@@ -234,24 +385,42 @@ class Subprocess(object):
         while True:
             if not self.idle_paused:
                 self.handle_gui_events(self.sock)
-            funcname, args = recv_object(self.sock)
+            # Every reply is sent with the id of its request, so the GUI can
+            # send a few requests before reading their replies, and can tell
+            # which request a late reply belongs to. Notifications, which
+            # aren't replies, are sent with the id None (see notify).
+            req_id, funcname, args = recv_object(self.sock)
             if funcname in rpc_funcs:
                 func = getattr(self, funcname)
                 try:
                     r = func(*args)
                     if isinstance(r, types.GeneratorType):
                         for obj in r:
-                            send_object(self.sock, obj)
+                            send_object(self.sock, (req_id, obj))
                     else:
-                        send_object(self.sock, r)
+                        send_object(self.sock, (req_id, r))
                 except Exception:
                     # This may help in debugging exceptions.
                     traceback.print_exc()
-                    send_object(self.sock, None)
+                    send_object(self.sock, (req_id, None))
             else:
                 # aid in debug
                 sys.stderr.write("Unknown command: %s\n" % funcname)
-                send_object(self.sock, None)
+                send_object(self.sock, (req_id, None))
+
+    def notify(self, name, value):
+        """
+        Send the GUI a notification, which isn't a reply to any request.
+        """
+        send_object(self.sock, (None, (name, value)))
+
+    def notify_after_execute(self):
+        """
+        Notify the GUI of the new namespace generation and of the memory
+        usage, after executing a command.
+        """
+        self.notify(u'generation', self.generation)
+        self.notify(u'memory', get_memory_usage())
 
     def displayhook(self, res):
         if res is not None:
@@ -380,36 +549,108 @@ class Subprocess(object):
         return True, codeobs
     
     @staticmethod
-    def safe_pformat(obj):
+    def safe_pformat(obj, f):
         """
-        Use pprint to format an object.
+        Use pprint to write the representation of an object to f.
         In case of an exception, warn and use regular repr instead.
         """
         try:
-            return unicode(pprint.pformat(obj))
+            pprint.PrettyPrinter(stream=f).pprint(obj)
+        except BoundedWriter.Full:
+            raise
         except:
             from warnings import warn
             warn('pprint raised an exception, using repr instead. '
                  'To reproduce, run: "from pprint import pprint; pprint(_)"')
-            return unicode(repr(obj))
+            f.clear()
+            f.write(repr(obj))
+        else:
+            f.strip_newline()
+    
+    @staticmethod
+    def write_repr(obj, f):
+        f.write(repr(obj))
+    
+    def write_bounded_repr(self, obj, f):
+        limits = [limit or None for limit in self.repr_limits]
+        max_depth, max_items, max_chars, max_seconds = limits
+        width = 80 if self.is_pprint else None
+        br = BoundedRepr(width, max_depth, max_items, max_chars, max_seconds)
+        br.write(obj, f, f.limit)
+    
+    def iter_res_chunks(self, obj):
+        """
+        Yield (chunk, has_more) pairs with the string representation of obj,
+        in chunks of up to RES_CHUNK_LEN chars.
+        repr() and pprint produce the whole representation at once, so it is
+        computed once and then sliced. With BoundedRepr, only as much of the
+        representation as was asked for is produced: it stops when its
+        output gets enough text, and is restarted with a 4 times larger
+        limit when more chunks are asked for, so the total work is
+        proportional to the text sent.
+        """
+        if self.repr_limits is None:
+            f = BoundedWriter(None)
+            if self.is_pprint:
+                self.safe_pformat(obj, f)
+            else:
+                self.write_repr(obj, f)
+            s = f.getvalue()
+            if not s:
+                yield s, False
+            for pos in xrange(0, len(s), RES_CHUNK_LEN):
+                yield (s[pos:pos+RES_CHUNK_LEN],
+                       pos + RES_CHUNK_LEN < len(s))
+            return
+        pos = 0
+        limit = RES_CHUNK_LEN
+        while True:
+            f = BoundedWriter(limit)
+            try:
+                self.write_bounded_repr(obj, f)
+            except BoundedWriter.Full:
+                is_complete = False
+            else:
+                is_complete = True
+            s = f.getvalue()
+            if not s and is_complete:
+                yield s, False
+            while pos < len(s):
+                chunk = s[pos:pos+RES_CHUNK_LEN]
+                pos += len(chunk)
+                yield chunk, (pos < len(s) or not is_complete)
+            if is_complete:
+                return
+            limit *= 4
     
     @rpc_func
-    def execute(self, source):
+    def execute(self, source, is_sampled=False):
         """
         Get the source code to execute (a unicode string).
+        If is_sampled, sample the lines which run with a Sampler.
         Compile it. If there was a syntax error, return
         (False, (msg, line, col)).
         If compilation was successful, return (True, None), then run the code
-        and then send (is_success, res_no, res_str, exception_string, rem_stdin).
+        and then send (is_success, res_no, res_str, res_has_more,
+        exception_string, rem_stdin, stats, samples_str, names_delta).
         is_success - True if there was no exception.
         res_no - number of the result in the history count, or None if there
                  was no result or there's no history.
-        res_str - a string representation of the result.
+        res_str - a string representation of the result, or its first chunk.
+        res_has_more - True if res_str is only the first chunk of the result.
+                       The others can be retrieved with get_more_result.
         exception_string - description of the exception, or None if is_success.
         rem_stdin - data that was sent into stdin and wasn't consumed.
+        stats - None, or (wall_time, cpu_time, peak_memory_growth,
+                profile_str) if the command was measured. See CommandStats.
+        samples_str - the report of the Sampler, if is_sampled.
+        names_delta - the changes in the names of the namespace, see
+                      get_names_delta.
         """
         # pause_idle was called before execute, disable it.
         self.idle_paused = False
+        # Discard the rest of the previous result
+        self.res_chunks = None
         
         if ast:
             success, r = self.compile_ast(source)
@@ -421,14 +662,40 @@ class Subprocess(object):
         else:
             yield True, None
         codeobs = r
+        self.generation += 1
             
         self.last_res = None
+        if self.is_timing or self.profile_top:
+            stats = CommandStats(self.profile_top)
+        else:
+            stats = None
+        if is_sampled and Sampler.is_available:
+            sampler = Sampler()
+        else:
+            sampler = None
         try:
             unmask_sigint()
             try:
                 # Execute
-                for codeob in codeobs:
-                    exec codeob in self.locs
+                if stats is not None:
+                    stats.start()
+                    profiler = stats.profiler
+                else:
+                    profiler = None
+                if profiler is not None:
+                    profiler.enable()
+                if sampler is not None:
+                    sampler.start()
+                try:
+                    for codeob in codeobs:
+                        exec codeob in self.locs
+                finally:
+                    if sampler is not None:
+                        sampler.stop()
+                    if profiler is not None:
+                        profiler.disable()
+                    if stats is not None:
+                        stats.stop()
                 # Work around http://bugs.python.org/issue8213 - stdout buffered
                 # in Python 3.
                 if not sys.stdout.closed:
@@ -438,16 +705,13 @@ class Subprocess(object):
                 # Convert the result to a string. This is here because exceptions
                 # may be raised here.
                 if self.last_res is not None:
-                    if self.is_pprint:
-                        res_str = self.safe_pformat(self.last_res)
-                    else:
-                        res_str = unicode(repr(self.last_res))
-                    if len(res_str) > MAX_RES_STR_LEN:
-                        res_str = (res_str[:MAX_RES_STR_LEN]
-                                   +'\n[%d chars truncated]' % (
-                                        len(res_str)-MAX_RES_STR_LEN))
+                    res_chunks = self.iter_res_chunks(self.last_res)
+                    res_str, res_has_more = res_chunks.next()
+                    if res_has_more:
+                        self.res_chunks = res_chunks
                 else:
                     res_str = None
+                    res_has_more = False
             finally:
                 mask_sigint()
         except:
@@ -459,6 +723,7 @@ class Subprocess(object):
             is_success = False
             res_no = None
             res_str = None
+            res_has_more = False
         else:
             is_success = True
             exception_string = None
@@ -495,7 +760,40 @@ class Subprocess(object):
         # Check if matplotlib in non-interactive mode was imported
         self.check_matplotlib_ia()
 
-        yield is_success, res_no, res_str, exception_string, rem_stdin
+        self.notify_after_execute()
+
+        if stats is not None:
+            stats = stats.get_reply()
+        if sampler is not None:
+            samples_str = sampler.get_report()
+        elif is_sampled:
+            samples_str = u"Sampling isn't available on this platform.\n"
+        else:
+            samples_str = None
+
+        yield (is_success, res_no, res_str, res_has_more, exception_string,
+               rem_stdin, stats, samples_str, self.get_names_delta())
+
+    @rpc_func
+    def get_more_result(self):
+        """
+        Return (chunk, has_more) with the next chunk of the result of the last
+        command, or None if there's nothing more.
+        """
+        if self.res_chunks is None:
+            return None
+        try:
+            chunk, has_more = self.res_chunks.next()
+        except StopIteration:
+            chunk, has_more = u'', False
+        except Exception:
+            chunk = u'\n[Error when formatting the result: %s]' % (
+                unicodify(traceback.format_exception_only(
+                    *sys.exc_info()[:2])[-1].strip()))
+            has_more = False
+        if not has_more:
+            self.res_chunks = None
+        return chunk, has_more
 
     @rpc_func
     def pause_idle(self):
@@ -514,6 +812,33 @@ class Subprocess(object):
     def set_pprint(self, is_pprint):
         self.is_pprint = is_pprint
     
+    @rpc_func
+    def set_repr_limits(self, repr_limits):
+        """
+        repr_limits is None to format results with repr() or pprint, or a
+        tuple (max_depth, max_items, max_chars, max_seconds) to format them
+        with BoundedRepr. A limit of 0 means no limit.
+        """
+        self.repr_limits = repr_limits
+    
+    @rpc_func
+    def set_command_stats(self, is_timing, profile_top):
+        """
+        If is_timing, measure the time and memory each command takes.
+        If profile_top isn't 0, profile each command, and show the profile_top
+        functions which took most time.
+        """
+        self.is_timing = is_timing
+        self.profile_top = profile_top
+    
+    @rpc_func
+    def set_parse_files(self, is_parse):
+        """
+        If is_parse, complete the members of modules which weren't imported
+        by parsing their source files.
+        """
+        self.parse_files_to_autocomplete = is_parse
+
     @rpc_func
     def set_matplotlib_ia(self, is_switch, is_warn):
         self.is_matplotlib_ia_switch = is_switch
@@ -604,24 +929,51 @@ class Subprocess(object):
 
         return public, private
 
+    @staticmethod
+    def get_names(namespace):
+        return set([name for name in namespace if isinstance(name, basestring)])
+
+    def get_all_names(self):
+        """Return the names in __all__ of the namespace, or None."""
+        try:
+            return [unicodify(name) for name in self.locs['__all__']
+                    if isinstance(name, basestring)]
+        except Exception:
+            return None
+
     @rpc_func
-    def complete_firstlevels(self):
+    def get_firstlevels(self):
         """
-        Get (public, private) names (globals, builtins, keywords).
+        Get (fixed_names, global_names, all_names), for the GUI to complete
+        first-level names by itself:
+        fixed_names - sorted builtin names and keywords.
+        global_names - sorted names in the namespace.
+        all_names - the names in __all__ of the namespace, or None.
+        From now on, the reply of execute will include the changes in the
+        names of the namespace.
         """
-        namespace = self.locs.copy()
-        namespace.update(__builtin__.__dict__)
-        ids = eval("dir()", namespace) + keyword.kwlist
-        ids = map(unicodify, ids)
-        ids.sort()
-        if '__all__' in namespace:
-            all_set = set(namespace['__all__'])
-        else:
-            all_set = None
-        public, private = self.split_list(ids, all_set)
-        
-        return public, private
-        
+        fixed_names = self.get_names(__builtin__.__dict__)
+        fixed_names.update(keyword.kwlist)
+        fixed_names = sorted(map(unicodify, fixed_names))
+        self.known_names = self.get_names(self.locs)
+        global_names = sorted(map(unicodify, self.known_names))
+        return fixed_names, global_names, self.get_all_names()
+
+    def get_names_delta(self):
+        """
+        Return (added, removed, all_names) - the names which were added to
+        and removed from the namespace since the GUI was last told, and
+        the names in __all__ of the namespace, or None.
+        If the GUI didn't call get_firstlevels, return None.
+        """
+        if self.known_names is None:
+            return None
+        names = self.get_names(self.locs)
+        added = [unicodify(name) for name in names - self.known_names]
+        removed = [unicodify(name) for name in self.known_names - names]
+        self.known_names = names
+        return added, removed, self.get_all_names()
+
     @rpc_func
     def get_func_args(self, expr):
         """Return the argument names of the function (a list of strings)"""
@@ -671,6 +1023,15 @@ class Subprocess(object):
         return sorted(unicodify(self.dict_key_repr(x)) for x in obj if is_key_reprable(x))
         
 
+    @rpc_func
+    def start_module_index(self, fn):
+        """
+        Start indexing the modules in sys.path in a background thread, so
+        that find_modules will answer from memory. The index is kept in
+        files whose names start with fn.
+        """
+        module_index.start(fn, sys.path)
+
     @rpc_func
     def find_modules(self, package):
         if package:
@@ -680,10 +1041,18 @@ class Subprocess(object):
         return [unicodify(s) for s in find_modules(package)]
 
     def simple_parse_source(self, mod_name):
+        """
+        Return (names, all_names) - the names defined in the source file of
+        mod_name, and the names in its __all__ or None.
+        """
         if self.parse_files_to_autocomplete:
-            return [unicodify(x) for x in simple_parse_source(mod_name)]
+            names, all_names = simple_parse_source(mod_name)
+            names = [unicodify(x) for x in names]
+            if all_names is not None:
+                all_names = [unicodify(x) for x in all_names]
+            return names, all_names
         else:
-            return []
+            return [], None
 
     @rpc_func
     def get_module_members(self, mod_name):
@@ -692,15 +1061,28 @@ class Subprocess(object):
 
         if mod is None:  # hasn't previously been imported
             if len(subs) != 0:  # isn't a file
-                init_contents = self.simple_parse_source(mod_name + '.__init__')
-                return sorted(subs + [x for x in init_contents if x not in subs]), []
-            ids = self.simple_parse_source(mod_name)  # is a file
+                # Submodules and the names in __init__ are all public, unless
+                # __init__ has __all__, which applies only to its names.
+                ids, all_names = self.simple_parse_source(
+                    mod_name + '.__init__')
+                if all_names is not None:
+                    public, private = self.split_list(ids, set(all_names))
+                else:
+                    public, private = ids, []
+                subs_set = set(subs)
+                public = set(public)
+                public.update(subs)
+                private = [x for x in private if x not in subs_set]
+                return sorted(public), sorted(private)
+            else:
+                ids, all_names = self.simple_parse_source(mod_name)  # is a file
         else:
             ids = [unicodify(x) for x in mod.__dict__.iterkeys()]
             ids.extend([x for x in subs if x not in ids])
+            all_names = getattr(mod, '__all__', None)
 
-        if hasattr(mod, '__all__'):
-            all_set = set(mod.__all__)
+        if all_names is not None:
+            all_set = set(all_names)
         else:
             all_set = None
 
@@ -797,6 +1179,26 @@ class Subprocess(object):
     @rpc_func
     def get_subprocess_info(self):
         return (self.get_welcome(), can_mask_sigint())
+    
+    @rpc_func
+    def batch(self, calls):
+        """
+        Get a list of (funcname, args) pairs of queries, and return a list of
+        their results, so that a few queries can be answered in one reply.
+        The result of a query which failed is None.
+        """
+        results = []
+        for funcname, args in calls:
+            if funcname not in rpc_funcs or funcname in ('batch', 'execute'):
+                sys.stderr.write("Can't batch command: %s\n" % funcname)
+                results.append(None)
+                continue
+            try:
+                results.append(getattr(self, funcname)(*args))
+            except Exception:
+                traceback.print_exc()
+                results.append(None)
+        return results
         
     @classmethod
     def _find_constructor(cls, class_ob):
@@ -917,6 +1319,7 @@ class Subprocess(object):
             if not hasattr(matplotlib, 'interactive'):
                 return
             matplotlib.interactive(True)
+            self.notify(u'matplotlib_ia', True)
         else:
             sys.stderr.write(
                 "Warning: matplotlib in non-interactive mode detected.\n"
@@ -1068,5 +1471,24 @@ class TkHandler(GuiHandler):
         time.sleep(delay)
         return True
 
-def main(port):
-    _subp = Subprocess(port)
+def connect(sock_arg):
+    """
+    Return a socket connected to the GUI. sock_arg is either 'fd:<n>', if we
+    inherited a socket with file descriptor n, or the TCP port to connect to.
+    """
+    if sock_arg.startswith('fd:'):
+        fd = int(sock_arg[len('fd:'):])
+        sock = socket.fromfd(fd, socket.AF_UNIX, socket.SOCK_STREAM)
+        os.close(fd)
+        # Don't let processes started by user code inherit the socket
+        import fcntl
+        fcntl.fcntl(sock.fileno(), fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        # The GUI waits for this, since there's no connection to wait for.
+        send_object(sock, None)
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect(('localhost', int(sock_arg)))
+    return sock
+
+def main(sock_arg):
+    _subp = Subprocess(sock_arg)
@@ -0,0 +1,420 @@
+# Copyright 2012 Noam Yorav-Raphael
+#
+# This file is part of DreamPie.
+#
+# DreamPie is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# DreamPie is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with DreamPie.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Format objects like repr() or pprint, within limits of depth, items per
+container, output chars and time.
+
+pprint first computes the repr of the whole object, to decide if it fits in
+a line. Here an object is formatted on one line only until the line is
+full, so the work done is proportional to the output, and formatting stops
+as soon as a limit is reached. Cut out parts are replaced by '...', like
+reprlib does.
+"""
+
+__all__ = ['BoundedRepr']
+
+import sys
+py3k = (sys.version_info[0] == 3)
+import time
+from heapq import nsmallest
+from itertools import islice
+
+if py3k:
+    _str_types = (str, bytes)
+else:
+    _str_types = (str, unicode)
+
+# Set reprs changed in Python 3
+if repr(set([0])) == '{0}':
+    _set_brackets = {set: ('{', '}'), frozenset: ('frozenset({', '})')}
+else:
+    _set_brackets = {set: ('set([', '])'), frozenset: ('frozenset([', '])')}
+
+def _head_repr(s, n):
+    """
+    Return the first n chars of repr(s), where s is a string, computing
+    only the repr of its first n chars.
+    """
+    head = s[:n]
+    r = repr(head)
+    try:
+        is_dquoted = "'" in s and '"' not in s
+        is_head_dquoted = "'" in head and '"' not in head
+    except TypeError:
+        # bytes in Python 3
+        return r[:n]
+    if is_dquoted != is_head_dquoted:
+        # Quote the head like repr(s) does. Only the quotes of the head
+        # itself need to be escaped differently.
+        i = 0
+        while r[i] not in '\'"':
+            i += 1
+        body = r[i+1:-1]
+        if is_dquoted:
+            r = r[:i] + '"' + body + '"'
+        else:
+            r = r[:i] + "'" + body.replace("'", "\\'") + "'"
+    return r[:n]
+
+class _TooLong(Exception):
+    """Raised when a one-line representation doesn't fit"""
+    pass
+
+class _LineBuffer(object):
+    """
+    Collect a one-line representation, up to budget chars (or without a
+    limit, if budget is None).
+    """
+    def __init__(self, budget):
+        self.budget = budget
+        self.parts = []
+        self.length = 0
+
+    def write(self, s):
+        self.length += len(s)
+        if self.budget is not None and self.length > self.budget:
+            raise _TooLong()
+        self.parts.append(s)
+
+    def getvalue(self):
+        return ''.join(self.parts)
+
+# Marks that a container has more items than are shown
+_MORE = object()
+
+# Maps types to their kind, see BoundedRepr._get_kind
+_kinds = {}
+
+class BoundedRepr(object):
+    """
+    Format objects like repr() (if width is None) or like pprint (lines of
+    up to width chars), within limits. A limit of None means no limit.
+    max_depth - containers nested deeper are shown as '[...]'.
+    max_items - only this many items of each container are shown.
+    max_chars - when this many chars were written, stop. A string which
+                doesn't fit is cut, and followed by '...'.
+    max_seconds - when formatting took this long, stop.
+    After stopping, every object which wasn't written yet is written as '...'.
+    """
+    def __init__(self, width=80, max_depth=None, max_items=None,
+                 max_chars=None, max_seconds=None):
+        self.width = width
+        self.max_depth = max_depth
+        self.max_items = max_items
+        self.max_chars = max_chars
+        self.max_seconds = max_seconds
+
+        # State of the current write() call
+        self.f = None
+        self.out_limit = None
+        self.n_chars = 0
+        self.deadline = None
+        self.is_stopped = False
+        # ids of the containers being formatted, to detect recursion
+        self.stack = set()
+
+    def write(self, obj, f, out_limit=None):
+        """
+        Write the representation of obj to the file-like object f.
+        Exceptions raised by f.write are passed on, so f can stop the
+        formatting too. If f does that after out_limit chars, pass it, so
+        that only the part of a long string which f accepts is formatted.
+        """
+        self.f = f
+        self.out_limit = out_limit
+        self.n_chars = 0
+        if self.max_seconds is not None:
+            self.deadline = time.time() + self.max_seconds
+        else:
+            self.deadline = None
+        self.is_stopped = False
+        self.stack = set()
+        try:
+            if self.width is None:
+                self._write_line(obj, 1, _Out(self))
+            else:
+                self._format(obj, 0, 0, 1)
+        finally:
+            self.f = None
+
+    def repr(self, obj):
+        """Return the representation of obj as a string."""
+        buf = _LineBuffer(None)
+        self.write(obj, buf)
+        return buf.getvalue()
+
+    # The engine itself writes to the output with this method
+    def _write_out(self, s):
+        self.f.write(s)
+        self.n_chars += len(s)
+        if self.max_chars is not None and self.n_chars >= self.max_chars:
+            self.is_stopped = True
+
+    def _atom_repr(self, obj):
+        """
+        Return repr(obj), for an object which isn't a container. A string
+        which is longer than what's left of max_chars isn't formatted
+        entirely: the part which fits is returned, followed by '...', like
+        reprlib does, and formatting stops.
+        A string which is longer than what's left of out_limit is cut one
+        char after it, so that the output stops the formatting.
+        """
+        if not isinstance(obj, _str_types):
+            return repr(obj)
+        if self.out_limit is not None:
+            out_left = max(self.out_limit - self.n_chars, 0)
+            if (len(obj) + 2 > out_left
+                and (self.max_chars is None
+                     or self.max_chars - self.n_chars > out_left)):
+                return _head_repr(obj, out_left + 1)
+        if self.max_chars is None:
+            return repr(obj)
+        left = max(self.max_chars - self.n_chars, 0)
+        # The repr of a string is at least two chars longer than it
+        if len(obj) + 2 <= left:
+            return repr(obj)
+        self.is_stopped = True
+        return _head_repr(obj, left) + '...'
+
+    def _check_time(self):
+        if self.deadline is not None and time.time() > self.deadline:
+            self.is_stopped = True
+
+    @staticmethod
+    def _get_kind(obj):
+        """
+        Return 'dict', 'seq' or None, according to the way obj is formatted.
+        Like pprint, subclasses of builtin containers which override __repr__
+        are formatted using it.
+        """
+        typ = type(obj)
+        try:
+            return _kinds[typ]
+        except KeyError:
+            pass
+        r = getattr(typ, '__repr__', None)
+        if issubclass(typ, dict) and r is dict.__repr__:
+            kind = 'dict'
+        elif ((issubclass(typ, list) and r is list.__repr__) or
+              (issubclass(typ, tuple) and r is tuple.__repr__) or
+              (issubclass(typ, set) and r is set.__repr__) or
+              (issubclass(typ, frozenset) and r is frozenset.__repr__)):
+            kind = 'seq'
+        else:
+            kind = None
+        if len(_kinds) > 1000:
+            # Don't keep too many classes alive
+            _kinds.clear()
+        _kinds[typ] = kind
+        return kind
+
+    def _head(self, items, is_sorted):
+        """
+        Return an iterable of up to max_items of a container's items,
+        followed by _MORE if some were left out. Like pprint, if is_sorted
+        and we're not formatting like repr(), the smallest items are taken,
+        sorted.
+        """
+        is_sorted = is_sorted and self.width is not None
+        max_items = self.max_items
+        if max_items is None or len(items) <= max_items:
+            if is_sorted:
+                try:
+                    return sorted(items)
+                except TypeError:
+                    pass
+            return items
+        if is_sorted:
+            # This doesn't sort all the items, only finds the smallest.
+            try:
+                head = nsmallest(max_items, items)
+            except TypeError:
+                head = list(islice(items, max_items))
+        else:
+            head = list(islice(items, max_items))
+        head.append(_MORE)
+        return head
+
+    @staticmethod
+    def _get_brackets(obj):
+        if isinstance(obj, list):
+            return '[', ']'
+        elif isinstance(obj, tuple):
+            return '(', ')'
+        elif isinstance(obj, set):
+            return _set_brackets[set]
+        else:
+            return _set_brackets[frozenset]
+
+    def _write_line(self, obj, level, out):
+        """
+        Write the one-line representation of obj with out.write.
+        level is the nesting depth of obj, starting from 1.
+        """
+        if self.is_stopped:
+            out.write('...')
+            return
+        kind = self._get_kind(obj)
+        if kind is None:
+            if (isinstance(obj, _str_types) and isinstance(out, _LineBuffer)
+                and out.budget is not None and len(obj) > out.budget):
+                # Don't compute the repr of a long string to find out that
+                # it doesn't fit.
+                raise _TooLong()
+            out.write(self._atom_repr(obj))
+            return
+        if not obj:
+            out.write(repr(obj))
+            return
+        if kind == 'dict':
+            start, end = '{', '}'
+        else:
+            start, end = self._get_brackets(obj)
+        if self.max_depth is not None and level > self.max_depth:
+            out.write(start + '...' + end)
+            return
+        objid = id(obj)
+        if objid in self.stack:
+            out.write(self._recursion_repr(obj))
+            return
+        self.stack.add(objid)
+        try:
+            out.write(start)
+            if kind == 'dict':
+                keys = self._head(obj, True)
+                for i, key in enumerate(keys):
+                    self._check_time()
+                    if i:
+                        out.write(', ')
+                    if key is _MORE or self.is_stopped:
+                        out.write('...')
+                        break
+                    self._write_line(key, level + 1, out)
+                    out.write(': ')
+                    self._write_line(obj[key], level + 1, out)
+            else:
+                is_sorted = not isinstance(obj, (list, tuple))
+                items = self._head(obj, is_sorted)
+                for i, item in enumerate(items):
+                    self._check_time()
+                    if i:
+                        out.write(', ')
+                    if item is _MORE or self.is_stopped:
+                        out.write('...')
+                        break
+                    self._write_line(item, level + 1, out)
+                if len(obj) == 1 and isinstance(obj, tuple):
+                    out.write(',')
+            out.write(end)
+        finally:
+            self.stack.discard(objid)
+
+    def _line_repr(self, obj, level, budget):
+        """
+        Return the one-line representation of obj, or None if it's longer
+        than budget.
+        """
+        buf = _LineBuffer(budget)
+        try:
+            self._write_line(obj, level, buf)
+        except _TooLong:
+            return None
+        return buf.getvalue()
+
+    @staticmethod
+    def _recursion_repr(obj):
+        return '<Recursion on %s with id=%s>' % (type(obj).__name__, id(obj))
+
+    def _format(self, obj, indent, allowance, level):
+        """
+        Write the representation of obj, like pprint. indent is the column
+        in which obj starts, and allowance is the number of chars which will
+        be written after it on the same line.
+        """
+        if self.is_stopped:
+            self._write_out('...')
+            return
+        max_width = self.width - 1 - indent - allowance
+        kind = self._get_kind(obj)
+        if kind is None:
+            self._write_out(self._atom_repr(obj))
+            return
+        if not obj:
+            self._write_out(repr(obj))
+            return
+        line = self._line_repr(obj, level, max_width)
+        if line is not None:
+            self._write_out(line)
+            return
+        if self.max_depth is not None and level > self.max_depth:
+            self._write_line(obj, level, _Out(self))
+            return
+        objid = id(obj)
+        if objid in self.stack:
+            self._write_out(self._recursion_repr(obj))
+            return
+        self.stack.add(objid)
+        try:
+            if kind == 'dict':
+                self._format_dict(obj, indent, allowance, level)
+            else:
+                self._format_seq(obj, indent, allowance, level)
+        finally:
+            self.stack.discard(objid)
+
+    def _format_dict(self, obj, indent, allowance, level):
+        write = self._write_out
+        write('{')
+        indent += 1
+        keys = self._head(obj, True)
+        for i, key in enumerate(keys):
+            self._check_time()
+            if i:
+                write(',\n' + ' ' * indent)
+            if key is _MORE or self.is_stopped:
+                write('...')
+                break
+            rep = self._line_repr(key, level + 1, None)
+            write(rep + ': ')
+            self._format(obj[key], indent + len(rep) + 2, allowance + 1,
+                         level + 1)
+        write('}')
+
+    def _format_seq(self, obj, indent, allowance, level):
+        write = self._write_out
+        start, end = self._get_brackets(obj)
+        write(start)
+        indent += len(start)
+        is_sorted = not isinstance(obj, (list, tuple))
+        items = self._head(obj, is_sorted)
+        for i, item in enumerate(items):
+            self._check_time()
+            if i:
+                write(',\n' + ' ' * indent)
+            if item is _MORE or self.is_stopped:
+                write('...')
+                break
+            self._format(item, indent, allowance + 1, level + 1)
+        if len(obj) == 1 and isinstance(obj, tuple):
+            write(',')
+        write(end)
+
+class _Out(object):
+    """Let _write_line write to the output of a BoundedRepr."""
+    def __init__(self, bounded_repr):
+        self.write = bounded_repr._write_out
@@ -21,16 +21,78 @@ from os.path import join, isdir, isfile, exists
 import stat
 import imp
 import re
-import time
+import keyword
+import marshal
+import threading
+import zipfile
+try:
+    import ast
+except ImportError:
+    # Python 2.5 doesn't have the ast module
+    ast = None
 
-TIMEOUT = 1 # Stop after 1 second
+# scandir gets the type of the entries with the names, without a stat call
+# for each entry. It's in os since Python 3.5, and is a package before that.
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 # Match any of the suffixes
 suffix_re = re.compile(
     r'(?:%s)$' % '|'.join(re.escape(suffix[0]) for suffix in imp.get_suffixes()))
 
-# A mapping from absolute names to (mtime, module_names) tuple.
-cache = {}
+# Suffixes which can be imported from zip files
+zip_suffix_re = re.compile(r'\.py[co]?$')
+
+# Match identifiers, which are the names of directories which can be packages
+package_re = re.compile(r'(?!\d)\w+$')
+
+# Directories which are never packages, though their names are identifiers
+non_package_dirs = frozenset(['__pycache__'])
+
+# Since Python 3.3, every directory can be a namespace package, without an
+# __init__ file.
+has_namespace_packages = sys.version_info >= (3, 3)
+
+# Changes to the index made by queries are saved after this many seconds, in
+# a background thread, so that a few changes are saved together.
+SAVE_DELAY = 5
+
+def list_dir(dirname):
+    """
+    Return a list of (basename, is_dir) pairs for the entries in dirname.
+    With scandir, is_dir is taken from the directory entry, and a stat call
+    is only made for symlinks.
+    """
+    if scandir is not None:
+        r = []
+        for entry in scandir(dirname):
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            r.append((entry.name, is_dir))
+        return r
+    else:
+        # Names with a dot can't be packages, so don't stat them.
+        return [(basename, '.' not in basename
+                           and isdir(join(dirname, basename)))
+                for basename in os.listdir(dirname)]
+
+def is_package_name(basename):
+    return (package_re.match(basename) is not None
+            and not keyword.iskeyword(basename)
+            and basename not in non_package_dirs)
+
+def is_package_dir(dirname):
+    if has_namespace_packages:
+        return True
+    init = join(dirname, '__init__.py')
+    return exists(init) or exists(init+'c')
 
 def find_in_dir(dirname):
     """
@@ -39,37 +101,319 @@ def find_in_dir(dirname):
     if dirname == '':
         dirname = '.'
     try:
-        basenames = os.listdir(dirname)
+        entries = list_dir(dirname)
     except OSError:
         return
-    for basename in basenames:
+    # Only directories which may be packages are checked for an __init__
+    # file, after all the entries were read.
+    subdirs = []
+    for basename, is_dir in entries:
         m = suffix_re.search(basename)
         if m:
             yield basename[:m.start()]
-        else:
-            if '.' not in basename and isdir(join(dirname, basename)):
-                init = join(dirname, basename, '__init__.py')
-                if exists(init) or exists(init+'c'):
-                    yield basename    
-
-def find_in_dir_cached(dirname):
-    if dirname not in cache:
-        # If it is in cache, it's already absolute.
-        dirname = os.path.abspath(dirname)
-    try:
-        st = os.stat(dirname)
-    except OSError:
-        return ()
-    if not stat.S_ISDIR(st.st_mode):
-        return ()
+        elif is_dir and is_package_name(basename):
+            subdirs.append(basename)
+    for basename in subdirs:
+        if is_package_dir(join(dirname, basename)):
+            yield basename
+
+def find_in_zip(filename):
+    """
+    Yield all names of modules in the top level of the given zip file (an
+    egg, for example).
+    """
     try:
-        mtime, modules = cache[dirname]
-    except KeyError:
-        mtime = 0
-    if mtime != st.st_mtime:
-        modules = list(find_in_dir(dirname))
-        cache[dirname] = (st.st_mtime, modules)
-    return modules
+        zf = zipfile.ZipFile(filename)
+        try:
+            names = zf.namelist()
+        finally:
+            zf.close()
+    except Exception:
+        return
+    for name in names:
+        parts = name.split('/')
+        if len(parts) == 1:
+            m = zip_suffix_re.search(name)
+            if m:
+                yield name[:m.start()]
+        elif (len(parts) == 2 and parts[1].startswith('__init__.')
+              and zip_suffix_re.search(parts[1])):
+            yield parts[0]
+
+def _target_names(target):
+    typ = type(target).__name__
+    if typ == 'Name':
+        yield target.id
+    elif typ in ('Tuple', 'List'):
+        for elt in target.elts:
+            for name in _target_names(elt):
+                yield name
+    elif typ == 'Starred':
+        for name in _target_names(target.value):
+            yield name
+
+def _str_list(node):
+    """
+    Return the strings in node if it's a list or tuple of string literals,
+    or None.
+    """
+    if type(node).__name__ not in ('List', 'Tuple'):
+        return None
+    r = []
+    for elt in node.elts:
+        typ = type(elt).__name__
+        if typ == 'Str':
+            r.append(elt.s)
+        elif typ == 'Constant' and isinstance(elt.value, basestring):
+            r.append(elt.value)
+        else:
+            return None
+    return r
+
+def _find_names(body, names, all_names):
+    """
+    Add the names which the statements in body bind to names. If they
+    assign a list of strings to __all__, add them to all_names.
+    Statements inside if, try, for, while and with blocks are included.
+    """
+    for node in body:
+        typ = type(node).__name__
+        if typ in ('FunctionDef', 'AsyncFunctionDef', 'ClassDef'):
+            names.append(node.name)
+        elif typ in ('Import', 'ImportFrom'):
+            for alias in node.names:
+                if alias.asname:
+                    names.append(alias.asname)
+                elif alias.name != '*':
+                    names.append(alias.name.split('.')[0])
+        elif typ in ('Assign', 'AugAssign', 'AnnAssign'):
+            if typ == 'Assign':
+                targets = node.targets
+            else:
+                targets = [node.target]
+            for target in targets:
+                for name in _target_names(target):
+                    names.append(name)
+                    if name == '__all__' and node.value is not None:
+                        strs = _str_list(node.value)
+                        if strs is not None:
+                            if typ == 'Assign':
+                                del all_names[:]
+                            all_names.extend(strs)
+        else:
+            for field in ('body', 'orelse', 'finalbody'):
+                _find_names(getattr(node, field, ()), names, all_names)
+            for handler in getattr(node, 'handlers', ()):
+                _find_names(handler.body, names, all_names)
+
+def parse_names(filename):
+    """
+    Return (names, all_names) - the top-level names defined in the source
+    file filename, and the names in its __all__, or None if it doesn't
+    define it.
+    """
+    if ast is not None:
+        f = open(filename, 'rb')
+        try:
+            source = f.read()
+        finally:
+            f.close()
+        try:
+            tree = ast.parse(source, filename)
+        except (SyntaxError, ValueError, TypeError):
+            # Perhaps it's for another version of Python
+            pass
+        else:
+            names = []
+            all_names = []
+            _find_names(tree.body, names, all_names)
+            if '__all__' not in names:
+                all_names = None
+            return sorted(set(names)), all_names
+    return regex_parse_names(filename), None
+
+def regex_parse_names(filename):
+    """
+    Return the names defined by def, class and import statements in the
+    source file filename, found with regular expressions.
+    """
+    importable = []
+    with open(filename) as fl:
+        in_import_block = False
+        continued_next_line = False
+        for line in fl.readlines():
+            pattern = '^(.*)$' if continued_next_line else '^(?:class|def|from .*? import|import) ([^(]*).*?$'
+            mat = re.match(pattern, line)
+
+            if line.startswith(('from', 'import')):
+                in_import_block = True
+            if mat is None:
+                in_import_block = continued_next_line = False
+            else:
+                continued_next_line = in_import_block and line.strip().endswith((',', '\\'))
+                if not continued_next_line:
+                    in_import_block = False
+
+                _imps = mat.groups()[0].strip().strip(' ,\\').split(',')
+                for _imp in _imps:
+                    if ' as ' in _imp:
+                        _imp = _imp.split(' as ')[-1]
+                    importable.append(_imp.strip())
+    return sorted(importable)
+
+class ModuleIndex(object):
+    """
+    Keep the names of the modules in directories, so that a directory is
+    only listed again when its mtime changes, and the names defined in
+    source files, so that a file is only parsed again when its mtime or
+    size change.
+    The index can be saved to a file, and is built in a background thread
+    when it's started, so that queries are answered from memory.
+    """
+    def __init__(self):
+        # A mapping from absolute names to (mtime, module_names) tuple.
+        self.cache = {}
+        # A mapping from absolute names of source files to
+        # (mtime, size, names, all_names) tuple. See parse_names.
+        self.members = {}
+        self.fn = None
+        self.is_dirty = False
+        self.thread = None
+        self.save_lock = threading.Lock()
+        self.save_timer = None
+
+    def find_in_dir(self, dirname):
+        if dirname not in self.cache:
+            # If it is in cache, it's already absolute.
+            dirname = os.path.abspath(dirname)
+        try:
+            st = os.stat(dirname)
+        except OSError:
+            return ()
+        if not (stat.S_ISDIR(st.st_mode) or stat.S_ISREG(st.st_mode)):
+            return ()
+        try:
+            mtime, modules = self.cache[dirname]
+        except KeyError:
+            mtime = 0
+        if mtime != st.st_mtime:
+            if stat.S_ISDIR(st.st_mode):
+                modules = list(set(find_in_dir(dirname)))
+            elif zipfile.is_zipfile(dirname):
+                modules = list(set(find_in_zip(dirname)))
+            else:
+                modules = []
+            self.cache[dirname] = (st.st_mtime, modules)
+            self.is_dirty = True
+        return modules
+
+    def parse_names(self, filename):
+        """
+        Return (names, all_names) for the source file filename, like
+        parse_names(), or None if it can't be read.
+        """
+        filename = os.path.abspath(filename)
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        try:
+            mtime, size, names, all_names = self.members[filename]
+        except KeyError:
+            mtime = size = None
+        if (mtime, size) != (st.st_mtime, st.st_size):
+            try:
+                names, all_names = parse_names(filename)
+            except (IOError, OSError):
+                return None
+            self.members[filename] = (st.st_mtime, st.st_size, names,
+                                      all_names)
+            self.is_dirty = True
+        return names, all_names
+
+    def start(self, fn, dirnames):
+        """
+        Load the index from the file fn (a version suffix is added, since
+        the marshal format changes between versions), and update it with
+        dirnames in a background thread.
+        Does nothing if the index was already started.
+        """
+        if self.thread is not None:
+            return
+        self.fn = '%s-%s-%d.%d' % ((fn, sys.platform) + sys.version_info[:2])
+        try:
+            f = open(self.fn, 'rb')
+            try:
+                cache, members = marshal.load(f)
+            finally:
+                f.close()
+        except Exception:
+            pass
+        else:
+            if isinstance(cache, dict) and isinstance(members, dict):
+                cache.update(self.cache)
+                self.cache = cache
+                members.update(self.members)
+                self.members = members
+        self.thread = threading.Thread(target=self._refresh,
+                                       name='DreamPie module index',
+                                       args=(list(dirnames),))
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def _refresh(self, dirnames):
+        for dirname in dirnames:
+            self.find_in_dir(dirname)
+        # Forget directories and files which were removed
+        for d in (self.cache, self.members):
+            for fn in list(d):
+                if not exists(fn):
+                    d.pop(fn, None)
+                    self.is_dirty = True
+        self.save()
+
+    def save_later(self):
+        """
+        Save the index in a background thread, SAVE_DELAY seconds from now,
+        so that queries don't wait for it.
+        """
+        if self.fn is None or not self.is_dirty or self.save_timer is not None:
+            return
+        self.save_timer = threading.Timer(SAVE_DELAY, self._on_save_timer)
+        self.save_timer.setDaemon(True)
+        self.save_timer.start()
+
+    def _on_save_timer(self):
+        # Changes made from now on will schedule another save
+        self.save_timer = None
+        self.save()
+
+    def save(self):
+        """Save the index to its file, if it was changed."""
+        if self.fn is None or not self.is_dirty:
+            return
+        self.save_lock.acquire()
+        try:
+            self.is_dirty = False
+            # Write to a temporary file, so that a DreamPie running at the
+            # same time won't read a partial file.
+            tmp_fn = '%s.%d.tmp' % (self.fn, os.getpid())
+            try:
+                f = open(tmp_fn, 'wb')
+                try:
+                    marshal.dump((self.cache.copy(), self.members.copy()), f)
+                finally:
+                    f.close()
+                if sys.platform == 'win32' and exists(self.fn):
+                    os.remove(self.fn)
+                os.rename(tmp_fn, self.fn)
+            except (IOError, OSError):
+                # The index is only an optimization
+                pass
+        finally:
+            self.save_lock.release()
+
+index = ModuleIndex()
 
 def find_package_path(package):
     """
@@ -105,14 +449,12 @@ def find_modules(package):
     or [] for a toplevel module.
     Return a list of module names.
     """
-    start_time = time.time()
     r = set()
     path = find_package_path(package)
     if path:
         for dirname in path:
-            r.update(find_in_dir_cached(dirname))
-            if time.time() - start_time > TIMEOUT:
-                break
+            r.update(index.find_in_dir(dirname))
+        index.save_later()
     prefix = ''.join(s+'.' for s in package)
     for name in sys.modules:
         if name.startswith(prefix):
@@ -123,33 +465,18 @@ def find_modules(package):
     return sorted(r)
 
 def simple_parse_source(mod_name):
-    # TODO: add parsing of importable constants?
+    """
+    Return (names, all_names) for the source file of the module mod_name,
+    like parse_names(). If it isn't found, return ([], None).
+    """
     package = mod_name.split('.')
     package[-1] += '.py'
     path = find_package_path(package)
 
-    importable = []
     if path:
         for filename in path:
-            with open(filename) as fl:
-                in_import_block = False
-                continued_next_line = False
-                for line in fl.readlines():
-                    pattern = '^(.*)$' if continued_next_line else '^(?:class|def|from .*? import|import) ([^(]*).*?$'
-                    mat = re.match(pattern, line)
-
-                    if line.startswith(('from', 'import')):
-                        in_import_block = True
-                    if mat is None:
-                        in_import_block = continued_next_line = False
-                    else:
-                        continued_next_line = in_import_block and line.strip().endswith((',', '\\'))
-                        if not continued_next_line:
-                            in_import_block = False
-
-                        _imps = mat.groups()[0].strip().strip(' ,\\').split(',')
-                        for _imp in _imps:
-                            if ' as ' in _imp:
-                                _imp = _imp.split(' as ')[-1]
-                            importable.append(_imp.strip())
-    return sorted(importable)
+            r = index.parse_names(filename)
+            if r is not None:
+                index.save_later()
+                return r
+    return [], None
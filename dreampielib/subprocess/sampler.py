@@ -0,0 +1,107 @@
+# Copyright 2012 Noam Yorav-Raphael
+#
+# This file is part of DreamPie.
+#
+# DreamPie is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# DreamPie is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with DreamPie.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A statistical profiler, which counts the lines of code typed in the shell
+which are running, every few milliseconds of CPU time.
+"""
+
+__all__ = ['Sampler']
+
+import sys
+import signal
+import linecache
+
+class Sampler(object):
+    """
+    Sample the stacks of all threads every interval seconds of CPU time, and
+    count, for every line of code in a file whose name starts with prefix,
+    the number of samples in which it was running (itself, or by calling
+    a function).
+    """
+    # setitimer is only available on Unix, and Jython doesn't have
+    # _current_frames.
+    is_available = (hasattr(signal, 'setitimer')
+                    and hasattr(sys, '_current_frames'))
+
+    def __init__(self, interval=0.005, prefix='<pyshell#'):
+        self.interval = interval
+        self.prefix = prefix
+        # Maps (filename, lineno) to the number of samples
+        self.counts = {}
+        self.n_samples = 0
+        self.old_handler = None
+
+    def start(self):
+        self.old_handler = signal.signal(signal.SIGPROF, self._on_sample)
+        # Restart system calls interrupted by the signal, instead of raising
+        # EINTR errors in the user's code.
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self.old_handler)
+
+    def _on_sample(self, _signum, _frame):
+        self.n_samples += 1
+        counts = self.counts
+        prefix = self.prefix
+        seen = set()
+        for frame in sys._current_frames().values():
+            while frame is not None:
+                filename = frame.f_code.co_filename
+                if filename.startswith(prefix):
+                    key = (filename, frame.f_lineno)
+                    # A line is counted once per sample, even if it's in the
+                    # stack a few times because of recursion.
+                    if key not in seen:
+                        seen.add(key)
+                        counts[key] = counts.get(key, 0) + 1
+                frame = frame.f_back
+
+    @staticmethod
+    def _sort_key(key):
+        filename, lineno = key
+        # Sort <pyshell#10> after <pyshell#9>
+        num = filename[filename.rfind('#')+1:-1]
+        if num.isdigit():
+            return (int(num), filename, lineno)
+        else:
+            return (-1, filename, lineno)
+
+    def get_report(self):
+        """
+        Return a report of the hits of every line which was sampled, in the
+        order of the code.
+        """
+        lines = [u'Sampled %d times, every %d ms of CPU time.\n' % (
+            self.n_samples, int(self.interval * 1000))]
+        if not self.counts:
+            lines.append(u'No line typed in the shell was sampled.\n')
+            return u''.join(lines)
+        lines.append(u' hits      %  line\n')
+        for key in sorted(self.counts, key=self._sort_key):
+            filename, lineno = key
+            count = self.counts[key]
+            source = linecache.getline(filename, lineno).rstrip()
+            if not isinstance(source, unicode):
+                source = source.decode('utf8', 'replace')
+            lines.append(u'%5d %5.1f%%  %s:%d  %s\n' % (
+                count, 100. * count / self.n_samples, filename, lineno,
+                source))
+        return u''.join(lines)
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+# Measure the time it takes brine to dump and load typical RPC payloads.
+# Usage: bench_brine.py [other-brine.py]
+# If another brine module is given, it is measured too, and the results are
+# checked to be the same. To compare with an older version, run something like
+# git show <rev>:dreampielib/common/brine.py > /tmp/old_brine.py
+
+import sys
+from os.path import dirname, abspath
+import imp
+import timeit
+
+src_dir = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, src_dir)
+
+from dreampielib.common import brine
+
+def get_payloads():
+    """Return a list of (name, obj) pairs, which look like real RPC traffic."""
+    names = sorted(set(dir(__builtins__) + dir(sys) + dir(imp) + dir(str)))
+    names = [unicode('%s%d' % (name, i)) for i in range(40) for name in names]
+    public = [name for name in names if not name.startswith('_')]
+    private = [name for name in names if name.startswith('_')]
+    return [
+        ('call', (u'complete_attributes', (u'os.path',))),
+        ('execute reply', (True, None)),
+        ('firstlevels %d names' % len(names), (public, private)),
+        ('func args', (u'f', [u'a', u'b', u'c'], u'args', u'kwargs', [1, None])),
+        ('1 MB result', (u'x' * 1024 * 1024, 1)),
+        ('1000 small tuples', [(i, u'%d' % i, i * 0.5) for i in range(1000)]),
+        ]
+
+def bench(mod, obj):
+    """Return the best (dump, load) times in seconds."""
+    data = mod.dump(obj)
+    number = max(1, 200000 // (len(data) + 100))
+    dump_t = min(timeit.repeat(lambda: mod.dump(obj), number=number, repeat=3))
+    load_t = min(timeit.repeat(lambda: mod.load(data), number=number, repeat=3))
+    return dump_t / number, load_t / number
+
+def main():
+    mods = [('current', brine)]
+    if len(sys.argv) > 1:
+        mods.append((sys.argv[1], imp.load_source('other_brine', sys.argv[1])))
+    for name, obj in get_payloads():
+        data = brine.dump(obj)
+        print "%s (%d bytes):" % (name, len(data))
+        for mod_name, mod in mods:
+            if mod is not brine:
+                assert mod.dump(obj) == data
+                assert mod.load(data) == obj
+            dump_t, load_t = bench(mod, obj)
+            print "  %-20s dump %9.1f us  load %9.1f us" % (
+                mod_name, dump_t * 1e6, load_t * 1e6)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+# Measure the time it takes to find the modules in a synthetic site-packages
+# directory, with the listdir-and-stat scan which find_modules used before,
+# and with the current scan, with and without scandir.
+# Usage: bench_find_modules.py [n-entries]
+# scandir is in os since Python 3.5, and is a package before that, so run
+# this with both Python 2 and Python 3.
+
+import sys
+import os
+from os.path import dirname, abspath, join, isdir, exists
+import imp
+import time
+import tempfile
+import shutil
+
+src_dir = dirname(dirname(abspath(__file__)))
+# Load the module by itself, so that this runs on Python 3 too.
+find_modules = imp.load_source(
+    'find_modules', join(src_dir, 'dreampielib', 'subprocess',
+                         'find_modules.py'))
+
+N_REPEAT = 5
+
+def make_site_packages(n_entries):
+    """
+    Create a directory with n_entries entries, of the kinds found in
+    site-packages, and return its name.
+    """
+    d = tempfile.mkdtemp(prefix='bench_find_modules')
+    for i in range(n_entries):
+        kind = i % 5
+        if kind == 0:
+            open(join(d, 'mod%d.py' % i), 'w').close()
+        elif kind == 1:
+            open(join(d, 'ext%d.so' % i), 'w').close()
+        elif kind == 2:
+            os.mkdir(join(d, 'pkg%d' % i))
+            open(join(d, 'pkg%d' % i, '__init__.py'), 'w').close()
+        elif kind == 3:
+            os.mkdir(join(d, 'dist%d-1.0.dist-info' % i))
+        else:
+            os.mkdir(join(d, 'data%d' % i))
+    return d
+
+def old_find_in_dir(dirname):
+    suffix_re = find_modules.suffix_re
+    for basename in os.listdir(dirname):
+        m = suffix_re.search(basename)
+        if m:
+            yield basename[:m.start()]
+        else:
+            if '.' not in basename and isdir(join(dirname, basename)):
+                init = join(dirname, basename, '__init__.py')
+                if exists(init) or exists(init+'c'):
+                    yield basename
+
+def timed(func, dirname):
+    best = None
+    for _i in range(N_REPEAT):
+        start = time.time()
+        n = len(list(func(dirname)))
+        t = time.time() - start
+        if best is None or t < best:
+            best = t
+    return best, n
+
+def main():
+    n_entries = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    d = make_site_packages(n_entries)
+    try:
+        print('%d entries, best of %d runs' % (n_entries, N_REPEAT))
+        t, n = timed(old_find_in_dir, d)
+        print('%-20s %.3fs %d modules' % ('listdir and stat', t, n))
+        if find_modules.scandir is not None:
+            t, n = timed(find_modules.find_in_dir, d)
+            print('%-20s %.3fs %d modules' % ('scandir', t, n))
+        else:
+            print('%-20s (not available)' % 'scandir')
+        find_modules.scandir = None
+        t, n = timed(find_modules.find_in_dir, d)
+        print('%-20s %.3fs %d modules' % ('without scandir', t, n))
+    finally:
+        shutil.rmtree(d)
+
+if __name__ == '__main__':
+    main()
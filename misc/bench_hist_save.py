@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+# Measure the time it takes to save a large history to HTML.
+# Usage: bench_hist_save.py [megabytes]
+
+import sys
+from os.path import dirname, abspath
+import time
+import tempfile
+
+src_dir = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, src_dir)
+
+import gtk
+
+from dreampielib.gui import tags
+from dreampielib.gui.tags import (COMMAND, PROMPT, COMMAND_SEP, KEYWORD,
+                                  STRING, OUTPUT, STDOUT, RESULT_IND, RESULT)
+from dreampielib.gui.tag_runs import get_tag_runs
+from dreampielib.gui.hist_persist import iter_history_runs, iter_history_html
+
+OUTPUT_LINES = 50
+LINE = 'x' * 79 + '\n'
+
+def fill(tb, size):
+    """Fill the text buffer with sections which look like real history."""
+    w = lambda s, *tag_names: tb.insert_with_tags_by_name(
+        tb.get_end_iter(), s, *tag_names)
+    n = 0
+    while tb.get_char_count() < size:
+        w('>>> ', COMMAND, PROMPT)
+        w('for', COMMAND, KEYWORD)
+        w(' i ', COMMAND)
+        w('in', COMMAND, KEYWORD)
+        w(' range(%d): print ' % OUTPUT_LINES, COMMAND)
+        w("'%d'" % n, COMMAND, STRING)
+        w('\n', COMMAND)
+        w('\r', COMMAND_SEP)
+        w(LINE * OUTPUT_LINES, OUTPUT, STDOUT)
+        w('%d: ' % n, OUTPUT, RESULT_IND)
+        w('None\n', OUTPUT, RESULT)
+        n += 1
+    w('>>> ', COMMAND, PROMPT)
+
+def main():
+    megabytes = float(sys.argv[1]) if len(sys.argv) > 1 else 50
+    tv = gtk.TextView()
+    tb = tv.get_buffer()
+    tags.add_tags(tb)
+    print "Filling the text buffer with %.1f MB..." % megabytes
+    fill(tb, int(megabytes * 1024 * 1024))
+
+    start_time = time.time()
+    runs = get_tag_runs(tb, tb.get_start_iter(), tb.get_end_iter())
+    snapshot_time = time.time() - start_time
+    print "Snapshot of %d runs: %.2f seconds" % (len(runs), snapshot_time)
+
+    f = tempfile.TemporaryFile()
+    max_chunk_time = 0
+    start_time = last_time = time.time()
+    for chunk in iter_history_html(tv, iter_history_runs(runs, ())):
+        f.write(chunk)
+        t = time.time()
+        max_chunk_time = max(max_chunk_time, t - last_time)
+        last_time = t
+    write_time = time.time() - start_time
+    size = f.tell() / (1024. * 1024)
+    f.close()
+    print "Wrote %.1f MB in %.2f seconds (%.1f MB/s), longest chunk %.3f s" % (
+        size, write_time, size / write_time, max_chunk_time)
+
+if __name__ == '__main__':
+    main()
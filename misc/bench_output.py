@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+# Measure the throughput of output written by the subprocess, as it is
+# received by the GUI's SubprocessHandler.
+# Usage: bench_output.py [megabytes] [python-executable]
+
+import sys
+from os.path import join, dirname, abspath
+import time
+
+src_dir = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, src_dir)
+
+import gobject
+gobject.threads_init()
+
+from dreampielib.subp_lib import build
+from dreampielib.gui.subprocess_handler import SubprocessHandler
+
+LINE_LEN = 80
+
+def main():
+    megabytes = float(sys.argv[1]) if len(sys.argv) > 1 else 10
+    pyexec = sys.argv[2] if len(sys.argv) > 2 else sys.executable
+    n_lines = int(megabytes * 1024 * 1024) // LINE_LEN
+
+    build()
+    data_dir = join(src_dir, 'dreampielib', 'data')
+    loop = gobject.MainLoop()
+    state = dict(received=0, n_calls=0, done=False)
+
+    def check_done():
+        if state['done'] and state['received'] >= n_lines * LINE_LEN:
+            loop.quit()
+
+    def on_stdout_recv(data):
+        state['received'] += len(data)
+        state['n_calls'] += 1
+        check_done()
+
+    def on_stderr_recv(data):
+        sys.stderr.write(data)
+
+    def on_object_recv(_obj):
+        state['done'] = True
+        check_done()
+
+    def on_subp_terminated():
+        print >> sys.stderr, "Subprocess terminated unexpectedly"
+        loop.quit()
+
+    handler = SubprocessHandler(pyexec, data_dir,
+                                on_stdout_recv, on_stderr_recv,
+                                on_object_recv, on_subp_terminated)
+    handler.start()
+    source = (u"import sys\n"
+              u"line = 'x' * %d + '\\n'\n"
+              u"for i in range(%d): sys.stdout.write(line)\n"
+              % (LINE_LEN - 1, n_lines))
+    handler.send_object((0, u'execute', (source,)))
+    _req_id, (is_ok, _syntax_error_info) = handler.recv_object()
+    assert is_ok
+
+    start_time = time.time()
+    loop.run()
+    elapsed = time.time() - start_time
+
+    mb = state['received'] / (1024. * 1024)
+    print "Received %.1f MB in %.2f seconds (%.1f MB/s), %d callbacks" % (
+        mb, elapsed, mb / elapsed, state['n_calls'])
+    handler.kill()
+
+if __name__ == '__main__':
+    main()
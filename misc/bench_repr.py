@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+# Measure the time it takes to format pathological results with repr(), with
+# pprint and with BoundedRepr, using the default limits of DreamPie. The last
+# column is the time it takes to format the first chunk which DreamPie shows.
+# Usage: bench_repr.py [max-seconds]
+# pprint is skipped for objects on which it takes more than a few seconds.
+
+import sys
+from os.path import dirname, abspath
+import time
+import pprint
+
+src_dir = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, src_dir)
+
+from dreampielib.subprocess.bounded_repr import BoundedRepr
+
+# The defaults in the config file, except for max_seconds
+MAX_DEPTH = 20
+MAX_ITEMS = 10000
+# RES_CHUNK_LEN of the subprocess
+CHUNK_LEN = 10000
+
+class SlowRepr(object):
+    def __repr__(self):
+        time.sleep(0.001)
+        return 'SlowRepr()'
+
+def get_objects():
+    """Return a list of (name, obj, is_slow_for_pprint) tuples."""
+    deep = []
+    for _i in range(500):
+        deep = [deep]
+    objs = [
+        ('list of 10M ints', list(range(10 ** 7)), True),
+        ('dict of 1M strs', dict((i, str(i)) for i in range(10 ** 6)), True),
+        ('set of 1M ints', set(range(10 ** 6)), True),
+        ('10M char str', 'x' * 10 ** 7, False),
+        ('1000x1000 nested lists', [list(range(1000))] * 1000, True),
+        ('500 nested lists', deep, False),
+        ('10000 slow reprs', [SlowRepr()] * 10000, True),
+        ]
+    try:
+        import numpy
+    except ImportError:
+        pass
+    else:
+        objs.append(('numpy 1000x1000', numpy.zeros((1000, 1000)), False))
+    return objs
+
+def timed(func, *args):
+    start = time.time()
+    try:
+        r = func(*args)
+    except Exception, e:
+        return time.time() - start, '%s: %s' % (type(e).__name__, e)
+    return time.time() - start, len(r)
+
+def main():
+    max_seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 2
+    bounded = BoundedRepr(80, MAX_DEPTH, MAX_ITEMS, None, max_seconds)
+    bounded_flat = BoundedRepr(None, MAX_DEPTH, MAX_ITEMS, None, max_seconds)
+    bounded_chunk = BoundedRepr(80, MAX_DEPTH, MAX_ITEMS, CHUNK_LEN,
+                                max_seconds)
+    fmt = '%-24s' + ' %20s' * 5
+    print fmt % ('', 'repr', 'pprint', 'bounded repr', 'bounded pprint',
+                 'first chunk')
+    for name, obj, is_slow in get_objects():
+        results = []
+        for func in (repr, pprint.pformat, bounded_flat.repr, bounded.repr,
+                     bounded_chunk.repr):
+            if is_slow and func is pprint.pformat:
+                results.append('(skipped)')
+                continue
+            t, r = timed(func, obj)
+            if isinstance(r, int):
+                results.append('%.3fs %d chars' % (t, r))
+            else:
+                results.append('%.3fs %s' % (t, r[:10]))
+        print fmt % ((name,) + tuple(results))
+
+if __name__ == '__main__':
+    main()
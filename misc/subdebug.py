@@ -1,6 +1,9 @@
 #!/usr/bin/env python
 
 # Interact with the subprocess without a big GUI program
+# Type requests as (req_id, funcname, args), for example
+# (0, u'execute', (u'1+1',))
+# Replies are printed as (req_id, result).
 
 import sys
 import os